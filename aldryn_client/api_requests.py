@@ -1,26 +1,85 @@
 import os
+import socket
+import time
 
 import click
 import requests
-from six.moves.urllib_parse import urljoin
-
-from . import messages
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+import six
+from six.moves.urllib_parse import urljoin, urlsplit
+
+from . import messages, settings
+from .cache import replace_file
+from .compression import get_accept_header
+from .polling import ProgressResult, parse_retry_after
+from .transfer import (
+    DownloadState, MultipartEncoder, SegmentedDownload, StreamReader,
+    DOWNLOAD_ERRORS, get_retry_delay, supports_segments,
+)
 from .utils import create_temp_dir
 
 
+def get_keep_alive_socket_options():
+    options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    # detect dead connections (e.g. after a VPN reconnect) within ~2 minutes
+    # instead of waiting for the operating system default of two hours
+    for name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15),
+                        ('TCP_KEEPCNT', 4)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTP adapter enabling TCP keep-alive on its connections and reporting
+    how often connections have been reused.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('socket_options', get_keep_alive_socket_options())
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def get_stats(self):
+        pools = self.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        requests_count = sum(pool.num_requests for pool in pools)
+        connections = sum(pool.num_connections for pool in pools)
+        return {
+            'requests': requests_count,
+            'connections': connections,
+            'reused': requests_count - connections,
+        }
+
+
 class SingleHostSession(requests.Session):
+    pool_maxsize = settings.HTTP_POOL_SIZE
+    timeout = settings.HTTP_TIMEOUT
+
     def __init__(self, host, **kwargs):
         super(SingleHostSession, self).__init__()
         self.host = host.rstrip('/')
         for key, value in kwargs.items():
             setattr(self, key, value)
+        self.adapter = KeepAliveAdapter(
+            pool_connections=self.pool_maxsize,
+            pool_maxsize=self.pool_maxsize,
+        )
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
 
     def request(self, method, url, *args, **kwargs):
         url = urljoin(self.host, url)
+        kwargs.setdefault('timeout', self.timeout)
         return super(SingleHostSession, self).request(
             method, url, *args, **kwargs
         )
 
+    def get_stats(self):
+        return self.adapter.get_stats()
+
 
 class APIRequest(object):
     network_exception_message = messages.NETWORK_ERROR_MESSAGE
@@ -33,6 +92,9 @@ class APIRequest(object):
     method = 'GET'
     url = None
     headers = {}
+    # seconds a response may be served from the response cache without
+    # revalidating it. ``None`` disables caching for this request.
+    cache_ttl = None
 
     def __init__(self, session, url=None, url_kwargs=None, data=None, files=None,
                  *args, **kwargs):
@@ -52,19 +114,76 @@ class APIRequest(object):
     def get_error_code_map(self):
         return self.response_code_error_map
 
+    def get_headers(self):
+        return self.headers
+
+    def get_cache(self):
+        cache = getattr(self.session, 'cache', None)
+        if cache and self.method == 'GET' and self.cache_ttl is not None:
+            return cache
+        return None
+
     def request(self, *args, **kwargs):
+        start = time.time()
+        cache = self.get_cache()
+        if cache:
+            response = cache.fetch(self, *args, **kwargs)
+        else:
+            response = self.send(*args, **kwargs)
         try:
-            response = self.session.request(
-                self.method, self.get_url(),
-                data=self.data, files=self.files,
-                headers=self.headers,
-                *args, **kwargs
-            )
+            return self.verify(response)
+        finally:
+            self.log_request(response, time.time() - start)
+
+    def get_bytes_sent(self, response):
+        body = response.request.body if response.request else None
+        try:
+            return len(body or b'')
+        except TypeError:
+            # streamed body of unknown length
+            return 0
+
+    def get_bytes_received(self, response):
+        if response.raw is None or response._content_consumed:
+            return len(response.content or b'')
+        # streamed bodies report what they read themselves
+        return 0
+
+    def get_log_url(self):
+        # URLs handed out by the server may be signed, never log their query
+        return type(self).url or urlsplit(self.url).path
+
+    def log_request(self, response, duration):
+        request_log = getattr(self.session, 'request_log', None)
+        if request_log is None:
+            return
+        request_log.add(
+            method=self.method,
+            url=self.get_log_url(),
+            status=response.status_code,
+            ttfb=response.elapsed.total_seconds(),
+            total=duration,
+            bytes_sent=self.get_bytes_sent(response),
+            bytes_received=self.get_bytes_received(response),
+            cached=getattr(response, 'from_cache', False),
+        )
+
+    def send(self, *args, **kwargs):
+        try:
+            return self.send_request(*args, **kwargs)
         except (requests.exceptions.ConnectionError,
                 requests.exceptions.Timeout) as e:
-            raise click.ClickException(messages.NETWORK_ERROR_MESSAGE + unicode(e))
+            raise click.ClickException(
+                messages.NETWORK_ERROR_MESSAGE + six.text_type(e)
+            )
 
-        return self.verify(response)
+    def send_request(self, *args, **kwargs):
+        kwargs.setdefault('headers', self.get_headers())
+        return self.session.request(
+            self.method, self.get_url(),
+            data=self.data, files=self.files,
+            *args, **kwargs
+        )
 
     def verify(self, response):
         if not response.ok:
@@ -86,6 +205,40 @@ class RawResponse(object):
         return response
 
 
+class StreamResponse(object):
+    """
+    Return the response without reading its body, the caller is
+    responsible to consume and close it. The request is logged once the
+    response is closed, with the bytes read until then.
+    """
+    def process(self, response):
+        return response
+
+    def request(self, *args, **kwargs):
+        kwargs['stream'] = True
+        return super(StreamResponse, self).request(*args, **kwargs)
+
+    def get_bytes_received(self, response):
+        if response.raw is None:
+            return 0
+        # bytes received over the connection, before decompressing them
+        return response.raw.tell()
+
+    def log_request(self, response, duration):
+        if not response.ok:
+            return super(StreamResponse, self).log_request(response, duration)
+        start = time.time() - duration
+        close = response.close
+
+        def close_and_log():
+            response.close = close
+            close()
+            super(StreamResponse, self).log_request(
+                response, time.time() - start,
+            )
+        response.close = close_and_log
+
+
 class TextResponse(object):
     def process(self, response):
         return response.text
@@ -96,6 +249,14 @@ class JsonResponse(object):
         return response.json()
 
 
+class ProgressResponse(object):
+    def process(self, response):
+        return ProgressResult(
+            response.json(),
+            retry_after=parse_retry_after(response.headers.get('Retry-After')),
+        )
+
+
 class DjangoFormMixin(object):
     success_message = 'Request successful'
 
@@ -117,27 +278,216 @@ class DjangoFormMixin(object):
 
 
 class FileResponse(object):
+    resumable = False
+    # number of times an interrupted resumable download is continued
+    download_retries = 5
+    # bytes written between two updates of the resume sidecar file
+    checkpoint_size = 8 * 1024 * 1024
+    # number of connections used to download large files
+    segments = 1
+    min_segment_size = settings.DOWNLOAD_MIN_SEGMENT_SIZE
+    # keep the downloaded file in the download cache of the session
+    cache_download = False
+
     def __init__(self, *args, **kwargs):
         self.filename = kwargs.pop('filename', None)
         self.directory = kwargs.pop('directory', None)
+        self.resumable = kwargs.pop('resume', self.resumable)
+        self.segments = kwargs.pop('segments', None) or self.segments
+        self.min_segment_size = (
+            kwargs.pop('min_segment_size', None) or self.min_segment_size
+        )
+        self.dump_path = None
+        self.download_state = None
+        self.bytes_received = 0
         super(FileResponse, self).__init__(*args, **kwargs)
 
+    def get_dump_path(self):
+        if not self.dump_path:
+            self.dump_path = os.path.join(
+                self.directory or create_temp_dir(),
+                self.filename or 'data.tar.gz',
+            )
+        return self.dump_path
+
+    def get_download_headers(self):
+        headers = dict(super(FileResponse, self).get_headers())
+        # the file as stored on the server: decoding a gzip content encoding
+        # would make the written size differ from the Content-Length and
+        # the ranges of resumed and segmented downloads
+        headers['accept-encoding'] = 'identity'
+        return headers
+
+    def get_headers(self):
+        headers = self.get_download_headers()
+        if self.download_state:
+            headers.update(self.download_state.get_range_headers())
+        return headers
+
+    def verify(self, response):
+        self.bytes_received = 0
+        if (self.download_state and
+                response.status_code ==
+                requests.codes.requested_range_not_satisfiable):
+            # the partial file does not match the remote file anymore
+            self.download_state.clear()
+            raise RangeNotSatisfiable()
+        return super(FileResponse, self).verify(response)
+
+    def get_download_cache(self):
+        if self.cache_download:
+            return getattr(self.session, 'download_cache', None)
+        return None
+
     def process(self, response):
-        dump_path = os.path.join(
-            self.directory or create_temp_dir(),
-            self.filename or 'data.tar.gz',
-        )
+        cache = self.get_download_cache()
+        key = cache.get_key(response) if cache else None
+        if key and cache.get(key, self.get_dump_path()):
+            # only the headers have been received
+            response.close()
+            response.from_cache = True
+            if self.download_state:
+                self.download_state.clear()
+            return self.get_dump_path()
+        dump_path = self.download(response)
+        if key:
+            cache.add(key, dump_path)
+        return dump_path
+
+    def download(self, response):
+        if supports_segments(response, self.segments, self.min_segment_size):
+            return self.process_segmented(response)
+
+        if self.download_state:
+            return self.process_resumable(response)
 
-        with open(dump_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
+        # the file at the dump path may be a hard link into the download
+        # cache, which must not be overwritten in place
+        dump_path = self.get_dump_path()
+        temp_path = dump_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in StreamReader(response):
                     f.write(chunk)
-                    f.flush()
+                    self.bytes_received += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        replace_file(temp_path, dump_path)
+        return dump_path
+
+    def process_segmented(self, response):
+        download = SegmentedDownload(
+            self.session,
+            url=self.get_url(),
+            headers=self.get_download_headers(),
+            path=self.get_dump_path(),
+            response=response,
+            segments=self.segments,
+            min_segment_size=self.min_segment_size,
+            retries=self.download_retries,
+            state=self.download_state,
+            checkpoint_size=self.checkpoint_size,
+        )
+        dump_path = download.run()
+        self.bytes_received += download.size
         return dump_path
 
+    def process_resumable(self, response):
+        state = self.download_state
+        mode = state.start(response)
+        checkpoint = state.offset
+        try:
+            with open(state.partial_path, mode) as f:
+                for chunk in StreamReader(response):
+                    f.write(chunk)
+                    state.offset += len(chunk)
+                    self.bytes_received += len(chunk)
+                    if state.offset - checkpoint >= self.checkpoint_size:
+                        f.flush()
+                        state.save()
+                        checkpoint = state.offset
+        finally:
+            state.save()
+
+        if state.size is not None and state.offset != state.size:
+            raise requests.exceptions.ChunkedEncodingError(
+                'Received {} of {} bytes'.format(state.offset, state.size)
+            )
+        return state.finish()
+
+    def get_bytes_received(self, response):
+        return self.bytes_received
+
+    def send(self, *args, **kwargs):
+        if self.download_state is not None:
+            # connection errors are retried by the resume loop in request()
+            return self.send_request(*args, **kwargs)
+        return super(FileResponse, self).send(*args, **kwargs)
+
     def request(self, *args, **kwargs):
         kwargs['stream'] = True
-        return super(FileResponse, self).request(*args, **kwargs)
+        if not self.resumable:
+            return super(FileResponse, self).request(*args, **kwargs)
+
+        self.download_state = DownloadState(self.get_dump_path()).load()
+        attempt = 0
+        while True:
+            if self.download_state.is_complete:
+                return self.download_state.finish()
+            try:
+                return super(FileResponse, self).request(*args, **kwargs)
+            except RangeNotSatisfiable:
+                pass
+            except DOWNLOAD_ERRORS as e:
+                attempt += 1
+                if attempt > self.download_retries:
+                    raise click.ClickException(
+                        messages.DOWNLOAD_INTERRUPTED.format(
+                            path=self.download_state.partial_path,
+                            error=e,
+                        )
+                    )
+                click.secho(
+                    ' connection lost, resuming...', fg='yellow', nl=False
+                )
+                time.sleep(get_retry_delay(attempt))
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class StreamingUploadMixin(object):
+    """
+    Send ``files`` as a streamed multipart body instead of letting requests
+    build the whole body in memory.
+    """
+    def __init__(self, *args, **kwargs):
+        self.progress_callback = kwargs.pop('progress_callback', None)
+        super(StreamingUploadMixin, self).__init__(*args, **kwargs)
+        self.encoder = None
+
+    def get_headers(self):
+        headers = super(StreamingUploadMixin, self).get_headers()
+        if self.encoder is not None:
+            headers = dict(headers, **{
+                'Content-Type': self.encoder.content_type,
+            })
+        return headers
+
+    def request(self, *args, **kwargs):
+        if self.files:
+            self.encoder = MultipartEncoder(
+                self.data, self.files, callback=self.progress_callback,
+            )
+            if self.encoder.length is None:
+                # requests sends iterators with chunked transfer encoding
+                self.data = iter(self.encoder)
+            else:
+                self.data = self.encoder
+            self.files = {}
+        return super(StreamingUploadMixin, self).request(*args, **kwargs)
 
 
 class LoginRequest(APIRequest):
@@ -148,13 +498,15 @@ class LoginRequest(APIRequest):
 
 class ProjectListRequest(APIRequest):
     url = '/api/v1/user-websites/'
+    cache_ttl = 60
 
 
 class ProjectDetailRequest(APIRequest):
     url = '/api/v1/website/{website_id}/detail/'
+    cache_ttl = 5 * 60
 
 
-class DeployProjectProgressRequest(JsonResponse, APIRequest):
+class DeployProjectProgressRequest(ProgressResponse, APIRequest):
     url = '/api/v1/website/{website_id}/deploy/'
     method = 'GET'
 
@@ -170,12 +522,13 @@ class RegisterAddonRequest(DjangoFormMixin, JsonResponse, APIRequest):
     success_message = 'Addon successfully registered'
 
 
-class UploadAddonRequest(TextResponse, APIRequest):
+class UploadAddonRequest(StreamingUploadMixin, TextResponse, APIRequest):
     url = '/api/v1/apps/'
     method = 'POST'
 
 
-class UploadBoilerplateRequest(TextResponse, APIRequest):
+class UploadBoilerplateRequest(StreamingUploadMixin, TextResponse,
+                               APIRequest):
     url = '/api/v1/boilerplates/'
     method = 'POST'
 
@@ -200,6 +553,7 @@ class ProjectUnlockRequest(TextResponse, APIRequest):
 
 class SlugToIDRequest(APIRequest):
     url = '/api/v1/slug-to-id/{website_slug}/'
+    cache_ttl = 24 * 60 * 60
 
     def process(self, response):
         return response.json().get('id')
@@ -207,6 +561,7 @@ class SlugToIDRequest(APIRequest):
 
 class IDToSlugRequest(APIRequest):
     url = '/api/v1/id-to-slug/{website_id}/'
+    cache_ttl = 24 * 60 * 60
 
     def process(self, response):
         return response.json().get('slug')
@@ -214,6 +569,7 @@ class IDToSlugRequest(APIRequest):
 
 class DownloadBackupRequest(FileResponse, APIRequest):
     url = '/api/v1/workspace/{website_slug}/download/backup/'
+    cache_download = True
     headers = {'accept': 'application/x-tar-gz'}
 
     def verify(self, response):
@@ -230,13 +586,21 @@ class DownloadDBRequestRequest(JsonResponse, APIRequest):
     method = 'POST'
 
 
-class DownloadDBProgressRequest(JsonResponse, APIRequest):
+class DownloadDBProgressRequest(ProgressResponse, APIRequest):
     method = 'GET'
 
 
 class DownloadDBRequest(FileResponse, APIRequest):
     url = '/api/v1/workspace/{website_slug}/download/db/'
-    headers = {'accept': 'application/x-tar-gz'}
+    cache_download = True
+    resumable = True
+    segments = settings.DOWNLOAD_SEGMENTS
+    headers = {'accept': get_accept_header()}
+
+
+class DownloadDBStreamRequest(StreamResponse, APIRequest):
+    url = '/api/v1/workspace/{website_slug}/download/db/'
+    headers = {'accept': get_accept_header()}
 
 
 # Download Media
@@ -246,18 +610,32 @@ class DownloadMediaRequestRequest(JsonResponse, APIRequest):
     method = 'POST'
 
 
-class DownloadMediaProgressRequest(JsonResponse, APIRequest):
+class DownloadMediaProgressRequest(ProgressResponse, APIRequest):
     method = 'GET'
 
 
 class DownloadMediaRequest(FileResponse, APIRequest):
     url = '/api/v1/workspace/{website_slug}/download/media/'
-    headers = {'accept': 'application/x-tar-gz'}
+    cache_download = True
+    resumable = True
+    segments = settings.DOWNLOAD_SEGMENTS
+    headers = {'accept': get_accept_header()}
+
+
+class DownloadMediaStreamRequest(StreamResponse, APIRequest):
+    url = '/api/v1/workspace/{website_slug}/download/media/'
+    headers = {'accept': get_accept_header()}
+
+    def verify(self, response):
+        if response.status_code == requests.codes.not_found:
+            # no backup yet, ignore
+            return None
+        return super(DownloadMediaStreamRequest, self).verify(response)
 
 
 # Upload DB
 
-class UploadDBRequest(JsonResponse, APIRequest):
+class UploadDBRequest(StreamingUploadMixin, JsonResponse, APIRequest):
     url = '/api/v1/website/{website_id}/upload/db/'
     method = 'POST'
 
@@ -280,16 +658,74 @@ class UploadDBRequest(JsonResponse, APIRequest):
         return super(UploadDBRequest, self).verify(response)
 
 
-class UploadDBProgressRequest(JsonResponse, APIRequest):
+class UploadDBStreamRequest(UploadDBRequest):
+    """
+    Upload a bare compressed SQL dump. Servers which only accept archives
+    refuse it as a bad request, which returns ``None``.
+    """
+    def verify(self, response):
+        if response.status_code == requests.codes.bad_request:
+            return None
+        return super(UploadDBStreamRequest, self).verify(response)
+
+
+class UploadDBProgressRequest(ProgressResponse, APIRequest):
     method = 'GET'
 
 
+class UploadDBCommitRequest(UploadDBRequest):
+    url = '/api/v1/website/{website_id}/upload/db/commit/'
+
+
 # Upload Media
 
-class UploadMediaFilesRequest(JsonResponse, APIRequest):
+class UploadMediaFilesRequest(StreamingUploadMixin, JsonResponse,
+                              APIRequest):
     url = '/api/v1/website/{website_id}/upload/media/'
     method = 'POST'
 
 
-class UploadMediaFilesProgressRequest(JsonResponse, APIRequest):
+class UploadMediaFilesProgressRequest(ProgressResponse, APIRequest):
     method = 'GET'
+
+
+class UploadMediaFilesCommitRequest(UploadMediaFilesRequest):
+    url = '/api/v1/website/{website_id}/upload/media/commit/'
+
+
+class DownloadMediaFileRequest(FileResponse, APIRequest):
+    url = '/api/v1/website/{website_id}/media/files/{path}'
+
+
+class MediaManifestRequest(APIRequest):
+    """
+    List the media files on the server with their size and sha256 digest.
+    """
+    url = '/api/v1/website/{website_id}/media/manifest/'
+    method = 'GET'
+
+    def verify(self, response):
+        if response.status_code == requests.codes.not_found:
+            # not supported by the server
+            return None
+        return super(MediaManifestRequest, self).verify(response)
+
+    def process(self, response):
+        return response.json().get('files')
+
+
+# Chunked uploads
+
+class UploadChunkRequest(TextResponse, APIRequest):
+    """
+    Upload a single, content addressed chunk of an archive. Uploading the
+    same chunk twice is a no-op on the server.
+    """
+    url = '/api/v1/website/{website_id}/upload/{kind}/chunks/{digest}/'
+    method = 'PUT'
+
+    def get_headers(self):
+        return dict(self.headers, **{
+            'Content-Type': 'application/octet-stream',
+            'X-Checksum-SHA256': self.url_kwargs['digest'],
+        })
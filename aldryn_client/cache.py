@@ -0,0 +1,274 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+def replace_file(source, destination):
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # windows does not overwrite existing files
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+def link_or_copy(source, destination):
+    """
+    Hard link ``source`` to ``destination``, copy it if the two are on
+    different filesystems or links are not supported.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, destination)
+
+
+def prune_directory(directory, max_size, suffix=''):
+    """
+    Delete the least recently used files ending with ``suffix`` until the
+    files in ``directory`` use at most ``max_size`` bytes. Files are
+    considered used whenever their modification time is updated.
+
+    Returns the number of bytes freed.
+    """
+    entries = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(suffix):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for mtime, size, path in sorted(entries):
+        if total - freed <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        freed += size
+    return freed
+
+
+class CacheEntry(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    @property
+    def age(self):
+        return time.time() - self.meta['stored_at']
+
+    def get_conditional_headers(self):
+        cached_headers = self.meta['headers']
+        headers = {}
+        if cached_headers.get('ETag'):
+            headers['If-None-Match'] = cached_headers['ETag']
+        if cached_headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = cached_headers['Last-Modified']
+        return headers
+
+    def to_response(self):
+        response = requests.Response()
+        response.status_code = requests.codes.ok
+        response.url = self.meta['url']
+        response.headers = CaseInsensitiveDict(self.meta['headers'])
+        with open(self.path, 'rb') as fh:
+            response._content = fh.read()
+        response.from_cache = True
+        return response
+
+
+class ResponseCache(object):
+    """
+    On-disk cache for responses of read-only API endpoints.
+
+    Every response is stored as two files named after a hash of the URL and
+    the credentials it was requested with: the body and a JSON document
+    with the validators needed for conditional requests. Entries younger
+    than the TTL of the request class are used without asking the server,
+    older ones are revalidated with ``If-None-Match``/``If-Modified-Since``.
+    The least recently used entries are evicted once the cache grows larger
+    than ``max_size`` bytes.
+    """
+    cached_headers = ('Content-Type', 'ETag', 'Last-Modified')
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_key(self, session, url):
+        identity = '{} {}'.format(
+            session.headers.get('Authorization', ''), url,
+        )
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def get_paths(self, key):
+        path = os.path.join(self.directory, key)
+        return path + '.body', path + '.json'
+
+    def get(self, key):
+        body_path, meta_path = self.get_paths(key)
+        try:
+            with open(meta_path, 'r') as fh:
+                meta = json.load(fh)
+            # mark as recently used
+            os.utime(body_path, None)
+        except (IOError, OSError, ValueError):
+            if os.path.exists(meta_path):
+                # the body has been evicted
+                os.remove(meta_path)
+            return None
+        return CacheEntry(body_path, meta)
+
+    def set(self, key, response):
+        body_path, meta_path = self.get_paths(key)
+        meta = {
+            'url': response.url,
+            'stored_at': time.time(),
+            'headers': dict(
+                (name, response.headers[name])
+                for name in self.cached_headers
+                if name in response.headers
+            ),
+        }
+        try:
+            with open(body_path + '.tmp', 'wb') as fh:
+                fh.write(response.content)
+            replace_file(body_path + '.tmp', body_path)
+            self.write_meta(meta_path, meta)
+        except (IOError, OSError):
+            # caching is best effort only
+            return
+        prune_directory(self.directory, self.max_size, suffix='.body')
+
+    def refresh(self, key, entry):
+        entry.meta['stored_at'] = time.time()
+        try:
+            self.write_meta(self.get_paths(key)[1], entry.meta)
+        except (IOError, OSError):
+            pass
+
+    def write_meta(self, path, meta):
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(meta, fh)
+        replace_file(path + '.tmp', path)
+
+    def fetch(self, request, *args, **kwargs):
+        """
+        Return the response for ``request``, from the cache if possible.
+        """
+        key = self.get_key(request.session, request.get_url())
+        entry = self.get(key)
+        if entry and entry.age < request.cache_ttl:
+            return entry.to_response()
+
+        headers = dict(request.get_headers())
+        if entry:
+            headers.update(entry.get_conditional_headers())
+        response = request.send(headers=headers, *args, **kwargs)
+        if entry and response.status_code == requests.codes.not_modified:
+            self.refresh(key, entry)
+            return entry.to_response()
+        if response.status_code == requests.codes.ok:
+            self.set(key, response)
+        return response
+
+
+class DownloadCache(object):
+    """
+    Content addressed cache of downloaded database dumps and media archives.
+
+    Files are stored under a hash of the checksum the server sent along
+    with them, a ``Digest`` header or a strong ``ETag``, so a backup is
+    found again whatever (signed) URL it is downloaded from. Files are
+    hard linked into and out of the cache where possible. The least
+    recently used files are evicted once the cache grows larger than
+    ``max_size`` bytes.
+    """
+    checksum_headers = ('Digest', 'X-Checksum-Sha256', 'Content-MD5', 'ETag')
+    suffix = '.blob'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_key(self, response):
+        """
+        Return the cache key of the file ``response`` delivers, ``None`` if
+        the server did not send a checksum.
+        """
+        for name in self.checksum_headers:
+            value = response.headers.get(name)
+            if not value or value.startswith('W/'):
+                # weak ETags do not identify the content
+                continue
+            identity = '{}: {}'.format(name.lower(), value)
+            return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+        return None
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key, destination):
+        """
+        Put the cached file ``key`` at ``destination``. Returns ``False`` if
+        it is not cached.
+        """
+        path = self.get_path(key)
+        try:
+            # mark as recently used
+            os.utime(path, None)
+            link_or_copy(path, destination)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def add(self, key, source):
+        path = self.get_path(key)
+        try:
+            link_or_copy(source, path + '.tmp')
+            replace_file(path + '.tmp', path)
+            os.utime(path, None)
+        except (IOError, OSError):
+            # caching is best effort only
+            return
+        self.prune()
+
+    def prune(self, max_size=None):
+        """
+        Evict the least recently used files until the cache is at most
+        ``max_size`` bytes large. Returns the number of bytes freed.
+        """
+        return prune_directory(
+            self.directory,
+            self.max_size if max_size is None else max_size,
+            suffix=self.suffix,
+        )
+
+    def get_stats(self):
+        """
+        Return the number of cached files and their total size.
+        """
+        sizes = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.suffix):
+                try:
+                    sizes.append(
+                        os.path.getsize(os.path.join(self.directory, filename))
+                    )
+                except OSError:
+                    continue
+        return len(sizes), sum(sizes)
@@ -5,13 +5,16 @@ import subprocess
 import click
 
 from . import utils
+from .localdev.docker_api import get_client
 
 
 def check_requirements(silent=False):
     checks = [
         ('git client', ['git', '--version']),
         ('docker client', ['docker', '--version']),
-        ('docker server connection', ['docker', 'ps']),
+        # no need to start a docker process if the Engine API answers
+        ('docker server connection',
+         None if get_client() else ['docker', 'ps']),
         ('docker-compose', ['docker-compose', '--version']),
     ]
 
@@ -20,7 +23,8 @@ def check_requirements(silent=False):
     for check, cmd in checks:
         error_msg = None
         try:
-            utils.check_call(cmd, catch=False, silent=True)
+            if cmd:
+                utils.check_call(cmd, catch=False, silent=True)
         except OSError as exc:
             if exc.errno == os.errno.ENOENT:
                 error_msg = 'executable {} not found'.format(cmd[0])
@@ -14,10 +14,11 @@ import click
 from . import localdev
 from .localdev.utils import get_aldryn_project_settings
 from .cloud import CloudClient, get_endpoint
+from .compression import CODECS, DEFAULT_CODEC
 from .check_system import check_requirements
 from .utils import (
     hr, table, open_project_cloud_site, get_dashboard_url,
-    get_project_cheatsheet_url, get_latest_version_from_pypi,
+    get_project_cheatsheet_url, get_latest_version_from_pypi, pretty_size,
 )
 from .validators.addon import validate_addon
 from .validators.boilerplate import validate_boilerplate
@@ -29,8 +30,13 @@ from .upload.boilerplate import upload_boilerplate
 @click.option('-d', '--debug/--no-debug', default=False,
               help=('Drop into the debugger if the command execution raises '
                     'an exception.'))
+@click.option('--cache/--no-cache', default=True,
+              help='Use cached responses of the Aldryn API if possible.')
+@click.option('--http-stats', type=click.Choice(['table', 'json']),
+              help=('Report timings and transfer sizes of all requests to '
+                    'Aldryn when the command ends.'))
 @click.pass_context
-def cli(ctx, debug):
+def cli(ctx, debug, cache, http_stats):
     if debug:
         def exception_handler(type, value, traceback):
             click.secho(
@@ -44,7 +50,20 @@ def cli(ctx, debug):
             pdb.post_mortem(traceback)
         sys.excepthook = exception_handler
 
-    ctx.obj = CloudClient(get_endpoint())
+    ctx.obj = CloudClient(get_endpoint(), use_cache=cache)
+
+    if debug:
+        ctx.call_on_close(
+            lambda: click.secho(ctx.obj.get_connection_stats(), err=True)
+        )
+
+    if http_stats:
+        request_log = ctx.obj.enable_request_log()
+        if http_stats == 'json':
+            report = request_log.to_json_lines
+        else:
+            report = request_log.to_table
+        ctx.call_on_close(lambda: click.echo(report(), err=True))
 
     # skip if 'aldryn version' is run
     if not ctx.args == ['version']:
@@ -250,15 +269,46 @@ def project_pull():
 
 
 @project_pull.command(name='db')
+@click.option(
+    '--stream', is_flag=True, default=False,
+    help=('Import the database while it is being downloaded (custom '
+          'format dumps only)'),
+)
+@click.option(
+    '-j', '--jobs', type=int,
+    help=('Number of parallel pg_restore jobs (defaults to the number of '
+          'CPUs of the database container)'),
+)
 @click.pass_obj
-def pull_db(obj):
-    localdev.pull_db(obj)
+def pull_db(obj, stream, jobs):
+    localdev.pull_db(obj, stream=stream, jobs=jobs)
 
 
 @project_pull.command(name='media')
+@click.option(
+    '--incremental', is_flag=True, default=False,
+    help='Only download new and changed files, delete removed files',
+)
+@click.option(
+    '--stream', is_flag=True, default=False,
+    help='Extract the media files while they are being downloaded',
+)
 @click.pass_obj
-def pull_media(obj):
-    localdev.pull_media(obj)
+def pull_media(obj, incremental, stream):
+    localdev.pull_media(obj, incremental=incremental, stream=stream)
+
+
+@project.group(name='media')
+def project_media():
+    """Inspect the local media files"""
+    pass
+
+
+@project_media.command(name='status')
+@click.pass_obj
+def media_status(obj):
+    """Show media files changed since the last push or pull"""
+    localdev.show_media_status()
 
 
 @project.group(name='push')
@@ -268,8 +318,41 @@ def project_push():
 
 
 @project_push.command(name='db')
+@click.option(
+    '--chunked', is_flag=True, default=False,
+    help='Upload in resumable chunks',
+)
+@click.option(
+    '--dump-format', default='plain',
+    type=click.Choice(['custom', 'directory', 'plain']),
+    help='pg_dump output format',
+)
+@click.option(
+    '-j', '--jobs', type=int,
+    help=('Number of parallel pg_dump jobs for the directory format '
+          '(defaults to the number of CPUs of the database container)'),
+)
+@click.option(
+    '--pipeline', is_flag=True, default=False,
+    help=('Compress and upload a plain SQL dump while pg_dump writes it, '
+          'without writing any files'),
+)
+@click.option(
+    '--codec', default=DEFAULT_CODEC,
+    type=click.Choice([codec.name for codec in CODECS]),
+    help='Compression of the uploaded archive',
+)
 @click.pass_obj
-def push_db(obj):
+def push_db(obj, chunked, dump_format, jobs, pipeline, codec):
+    if pipeline and chunked:
+        raise click.UsageError(
+            '--pipeline and --chunked cannot be used together'
+        )
+    if pipeline and (dump_format != 'plain' or jobs):
+        raise click.UsageError(
+            '--pipeline always uploads a plain SQL dump, it cannot be used '
+            'with --dump-format or --jobs'
+        )
     warning = (
         'WARNING',
         '=======',
@@ -293,12 +376,28 @@ def push_db(obj):
     click.secho(os.linesep.join(warning), fg='red')
     if not click.confirm('\nAre you sure you want to continue?'):
         return
-    localdev.push_db(obj)
+    localdev.push_db(
+        obj, chunked=chunked, dump_format=dump_format, jobs=jobs,
+        pipeline=pipeline, codec=codec,
+    )
 
 
 @project_push.command(name='media')
+@click.option(
+    '--chunked', is_flag=True, default=False,
+    help='Upload in resumable chunks',
+)
+@click.option(
+    '--incremental', is_flag=True, default=False,
+    help='Only upload new and changed files, delete removed files',
+)
+@click.option(
+    '--codec', default=DEFAULT_CODEC,
+    type=click.Choice([codec.name for codec in CODECS]),
+    help='Compression of the uploaded archive',
+)
 @click.pass_obj
-def push_media(obj):
+def push_media(obj, chunked, incremental, codec):
     warning = (
         'WARNING',
         '=======',
@@ -320,7 +419,9 @@ def push_media(obj):
     click.secho(os.linesep.join(warning), fg='red')
     if not click.confirm('\nAre you sure you want to continue?'):
         return
-    localdev.push_media(obj)
+    localdev.push_media(
+        obj, chunked=chunked, incremental=incremental, codec=codec,
+    )
 
 
 @project.command(name='develop')
@@ -396,6 +497,44 @@ def boilerplate_upload(ctx):
     click.echo(ret)
 
 
+def get_download_cache(client):
+    download_cache = client.init_download_cache()
+    if download_cache is None:
+        raise click.ClickException('The cache directory is not accessible')
+    return download_cache
+
+
+@cli.group(name='cache')
+def cache():
+    """Manage the cache of downloaded backups"""
+    pass
+
+
+@cache.command(name='stats')
+@click.pass_obj
+def cache_stats(obj):
+    """Show the size of the download cache"""
+    download_cache = get_download_cache(obj)
+    files, size = download_cache.get_stats()
+    click.echo('directory: {}'.format(download_cache.directory))
+    click.echo('files:     {}'.format(files))
+    click.echo('size:      {} of {}'.format(
+        pretty_size(size), pretty_size(download_cache.max_size),
+    ))
+
+
+@cache.command(name='prune')
+@click.option(
+    '--all', 'prune_all', is_flag=True, default=False,
+    help='Remove all cached downloads',
+)
+@click.pass_obj
+def cache_prune(obj, prune_all):
+    """Evict the least recently used downloads"""
+    freed = get_download_cache(obj).prune(max_size=0 if prune_all else None)
+    click.echo('Freed {}'.format(pretty_size(freed)))
+
+
 @cli.command()
 @click.option(
     '-s', '--skip-check',  is_flag=True, default=False,
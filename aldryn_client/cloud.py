@@ -1,15 +1,21 @@
 import os
 import re
+from multiprocessing.pool import ThreadPool
 from netrc import netrc
 from time import sleep
 
 import click
-from six.moves.urllib_parse import urlparse
+from six.moves.urllib_parse import quote, urlparse
 
 from . import settings
 from . import messages
 from . import api_requests
+from . import transfer
+from .cache import DownloadCache, ResponseCache
 from .config import Config
+from .polling import ProgressResult, poll
+from .request_log import RequestLog
+from .utils import get_user_cache_dir
 
 
 ENDPOINT = 'https://control.{host}'
@@ -34,11 +40,14 @@ def get_endpoint(host=None):
 
 
 class CloudClient(object):
-    def __init__(self, endpoint):
+    def __init__(self, endpoint, use_cache=True):
         self.config = Config()
         self.endpoint = endpoint
         self.netrc = WritableNetRC()
         self.session = self.init_session()
+        if use_cache:
+            self.session.cache = self.init_cache()
+            self.session.download_cache = self.init_download_cache()
 
     # Helpers
     def get_auth_header(self):
@@ -48,6 +57,17 @@ class CloudClient(object):
             return {'Authorization': 'Basic {}'.format(data[2])}
         return {}
 
+    def get_download_options(self):
+        return {
+            'segments': self.config.config.get(
+                'download_segments', settings.DOWNLOAD_SEGMENTS
+            ),
+            'min_segment_size': self.config.config.get(
+                'download_min_segment_size',
+                settings.DOWNLOAD_MIN_SEGMENT_SIZE,
+            ),
+        }
+
     def get_access_token_url(self):
         return '{}/{}'.format(
             self.endpoint.rstrip('/'),
@@ -58,9 +78,43 @@ class CloudClient(object):
         return api_requests.SingleHostSession(
             self.endpoint,
             headers=self.get_auth_header(),
-            trust_env=False
+            trust_env=False,
+            # enough connections for the parallel downloads
+            pool_maxsize=max(
+                settings.HTTP_POOL_SIZE,
+                self.get_download_options()['segments'],
+            ),
+        )
+
+    def init_cache(self):
+        try:
+            directory = get_user_cache_dir('responses')
+        except (IOError, OSError):
+            return None
+        return ResponseCache(directory, settings.RESPONSE_CACHE_MAX_SIZE)
+
+    def init_download_cache(self):
+        try:
+            directory = get_user_cache_dir('downloads')
+        except (IOError, OSError):
+            return None
+        return DownloadCache(
+            directory,
+            self.config.config.get(
+                'download_cache_max_size', settings.DOWNLOAD_CACHE_MAX_SIZE,
+            ),
         )
 
+    def enable_request_log(self):
+        self.session.request_log = RequestLog()
+        return self.session.request_log
+
+    def concurrent(self, concurrency=None):
+        return AsyncCloudClient(self, concurrency=concurrency)
+
+    def get_connection_stats(self):
+        return messages.CONNECTION_STATS.format(**self.session.get_stats())
+
     def authenticate(self, token):
         self.session.headers['Authorization'] = 'Basic {}'.format(token)
 
@@ -118,8 +172,7 @@ class CloudClient(object):
             with click.progressbar(
                     length=100, show_percent=True,
                     show_eta=False, item_show_func=fmt_progress) as bar:
-                while response['is_deploying']:
-                    response = self.deploy_project_progress(website_id, stage)
+                def update_progress(response):
                     bar.current_item = progress = response['deploy_progress']
                     bar.update(
                         # update the difference of the current percentage
@@ -128,7 +181,18 @@ class CloudClient(object):
                         progress['extra_percent'] -
                         bar.pos
                     )
-                    sleep(3)
+
+                def get_progress():
+                    return self.deploy_project_progress(website_id, stage)
+
+                if response['is_deploying']:
+                    poll(
+                        get_progress,
+                        is_done=lambda response: not response['is_deploying'],
+                        callback=update_progress,
+                        # keep the progress bar moving
+                        max_interval=5,
+                    )
         except KeyboardInterrupt:
             click.secho('Disconnected')
 
@@ -138,7 +202,7 @@ class CloudClient(object):
             url_kwargs={'website_id': website_id},
         )
         data = request()
-        return data[stage]
+        return ProgressResult(data[stage], retry_after=data.retry_after)
 
     def deploy_project(self, website_id, stage):
         request = api_requests.DeployProjectRequest(
@@ -155,6 +219,10 @@ class CloudClient(object):
         )
         return request()
 
+    def get_projects_details(self, website_ids):
+        with self.concurrent() as client:
+            return client.map(client.get_project, website_ids)
+
     def is_project_locked(self, website_id):
         request = api_requests.ProjectLockQueryRequest(
             self.session,
@@ -187,17 +255,19 @@ class CloudClient(object):
         )
         return request()
 
-    def upload_addon(self, archive_obj):
+    def upload_addon(self, archive_obj, progress_callback=None):
         request = api_requests.UploadAddonRequest(
             self.session,
-            files={'app': archive_obj}
+            files={'app': archive_obj},
+            progress_callback=progress_callback,
         )
         return request()
 
-    def upload_boilerplate(self, archive_obj):
+    def upload_boilerplate(self, archive_obj, progress_callback=None):
         request = api_requests.UploadBoilerplateRequest(
             self.session,
-            files={'boilerplate': archive_obj}
+            files={'boilerplate': archive_obj},
+            progress_callback=progress_callback,
         )
         return request()
 
@@ -245,6 +315,15 @@ class CloudClient(object):
             url_kwargs={'website_slug': website_slug},
             filename=filename,
             directory=directory,
+            **self.get_download_options()
+        )
+        return request()
+
+    def download_db_stream(self, website_slug, url=None):
+        request = api_requests.DownloadDBStreamRequest(
+            self.session,
+            url=url,
+            url_kwargs={'website_slug': website_slug},
         )
         return request()
 
@@ -262,6 +341,14 @@ class CloudClient(object):
         )
         return request()
 
+    def download_media_stream(self, website_slug, url=None):
+        request = api_requests.DownloadMediaStreamRequest(
+            self.session,
+            url=url,
+            url_kwargs={'website_slug': website_slug},
+        )
+        return request()
+
     def download_media(self, website_slug, url=None,
                        filename=None, directory=None):
         request = api_requests.DownloadMediaRequest(
@@ -270,17 +357,57 @@ class CloudClient(object):
             url_kwargs={'website_slug': website_slug},
             filename=filename,
             directory=directory,
+            **self.get_download_options()
         )
         return request()
 
-    def upload_db(self, website_id, archive_path):
+    def upload_db(self, website_id, archive_path, progress_callback=None):
+        with open(archive_path, 'rb') as fobj:
+            request = api_requests.UploadDBRequest(
+                self.session,
+                url_kwargs={'website_id': website_id},
+                files={'db_dump': fobj},
+                progress_callback=progress_callback,
+            )
+            return request()
+
+    def upload_db_stream(self, website_id, blocks, progress_callback=None,
+                         filename='local_db.tar.gz'):
+        """
+        Upload a database archive while it is being produced. ``blocks`` is
+        an iterable of byte strings which is sent with chunked transfer
+        encoding as it is consumed.
+        """
         request = api_requests.UploadDBRequest(
             self.session,
             url_kwargs={'website_id': website_id},
-            files={'db_dump': open(archive_path, 'rb')}
+            files={'db_dump': (filename, blocks)},
+            progress_callback=progress_callback,
         )
         return request()
 
+    def upload_db_dump_stream(self, website_id, blocks,
+                              progress_callback=None,
+                              filename='local_db.sql.gz'):
+        """
+        Like ``upload_db_stream`` for a bare compressed SQL dump. Returns
+        ``None`` if the server only accepts archives.
+        """
+        request = api_requests.UploadDBStreamRequest(
+            self.session,
+            url_kwargs={'website_id': website_id},
+            files={'db_dump': (filename, blocks)},
+            progress_callback=progress_callback,
+        )
+        return request()
+
+    def upload_db_chunked(self, website_id, archive_path,
+                          progress_callback=None):
+        return self.upload_chunks(
+            'db', api_requests.UploadDBCommitRequest,
+            website_id, archive_path, progress_callback,
+        )
+
     def upload_db_progress(self, url):
         request = api_requests.UploadDBProgressRequest(
             self.session,
@@ -288,14 +415,40 @@ class CloudClient(object):
         )
         return request()
 
-    def upload_media(self, website_id, archive_path):
-        request = api_requests.UploadMediaFilesRequest(
+    def upload_media(self, website_id, archive_path, progress_callback=None):
+        with open(archive_path, 'rb') as fobj:
+            request = api_requests.UploadMediaFilesRequest(
+                self.session,
+                url_kwargs={'website_id': website_id},
+                files={'media_files': fobj},
+                progress_callback=progress_callback,
+            )
+            return request()
+
+    def get_media_manifest(self, website_id):
+        request = api_requests.MediaManifestRequest(
             self.session,
             url_kwargs={'website_id': website_id},
-            files={'media_files': open(archive_path, 'rb')}
         )
         return request()
 
+    def download_media_file(self, website_id, path, filename=None,
+                            directory=None):
+        request = api_requests.DownloadMediaFileRequest(
+            self.session,
+            url_kwargs={'website_id': website_id, 'path': quote(path)},
+            filename=filename,
+            directory=directory,
+        )
+        return request()
+
+    def upload_media_chunked(self, website_id, archive_path,
+                             progress_callback=None):
+        return self.upload_chunks(
+            'media', api_requests.UploadMediaFilesCommitRequest,
+            website_id, archive_path, progress_callback,
+        )
+
     def upload_media_progress(self, url):
         request = api_requests.UploadMediaFilesProgressRequest(
             self.session,
@@ -303,6 +456,121 @@ class CloudClient(object):
         )
         return request()
 
+    def upload_chunks(self, kind, commit_request_class, website_id,
+                      archive_path, progress_callback=None):
+        """
+        Upload an archive as content addressed chunks and commit it once all
+        chunks arrived. Chunks uploaded by a previous, interrupted call are
+        recorded in a journal next to the archive and skipped.
+        """
+        journal = transfer.ChunkJournal(
+            archive_path, settings.UPLOAD_CHUNK_SIZE,
+        ).load()
+        digests = []
+        for index, digest, data in journal.iter_chunks():
+            digests.append(digest)
+            if digest not in journal.completed:
+                request = api_requests.UploadChunkRequest(
+                    self.session,
+                    url_kwargs={
+                        'website_id': website_id,
+                        'kind': kind,
+                        'digest': digest,
+                    },
+                    data=data,
+                )
+                request()
+                journal.add(digest)
+            if progress_callback:
+                progress_callback(len(data))
+
+        request = commit_request_class(
+            self.session,
+            url_kwargs={'website_id': website_id},
+            data={
+                'filename': os.path.basename(archive_path),
+                'size': os.path.getsize(archive_path),
+                'chunks': digests,
+            },
+        )
+        response = request()
+        journal.clear()
+        return response
+
+
+class AsyncCloudClient(object):
+    """
+    Runs API requests of a ``CloudClient`` concurrently.
+
+    Every method submits the same ``APIRequest`` the synchronous client
+    uses to a bounded thread pool and immediately returns an
+    ``AsyncResult``; calling ``.get()`` on it waits for the response and
+    re-raises any error. ``gather`` and ``map`` wait for many requests at
+    once. The pool defaults to the size of the session's connection pool
+    so every worker keeps its own connection alive.
+    """
+    def __init__(self, client, concurrency=None):
+        self.client = client
+        self.session = client.session
+        self.concurrency = concurrency or self.session.pool_maxsize
+        self.pool = ThreadPool(self.concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def submit(self, request_class, **kwargs):
+        request = request_class(self.session, **kwargs)
+        return self.pool.apply_async(request)
+
+    def gather(self, results):
+        return [result.get() for result in results]
+
+    def map(self, method, items):
+        return self.gather([method(item) for item in items])
+
+    def get_projects(self):
+        return self.submit(api_requests.ProjectListRequest)
+
+    def get_project(self, website_id):
+        return self.submit(
+            api_requests.ProjectDetailRequest,
+            url_kwargs={'website_id': website_id},
+        )
+
+    def is_project_locked(self, website_id):
+        return self.submit(
+            api_requests.ProjectLockQueryRequest,
+            url_kwargs={'website_id': website_id},
+        )
+
+    def download_media_file(self, website_id, path, filename=None,
+                            directory=None):
+        return self.submit(
+            api_requests.DownloadMediaFileRequest,
+            url_kwargs={'website_id': website_id, 'path': quote(path)},
+            filename=filename,
+            directory=directory,
+        )
+
+    def get_website_id_for_slug(self, slug):
+        return self.submit(
+            api_requests.SlugToIDRequest,
+            url_kwargs={'website_slug': slug},
+        )
+
+    def get_website_slug_for_id(self, website_id):
+        return self.submit(
+            api_requests.IDToSlugRequest,
+            url_kwargs={'website_id': website_id},
+        )
+
 
 class WritableNetRC(netrc):
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,506 @@
+import os
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from . import settings
+from .scanner import TarInfoFactory
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+# deflate, no flags
+GZIP_HEADER = GZIP_MAGIC + b'\x08\x00'
+# extra flags and "unknown" operating system
+GZIP_HEADER_END = b'\x00\xff'
+
+
+def compress_block(data, level, last=False):
+    """
+    Compress ``data`` into a raw deflate stream which can be concatenated
+    with the streams of the following blocks.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        # a sync flush ends on a byte boundary without ending the stream
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def get_compression_threads():
+    return settings.COMPRESSION_THREADS or cpu_count()
+
+
+class ParallelGzipWriter(object):
+    """
+    A write-only file object which gzips everything written to it into
+    ``fileobj``, compressing blocks of ``block_size`` bytes on ``threads``
+    threads at the same time (zlib releases the GIL while compressing).
+
+    Like pigz, the blocks are compressed independently and joined into a
+    single deflate stream, so the output is a regular gzip file which
+    any gzip reader accepts. At most two blocks per thread are held in
+    memory.
+    """
+    def __init__(self, fileobj, compresslevel=6, block_size=1024 * 1024,
+                 threads=None):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.threads = threads or get_compression_threads()
+        self.pool = ThreadPool(self.threads)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32(b'')
+        self.size = 0
+        self.closed = False
+        self.fileobj.write(
+            GZIP_HEADER +
+            struct.pack('<I', int(time.time())) +
+            GZIP_HEADER_END
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = b''.join(self.buffer)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self.submit(data[offset:offset + self.block_size])
+                offset += self.block_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def submit(self, block, last=False):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.apply_async(
+            compress_block, (block, self.compresslevel, last),
+        ))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        # blocks are compressed as soon as they are complete
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.submit(b''.join(self.buffer), last=True)
+        self.buffer = []
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        self.fileobj.write(struct.pack(
+            '<II', self.crc & 0xffffffff, self.size & 0xffffffff,
+        ))
+        self.abort()
+
+    def abort(self):
+        self.closed = True
+        self.pending.clear()
+        self.pool.terminate()
+        self.pool.join()
+
+
+class BlockSink(object):
+    """
+    A file object collecting everything written to it, used to turn the
+    output of a compressor into an iterator of blocks.
+    """
+    def __init__(self):
+        self.blocks = []
+
+    def write(self, data):
+        if data:
+            self.blocks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        blocks, self.blocks = self.blocks, []
+        return blocks
+
+
+class PrefixedReader(object):
+    """
+    Put bytes which have already been read back in front of ``fileobj``.
+    """
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.fileobj.read(size - len(data))
+        return data
+
+
+class Codec(object):
+    """
+    A compression format for transfer archives.
+
+    ``media_type`` is used to negotiate the format of downloads,
+    ``magic`` to detect the format of received archives. ``tar_flag`` is
+    the option of the tar command line tool handling the format, if any.
+    """
+    name = None
+    media_type = None
+    extension = None
+    magic = None
+    tar_flag = None
+    default_level = None
+
+    def is_available(self):
+        return True
+
+    def open_writer(self, fileobj, level=None):
+        raise NotImplementedError
+
+    def open_reader(self, fileobj):
+        raise NotImplementedError
+
+    def iter_compress(self, blocks, level=None):
+        """
+        Compress an iterable of byte strings.
+        """
+        sink = BlockSink()
+        writer = self.open_writer(sink, level)
+        try:
+            for block in blocks:
+                writer.write(block)
+                for data in sink.drain():
+                    yield data
+        except BaseException:
+            if hasattr(writer, 'abort'):
+                writer.abort()
+            raise
+        writer.close()
+        for data in sink.drain():
+            yield data
+
+    def open_tar_reader(self, fileobj):
+        """
+        Open a tar archive compressed with this codec for reading it
+        sequentially from a non-seekable ``fileobj``.
+        """
+        return tarfile.open(fileobj=self.open_reader(fileobj), mode='r|')
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    media_type = 'application/x-tar-gz'
+    extension = '.tar.gz'
+    magic = GZIP_MAGIC
+    tar_flag = 'z'
+    default_level = 6
+
+    def open_writer(self, fileobj, level=None):
+        return ParallelGzipWriter(
+            fileobj, compresslevel=self.default_level if level is None
+            else level,
+        )
+
+    def open_tar_reader(self, fileobj):
+        # tarfile decompresses gzip streams itself
+        return tarfile.open(fileobj=fileobj, mode='r|gz')
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    media_type = 'application/x-zstd-compressed-tar'
+    extension = '.tar.zst'
+    magic = b'\x28\xb5\x2f\xfd'
+    default_level = 3
+
+    def is_available(self):
+        return zstandard is not None
+
+    def open_writer(self, fileobj, level=None):
+        compressor = zstandard.ZstdCompressor(
+            level=self.default_level if level is None else level,
+            threads=-1,
+        )
+        return compressor.stream_writer(fileobj)
+
+    def open_reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+class LZ4Codec(Codec):
+    name = 'lz4'
+    media_type = 'application/x-lz4-compressed-tar'
+    extension = '.tar.lz4'
+    magic = b'\x04\x22\x4d\x18'
+    default_level = 0
+
+    def is_available(self):
+        return lz4 is not None
+
+    def open_writer(self, fileobj, level=None):
+        return lz4.frame.LZ4FrameFile(
+            fileobj, mode='wb',
+            compression_level=self.default_level if level is None else level,
+        )
+
+    def open_reader(self, fileobj):
+        return lz4.frame.LZ4FrameFile(fileobj, mode='rb')
+
+
+# in order of preference
+CODECS = (ZstdCodec(), LZ4Codec(), GzipCodec())
+DEFAULT_CODEC = 'gzip'
+
+
+def get_available_codecs():
+    return [codec for codec in CODECS if codec.is_available()]
+
+
+def get_codec(name):
+    """
+    Return the codec called ``name``, or gzip if it is not installed.
+    """
+    for codec in get_available_codecs():
+        if codec.name == name:
+            return codec
+    return get_codec(DEFAULT_CODEC)
+
+
+def get_accept_header():
+    codecs = get_available_codecs()
+    return ', '.join(
+        codec.media_type if not index else '{};q={:.1f}'.format(
+            codec.media_type, 1 - index / 10.0,
+        )
+        for index, codec in enumerate(codecs)
+    )
+
+
+def detect_codec(data):
+    """
+    Return the codec of a stream starting with ``data``, ``None`` for
+    uncompressed or unknown data.
+    """
+    for codec in CODECS:
+        if data.startswith(codec.magic):
+            return codec
+    return None
+
+
+def open_tar_stream(fileobj):
+    """
+    Open a tar archive of any supported codec for sequential reading.
+    """
+    prefix = fileobj.read(4)
+    codec = detect_codec(prefix)
+    fileobj = PrefixedReader(prefix, fileobj)
+    if codec is None:
+        return tarfile.open(fileobj=fileobj, mode='r|')
+    if not codec.is_available():
+        raise tarfile.CompressionError(
+            '{} is not installed'.format(codec.name)
+        )
+    return codec.open_tar_reader(fileobj)
+
+
+def iter_members(tar):
+    """
+    Iterate over the members of ``tar`` one at a time.
+
+    ``TarFile`` keeps every member it has seen in ``tar.members``, which
+    grows to gigabytes for archives with millions of files. The list is
+    cleared after every member, so only one is kept in memory. Members
+    of a stream can only be extracted while they are current anyway.
+    """
+    while True:
+        member = tar.next()
+        if member is None:
+            return
+        yield member
+        tar.members = []
+
+
+class TarStats(object):
+    """
+    Number and total size of the files in an archive, counted while it is
+    written or read.
+    """
+    def __init__(self):
+        self.files = 0
+        self.size = 0
+
+    def add(self, member):
+        if member.isfile():
+            self.files += 1
+            self.size += member.size
+
+
+# refuses members which would end up outside of the target directory,
+# added to tarfile by python 3.12 and security releases of older versions
+EXTRACTION_FILTER = 'data' if hasattr(tarfile, 'data_filter') else None
+
+
+def is_below(path, directory):
+    path = os.path.realpath(path)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def check_member(member, path):
+    """
+    Raise a ``tarfile.TarError`` if extracting ``member`` below ``path``
+    would write outside of it, for tarfile versions without extraction
+    filters.
+    """
+    directory = os.path.realpath(path)
+    target = os.path.join(directory, member.name)
+    if os.path.isabs(member.name) or not is_below(target, directory):
+        raise tarfile.TarError(
+            "'{}' is outside of the archive".format(member.name)
+        )
+    if member.issym():
+        link_target = os.path.join(os.path.dirname(target), member.linkname)
+    elif member.islnk():
+        link_target = os.path.join(directory, member.linkname)
+    else:
+        return
+    if (os.path.isabs(member.linkname) or
+            not is_below(link_target, directory)):
+        raise tarfile.TarError("'{}' links to '{}' outside of the archive"
+                               .format(member.name, member.linkname))
+
+
+def extract_members(tar, path):
+    """
+    Extract all members of ``tar`` below ``path``, one member at a time.
+    Members which would be written outside of ``path`` raise a
+    ``tarfile.TarError``. Returns the ``TarStats`` of the extracted files.
+    """
+    stats = TarStats()
+    directories = []
+    for member in iter_members(tar):
+        stats.add(member)
+        if member.isdir():
+            directories.append((member.name, member.mtime))
+        if EXTRACTION_FILTER:
+            tar.extract(member, path, filter=EXTRACTION_FILTER)
+        else:
+            check_member(member, path)
+            tar.extract(member, path)
+    # like extractall, restore the modification time of directories after
+    # their contents have been extracted
+    for name, mtime in reversed(directories):
+        directory = os.path.join(path, name)
+        try:
+            os.utime(directory, (mtime, mtime))
+        except OSError:
+            pass
+    return stats
+
+
+def add_entries(tar, directory, entries):
+    """
+    Add the ``scan_tree`` listing of ``directory`` to ``tar`` one entry at
+    a time, using the stat results of the listing.
+    """
+    factory = TarInfoFactory()
+    for entry in entries:
+        path = entry.get_path(directory)
+        member = factory.create(entry, path)
+        if member is None:
+            # sockets and other unsupported file types
+            continue
+        if member.isfile():
+            with open(path, 'rb') as fh:
+                tar.addfile(member, fh)
+        else:
+            tar.addfile(member)
+        tar.members = []
+
+
+def iter_tar_file(path, arcname, block_size=1024 * 1024):
+    """
+    Yield a tar archive of the single file at ``path``, stored as
+    ``arcname``, in blocks of at most ``block_size`` bytes. Neither the
+    archive nor the file are held in memory.
+    """
+    stat = os.stat(path)
+    member = tarfile.TarInfo(arcname)
+    member.size = stat.st_size
+    member.mtime = stat.st_mtime
+    member.mode = 0o644
+    header = member.tobuf()
+    yield header
+    remaining = member.size
+    with open(path, 'rb') as fh:
+        while remaining:
+            block = fh.read(min(block_size, remaining))
+            if not block:
+                raise IOError('{} is shorter than expected'.format(path))
+            remaining -= len(block)
+            yield block
+    # pad the data to full blocks and end the archive with two empty
+    # blocks, padded to a full record like tarfile does
+    padding = -member.size % tarfile.BLOCKSIZE + 2 * tarfile.BLOCKSIZE
+    size = len(header) + member.size + padding
+    yield b'\0' * (padding + -size % tarfile.RECORDSIZE)
+
+
+def get_file_codec(path):
+    with open(path, 'rb') as fh:
+        return detect_codec(fh.read(4))
+
+
+@contextmanager
+def open_tar(path, codec=None, level=None):
+    """
+    Open a tar archive at ``path`` for writing, compressed with ``codec``
+    (gzip by default, compressed in parallel).
+    """
+    codec = codec or get_codec(DEFAULT_CODEC)
+    with open(path, 'wb') as fh:
+        writer = codec.open_writer(fh, level)
+        try:
+            tar = tarfile.open(fileobj=writer, mode='w|')
+            yield tar
+            tar.close()
+        except BaseException:
+            if hasattr(writer, 'abort'):
+                writer.abort()
+            raise
+        writer.close()
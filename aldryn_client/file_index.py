@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import time
+
+from .manifest import (
+    MANIFEST_FILENAME, Manifest, decode_path, get_local_path, hash_file,
+)
+from .scanner import scan_tree
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS synced (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class FileIndex(object):
+    """
+    A persistent index of the files in a directory, similar to git's
+    index, stored in an SQLite database.
+
+    ``files`` holds the size, modification time, inode and sha256 digest
+    of every local file. A file is only hashed again when its size, mtime
+    or inode changed. ``synced`` holds the files as they were on the
+    server after the last push or pull, to tell which files changed since.
+
+    Paths are stored as text, the byte string file names of python 2 are
+    decoded with the file system encoding.
+    """
+    def __init__(self, directory, path):
+        self.directory = directory
+        self.path = path
+        index_dir = os.path.dirname(path)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, callback=None):
+        """
+        Bring the index up to date with the directory and return the
+        ``Manifest`` of all files. ``callback`` is called with the path of
+        every file which had to be hashed.
+        """
+        known = dict(
+            (path, (size, mtime, inode, sha256))
+            for path, size, mtime, inode, sha256 in self.connection.execute(
+                'SELECT path, size, mtime, inode, sha256 FROM files'
+            )
+        )
+        manifest = Manifest()
+        changed = []
+        for entry in scan_tree(self.directory, exclude=(MANIFEST_FILENAME,)):
+            if not entry.is_file():
+                continue
+            relative_path = decode_path(entry.relative_path)
+            stat_data = (entry.size, entry.mtime, entry.inode)
+            row = known.pop(relative_path, None)
+            if row and row[:3] == stat_data:
+                sha256 = row[3]
+            else:
+                sha256 = hash_file(entry.get_path(self.directory))
+                changed.append((relative_path,) + stat_data + (sha256,))
+                if callback:
+                    callback(relative_path)
+            manifest[relative_path] = {
+                'size': entry.size,
+                'mtime': entry.mtime,
+                'sha256': sha256,
+            }
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                changed,
+            )
+            self.connection.executemany(
+                'DELETE FROM files WHERE path = ?',
+                [(path,) for path in known],
+            )
+        return manifest
+
+    def record(self, relative_path, sha256):
+        """
+        Add a file whose digest is known, e.g. because it was just
+        downloaded.
+        """
+        stat = os.lstat(get_local_path(self.directory, relative_path))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                (decode_path(relative_path), stat.st_size, stat.st_mtime,
+                 stat.st_ino, sha256),
+            )
+
+    def get_synced_manifest(self):
+        """
+        Return the manifest of the server after the last push or pull,
+        ``None`` if the directory has never been synced.
+        """
+        if not self.get_meta('synced_at'):
+            return None
+        return Manifest(
+            (path, {'size': size, 'sha256': sha256})
+            for path, size, sha256 in self.connection.execute(
+                'SELECT path, size, sha256 FROM synced'
+            )
+        )
+
+    def set_synced(self, manifest):
+        with self.connection:
+            self.connection.execute('DELETE FROM synced')
+            self.connection.executemany(
+                'INSERT INTO synced VALUES (?, ?, ?)',
+                [
+                    (path, entry['size'], entry['sha256'])
+                    for path, entry in manifest.items()
+                ],
+            )
+            self.set_meta('synced_at', str(time.time()))
+
+    def clear_synced(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM synced')
+            self.connection.execute(
+                "DELETE FROM meta WHERE key = 'synced_at'"
+            )
+
+    def get_meta(self, key):
+        row = self.connection.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value)
+        )
@@ -0,0 +1,455 @@
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+from time import sleep
+
+from six.moves import http_client
+from six.moves.urllib_parse import quote, urlencode
+
+from ..compression import PrefixedReader
+from ..utils import is_windows
+from .. import messages, settings
+
+
+# stream ids of the multiplexed output of exec sessions
+STDOUT = 1
+STDERR = 2
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__(
+            'Docker Engine API error {}: {}'.format(status, message)
+        )
+        self.status = status
+
+
+DOCKER_ERRORS = (DockerAPIError, http_client.HTTPException, socket.error)
+
+
+def get_socket_path():
+    """
+    Return the path of the Docker Engine socket, ``None`` if the daemon
+    cannot be reached through a unix socket (windows or a remote
+    ``DOCKER_HOST``).
+    """
+    docker_host = os.environ.get('DOCKER_HOST')
+    if docker_host:
+        if docker_host.startswith('unix://'):
+            return docker_host[len('unix://'):]
+        return None
+    if is_windows():
+        return None
+    return settings.DOCKER_SOCKET
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    """
+    A thin Docker Engine API client talking to the daemon through its unix
+    socket, which saves starting a ``docker`` or ``docker-compose`` process
+    for every container lookup or exec.
+
+    API requests share one keep-alive connection. Exec sessions take over
+    their connection for the input and output of the command and get a
+    connection of their own.
+    """
+    def __init__(self, socket_path, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout or settings.DOCKER_API_TIMEOUT
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def get_url(self, path, params=None):
+        url = '/v{}{}'.format(settings.DOCKER_API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+        return url
+
+    def request(self, method, path, params=None, data=None):
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        url = self.get_url(path, params)
+        with self.lock:
+            for attempt in range(2):
+                if self.connection is None:
+                    self.connection = self.connect()
+                try:
+                    self.connection.request(method, url, body, headers)
+                    response = self.connection.getresponse()
+                    content = response.read()
+                    break
+                except (http_client.HTTPException, socket.error):
+                    # the daemon may have closed the idle connection, try
+                    # once more on a new one
+                    self.connection.close()
+                    self.connection = None
+                    if attempt:
+                        raise
+        content_type = response.getheader('Content-Type') or ''
+        if content_type.startswith('application/json') and content:
+            content = json.loads(content.decode('utf-8'))
+        if response.status >= 400:
+            if isinstance(content, dict):
+                content = content.get('message', content)
+            raise DockerAPIError(response.status, content)
+        return content
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def ping(self):
+        return self.request('GET', '/_ping') == b'OK'
+
+    def list_containers(self, labels=(), all=True):
+        return self.request('GET', '/containers/json', params={
+            'all': int(all),
+            'filters': json.dumps({'label': list(labels)}),
+        })
+
+    def inspect_container(self, container_id):
+        return self.request(
+            'GET', '/containers/{}/json'.format(quote(container_id)),
+        )
+
+    def get_port(self, container_id, port, protocol='tcp'):
+        """
+        Return the ``(host, port)`` the container ``port`` is published at,
+        ``None`` if it is not published or the container is not running.
+        The IPv4 binding is preferred and all interfaces are ``0.0.0.0``,
+        like in the output of ``docker-compose port``.
+        """
+        network = self.inspect_container(container_id)['NetworkSettings']
+        bindings = (network.get('Ports') or {}).get(
+            '{}/{}'.format(port, protocol)
+        )
+        if not bindings:
+            return None
+        ipv4_bindings = [
+            binding for binding in bindings if ':' not in binding['HostIp']
+        ]
+        binding = (ipv4_bindings or bindings)[0]
+        host = binding['HostIp']
+        if host in ('', '::'):
+            host = '0.0.0.0'
+        return host, int(binding['HostPort'])
+
+    def get_health(self, container_id):
+        """
+        Return the health status of the container (``starting``,
+        ``healthy`` or ``unhealthy``), ``None`` if it has no health check
+        and ``'stopped'`` if it is not running.
+        """
+        state = self.inspect_container(container_id)['State']
+        if not state.get('Running'):
+            return 'stopped'
+        return (state.get('Health') or {}).get('Status')
+
+    def create_exec(self, container_id, command, stdin=False):
+        return self.request(
+            'POST', '/containers/{}/exec'.format(quote(container_id)),
+            data={
+                'AttachStdin': stdin,
+                'AttachStdout': True,
+                'AttachStderr': True,
+                'Tty': False,
+                'Cmd': list(command),
+            },
+        )['Id']
+
+    def start_exec(self, exec_id):
+        """
+        Start the exec session and return its socket and a file object
+        reading the multiplexed output of the command from it.
+        """
+        connection = self.connect()
+        connection.connect()
+        sock = connection.sock
+        body = json.dumps({'Detach': False, 'Tty': False}).encode('utf-8')
+        sock.sendall((
+            'POST {} HTTP/1.1\r\n'
+            'Host: docker\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n'
+            'Connection: Upgrade\r\n'
+            'Upgrade: tcp\r\n'
+            '\r\n'
+        ).format(
+            self.get_url('/exec/{}/start'.format(exec_id)), len(body),
+        ).encode('ascii') + body)
+        data = b''
+        while b'\r\n\r\n' not in data:
+            received = sock.recv(4096)
+            if not received:
+                sock.close()
+                raise DockerAPIError(0, 'connection closed')
+            data += received
+        head, data = data.split(b'\r\n\r\n', 1)
+        status = int(head.split(b' ', 2)[1])
+        if status not in (101, 200):
+            sock.close()
+            raise DockerAPIError(status, data.decode('utf-8', 'replace'))
+        # commands run as long as they need to
+        sock.settimeout(None)
+        return sock, PrefixedReader(data, sock.makefile('rb'))
+
+    def inspect_exec(self, exec_id):
+        return self.request('GET', '/exec/{}/json'.format(exec_id))
+
+    def wait_exec(self, exec_id):
+        while True:
+            info = self.inspect_exec(exec_id)
+            if not info['Running'] and info['ExitCode'] is not None:
+                return info['ExitCode']
+            sleep(0.01)
+
+
+def iter_frames(fileobj, block_size=64 * 1024):
+    """
+    Split the multiplexed output of an exec session into ``(stream,
+    data)`` tuples.
+    """
+    while True:
+        header = fileobj.read(8)
+        if len(header) < 8:
+            return
+        stream, size = struct.unpack('>BxxxL', header)
+        while size:
+            data = fileobj.read(min(size, block_size))
+            if not data:
+                return
+            size -= len(data)
+            yield stream, data
+
+
+def get_writer(target, default):
+    """
+    Return a function writing bytes like a ``Popen`` argument: to the
+    ``default`` stream for ``None``, to the file ``target`` otherwise.
+    """
+    fileobj = default if target is None else target
+    # write bytes to text mode streams through their buffer
+    fileobj = getattr(fileobj, 'buffer', fileobj)
+
+    def write(data):
+        fileobj.write(data)
+        fileobj.flush()
+    return write
+
+
+def get_error_writer(stdout, stderr):
+    """
+    Return a function writing errors of an exec session where ``docker
+    exec`` would write them, to the target of ``stderr``.
+    """
+    if stderr == subprocess.STDOUT:
+        stderr = stdout
+    if stderr == subprocess.PIPE:
+        stderr = None
+    return get_writer(stderr, sys.stderr)
+
+
+class ExecInput(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # the daemon closes the stdin of the command
+            self.sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+
+class ExecOutput(object):
+    """
+    The stdout of an exec session as a file object. Frames of other
+    streams are passed to ``write_other``.
+    """
+    def __init__(self, frames, streams, write_other):
+        self.frames = frames
+        self.streams = streams
+        self.write_other = write_other
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buffer) < size:
+            stream, data = next(self.frames, (None, None))
+            if stream is None:
+                break
+            if stream in self.streams:
+                self.buffer += data
+            else:
+                self.write_other(data)
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class ExecProcess(object):
+    """
+    A command run in a container through the exec API, with the parts of
+    the ``subprocess.Popen`` interface used for ``docker exec`` processes.
+
+    ``stdin``, ``stdout`` and ``stderr`` take ``subprocess.PIPE``, a file
+    object or ``None`` like ``Popen``, ``stderr`` also
+    ``subprocess.STDOUT``. Output which is not piped is copied to the
+    terminal while the command runs, like the output of a child process.
+
+    Creating the session raises the ``DOCKER_ERRORS`` of the daemon. Once
+    the command runs, errors of the daemon are written to ``stderr`` and
+    end the process with ``returncode`` 1, like with ``docker exec``.
+    """
+    def __init__(self, client, container_id, command, stdin=None,
+                 stdout=None, stderr=None):
+        self.client = client
+        self.returncode = None
+        self.write_error = get_error_writer(stdout, stderr)
+        self.exec_id = client.create_exec(
+            container_id, command, stdin=stdin == subprocess.PIPE,
+        )
+        self.sock, output = client.start_exec(self.exec_id)
+        frames = iter_frames(output)
+        self.stdin = None
+        if stdin == subprocess.PIPE:
+            self.stdin = ExecInput(self.sock)
+        write_stdout = get_writer(stdout, sys.stdout)
+        write_stderr = get_writer(stderr, sys.stderr)
+        streams = (STDOUT,)
+        if stderr == subprocess.STDOUT:
+            streams = (STDOUT, STDERR)
+        self.stdout = None
+        self.copier = None
+        if stdout == subprocess.PIPE:
+            self.stdout = ExecOutput(frames, streams, write_stderr)
+        else:
+            if stderr == subprocess.STDOUT:
+                write_stderr = write_stdout
+            self.copier = threading.Thread(
+                target=self.copy_output,
+                args=(frames, write_stdout, write_stderr),
+            )
+            self.copier.daemon = True
+            self.copier.start()
+
+    def copy_output(self, frames, write_stdout, write_stderr):
+        try:
+            for stream, data in frames:
+                if stream == STDOUT:
+                    write_stdout(data)
+                else:
+                    write_stderr(data)
+        except (IOError, OSError):
+            pass
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                info = self.client.inspect_exec(self.exec_id)
+            except DOCKER_ERRORS as error:
+                self.fail(error)
+            else:
+                if not info['Running'] and info['ExitCode'] is not None:
+                    self.returncode = info['ExitCode']
+                    self.close()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            if self.stdin is not None:
+                self.stdin.close()
+            if self.copier is not None:
+                self.copier.join()
+            try:
+                self.returncode = self.client.wait_exec(self.exec_id)
+            except DOCKER_ERRORS as error:
+                self.fail(error)
+            else:
+                self.close()
+        return self.returncode
+
+    def fail(self, error):
+        self.close()
+        self.returncode = 1
+        message = messages.DOCKER_EXEC_FAILED.format(error=error)
+        try:
+            self.write_error('{}\n'.format(message).encode('utf-8'))
+        except (IOError, OSError):
+            pass
+
+    def kill(self):
+        # the exec API cannot signal the command, it gets an error or EOF
+        # once the connection is closed
+        self.close()
+        if self.returncode is None:
+            self.returncode = -signal.SIGKILL
+
+    def close(self):
+        try:
+            # the output file object keeps the socket open otherwise
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+CLIENTS = {}
+
+
+def get_client():
+    """
+    Return a ``DockerClient`` for the local Docker Engine, ``None`` if it
+    cannot be reached through its unix socket.
+    """
+    socket_path = get_socket_path()
+    if socket_path is None:
+        return None
+    if socket_path not in CLIENTS:
+        client = DockerClient(socket_path)
+        try:
+            if not client.ping():
+                client = None
+        except DOCKER_ERRORS:
+            client = None
+        CLIENTS[socket_path] = client
+    return CLIENTS[socket_path]
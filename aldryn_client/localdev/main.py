@@ -1,3 +1,4 @@
+import io
 import json
 import tarfile
 import re
@@ -7,13 +8,28 @@ import sys
 from time import sleep, time
 
 import click
-import requests
 import shutil
 
-from ..utils import check_call, check_output, is_windows, pretty_size, get_size
+from ..utils import (
+    check_call, check_output, is_windows, pretty_size, pretty_rate, get_size,
+)
 from ..cloud import get_aldryn_host
-from .. import settings
-from . import utils
+from ..compression import (
+    PrefixedReader, add_entries, extract_members, get_codec, get_file_codec,
+    iter_members, iter_tar_file, open_tar, open_tar_stream,
+)
+from ..file_index import FileIndex
+from ..manifest import (
+    MANIFEST_FILENAME, Manifest, get_local_path, hash_file,
+)
+from ..polling import is_task_finished, poll
+from ..scanner import get_total_size, scan_tree
+from ..transfer import (
+    DOWNLOAD_ERRORS, ChunkJournal, IterReader, ResponseReader, abort_response,
+    iter_blocks, iter_in_thread, pump,
+)
+from .. import messages, settings
+from . import readiness, utils
 
 
 DEFAULT_GIT_HOST = 'git@git.{aldryn_host}'
@@ -140,7 +156,231 @@ def create_workspace(client, website_slug, path=None):
     click.secho('\n\n{}'.format(os.linesep.join(instructions)), fg='green')
 
 
-def pull_db(client, path=None):
+# pg_isready does not need a session, older images only have psql
+DB_READY_COMMAND = (
+    '/bin/sh', '-c',
+    'if command -v pg_isready > /dev/null; then pg_isready -q -U postgres; '
+    'else psql -U postgres -c "SELECT 1"; fi',
+)
+
+
+def wait_for_db(db_container_id):
+    readiness.wait_for_container(
+        db_container_id, 'db',
+        command=DB_READY_COMMAND,
+        label='local database server',
+    )
+
+
+def reset_local_db(db_container_id):
+    click.secho(' ---> Removing local database...', nl=False)
+    start_remove = time()
+    # create empty db
+    utils.exec_call(
+        db_container_id, ['dropdb', '-U', 'postgres', 'db', '--if-exists'],
+    )  # TODO: silence me
+
+    utils.exec_check_call(
+        db_container_id, ['createdb', '-U', 'postgres', 'db'],
+    )
+    # Workaround to add the hstore extension
+    # TODO: solve extensions in a generic way in harmony with server side db-api
+    utils.exec_check_call(db_container_id, [
+        'psql', '-U', 'postgres', '--dbname=db',
+        '-c', 'CREATE EXTENSION IF NOT EXISTS hstore;',
+    ])
+    remove_time = int(time() - start_remove)
+    click.echo(' [{}s]'.format(remove_time))
+
+
+PG_RESTORE_CMD = (
+    'pg_restore', '-U', 'postgres', '--dbname=db', '-n', 'public',
+    '--no-owner', '--exit-on-error',
+)
+
+# pg_restore refuses plain SQL dumps
+PSQL_RESTORE_CMD = (
+    'psql', '-v', 'ON_ERROR_STOP=1', '-U', 'postgres', '-d', 'db', '-f',
+)
+
+
+RESTORE_DIR = '/tmp/aldryn-restore'
+
+# extracts the archive in the db container and prints the dump format
+# (directory, custom or plain) and path, or "empty"
+DETECT_DUMP_FORMAT_SCRIPT = """
+set -e
+rm -rf {restore_dir}
+mkdir -p {restore_dir}
+tar -x{tar_flag}f /app/{archive} -C {restore_dir}
+toc=$(find {restore_dir} -name toc.dat | head -n 1)
+if [ -n "$toc" ]; then
+    echo "directory $(dirname "$toc")"
+else
+    dump=$(find {restore_dir} -type f | head -n 1)
+    if [ -z "$dump" ]; then
+        echo "empty"
+    elif [ "$(head -c 5 "$dump")" = "PGDMP" ]; then
+        echo "custom $dump"
+    else
+        echo "plain $dump"
+    fi
+fi
+"""
+
+
+def get_container_cpu_count(container_id):
+    try:
+        return int(utils.exec_check_output(
+            container_id, ['nproc'], catch=False,
+        ).strip())
+    except (subprocess.CalledProcessError, ValueError):
+        return 1
+
+
+def restore_db_from_archive(db_container_id, db_dump_path, jobs=None,
+                            tar_flag='z'):
+    """
+    Restore the downloaded archive. The dump is extracted in the db
+    container, custom and directory format dumps are restored with parallel
+    jobs. ``tar_flag`` is the tar option decompressing the archive.
+    """
+    click.secho(' ---> Extracting database dump...', nl=False)
+    start_extract = time()
+    try:
+        detected = utils.exec_check_output(db_container_id, [
+            '/bin/bash', '-c',
+            DETECT_DUMP_FORMAT_SCRIPT.format(
+                restore_dir=RESTORE_DIR,
+                archive=db_dump_path.lstrip('/'),
+                tar_flag=tar_flag,
+            ),
+        ]).strip().split(' ', 1)
+        if len(detected) != 2:
+            raise click.ClickException(messages.DB_ARCHIVE_EMPTY)
+        dump_format, dump_path = detected
+        extract_time = int(time() - start_extract)
+        click.echo(' {} format [{}s]'.format(dump_format, extract_time))
+
+        click.secho(' ---> Importing database...', nl=False)
+        start_import = time()
+        if dump_format == 'plain':
+            # only the custom and directory formats support parallel jobs
+            command = PSQL_RESTORE_CMD + (dump_path,)
+            jobs = 1
+        else:
+            jobs = jobs or get_container_cpu_count(db_container_id)
+            command = PG_RESTORE_CMD + ('--jobs={}'.format(jobs), dump_path)
+        returncode = utils.exec_call(db_container_id, command)
+        if returncode:
+            raise click.ClickException(messages.DB_RESTORE_FAILED.format(
+                command=command[0], returncode=returncode,
+            ))
+        import_time = int(time() - start_import)
+        click.echo(' ({} jobs) [{}s]'.format(jobs, import_time))
+    finally:
+        utils.exec_call(db_container_id, ['rm', '-rf', RESTORE_DIR])
+
+
+# the start of custom format dumps and of the toc.dat of directory dumps
+PG_DUMP_MAGIC = b'PGDMP'
+
+
+def open_stream_dump(archive):
+    """
+    Return a file object reading the dump in the streamed ``archive``. Only
+    custom format dumps can be piped into pg_restore, other dumps raise a
+    ``click.ClickException``.
+    """
+    for member in iter_members(archive):
+        if member.isfile():
+            break
+    else:
+        raise click.ClickException(messages.DB_ARCHIVE_EMPTY)
+    dump = archive.extractfile(member)
+    magic = dump.read(len(PG_DUMP_MAGIC))
+    if (magic != PG_DUMP_MAGIC or
+            os.path.basename(member.name) == 'toc.dat'):
+        raise click.ClickException(
+            messages.DB_STREAM_UNSUPPORTED.format(name=member.name)
+        )
+    return PrefixedReader(magic, dump)
+
+
+def restore_db_from_stream(db_container_id, response, reset=False):
+    """
+    Decompress the downloaded archive while it is being received and pipe
+    the dump directly into ``pg_restore`` in the db container.
+
+    The archive is checked to hold a custom format dump before the local
+    database is reset with ``reset``, so an unsupported archive leaves it
+    untouched.
+    """
+    process = None
+    piped = 0
+    try:
+        with open_tar_stream(ResponseReader(response)) as archive:
+            dump = open_stream_dump(archive)
+            if reset:
+                reset_local_db(db_container_id)
+            click.secho(
+                ' ---> Downloading and importing database...', nl=False,
+            )
+            start_import = time()
+            process = utils.docker_exec(
+                db_container_id, PG_RESTORE_CMD, stdin=subprocess.PIPE,
+            )
+            piped = pump(dump.read, process.stdin.write)
+    except tarfile.TarError as exc:
+        raise click.ClickException(
+            'The downloaded database archive is invalid: {}'.format(exc)
+        )
+    except DOWNLOAD_ERRORS as exc:
+        raise click.ClickException(
+            messages.DB_DOWNLOAD_INTERRUPTED.format(error=exc)
+        )
+    except (IOError, OSError) as exc:
+        if process is None:
+            raise
+        # pg_restore exited early, its output explains why
+        click.secho(' error: {}'.format(exc), fg='red')
+    finally:
+        response.close()
+        if process is not None:
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+            returncode = process.wait()
+    if returncode:
+        raise click.ClickException(messages.DB_RESTORE_FAILED.format(
+            command='pg_restore', returncode=returncode,
+        ))
+    import_time = int(time() - start_import)
+    click.echo(' {} [{}s, {}]'.format(
+        pretty_size(piped),
+        import_time,
+        pretty_rate(piped, time() - start_import),
+    ))
+
+
+def decompress_archive(archive_path, codec, tar_path):
+    click.secho(' ---> Decompressing {}...'.format(codec.name), nl=False)
+    start_decompress = time()
+    with open(archive_path, 'rb') as source:
+        with open(tar_path, 'wb') as target:
+            shutil.copyfileobj(
+                codec.open_reader(source), target, 1024 * 1024,
+            )
+    os.remove(archive_path)
+    click.echo(' {} [{}s]'.format(
+        pretty_size(os.path.getsize(tar_path)),
+        int(time() - start_decompress),
+    ))
+    return tar_path
+
+
+def pull_db(client, path=None, stream=False, jobs=None):
     path = path or utils.get_project_home(path)
     website_id = utils.get_aldryn_project_settings(path)['id']
     website_slug = utils.get_aldryn_project_settings(path)['slug']
@@ -173,10 +413,10 @@ def pull_db(client, path=None):
         click.secho(' error!', color='red')
         exit()
 
-    progress = {'success': None}
-    while progress.get('success') is None:
-        sleep(2)
-        progress = client.download_db_progress(url=progress_url)
+    progress = poll(
+        lambda: client.download_db_progress(url=progress_url),
+        is_done=is_task_finished,
+    )
     if not progress.get('success'):
         click.secho(' error!', color='red')
         click.secho(progress.get('result') or '')
@@ -185,83 +425,241 @@ def pull_db(client, path=None):
     preparation_time = int(time() - start_preparation)
     click.echo(' [{}s]'.format(preparation_time))
 
-    click.secho(' ---> Downloading database...', nl=False)
-    start_download = time()
-    db_dump_path = client.download_db(website_slug, url=download_url, directory=path)
-    download_time = int(time() - start_download)
-    click.echo(' [{}s]'.format(download_time))
-
-    # strip path from dump_path for use in the docker container
-    db_dump_path = db_dump_path.replace(path, '')
-    click.secho(' ---> Waiting for local database server...', nl=False)
-    start_wait = time()
-    # check for postgres in db container to start
-    attempts = 10
-    for attempt in range(attempts):
-        try:
-            check_call([
-                'docker', 'exec', db_container_id,
-                'psql', '-U', 'postgres',
-            ], catch=False, silent=True)
-        except subprocess.CalledProcessError:
-            sleep(5)
-        else:
-            break
+    if stream:
+        # the import consumes the download, the database has to be ready
+        wait_for_db(db_container_id)
+        restore_db_from_stream(
+            db_container_id,
+            client.download_db_stream(website_slug, url=download_url),
+            reset=True,
+        )
     else:
-        exit(
-            "Couldn't connect to database container. "
-            "Database server may not have started."
+        click.secho(' ---> Downloading database...', nl=False)
+        start_download = time()
+        db_dump_path = client.download_db(
+            website_slug, url=download_url, directory=path,
         )
-    wait_time = int(time() - start_wait)
-    click.echo(' [{}s]'.format(wait_time))
-
-    click.secho(' ---> Removing local database...', nl=False)
-    start_remove = time()
-    # create empty db
-    subprocess.call([
-        'docker', 'exec', db_container_id,
-        'dropdb', '-U', 'postgres', 'db', '--if-exists',
-    ])  # TODO: silence me
-
-    check_call([
-        'docker', 'exec', db_container_id,
-        'createdb', '-U', 'postgres', 'db',
-    ])
-    # Workaround to add the hstore extension
-    # TODO: solve extensions in a generic way in harmony with server side db-api
-    check_call([
-        'docker', 'exec', db_container_id,
-        'psql', '-U', 'postgres', '--dbname=db',
-        '-c', 'CREATE EXTENSION IF NOT EXISTS hstore;',
-    ])
-    remove_time = int(time() - start_remove)
-    click.echo(' [{}s]'.format(remove_time))
+        download_time = int(time() - start_download)
+        click.echo(' {} [{}s, {}]'.format(
+            pretty_size(os.path.getsize(db_dump_path)),
+            download_time,
+            pretty_rate(
+                os.path.getsize(db_dump_path), time() - start_download,
+            ),
+        ))
 
-    click.secho(' ---> Importing database...', nl=False)
-    start_import = time()
-    # TODO: use same dump-type detection like server side on db-api
-    try:
-        piped_restore = (
-            'tar -xzOf /app/{}'
-            ' | pg_restore -U postgres --dbname=db -n public '
-            '--no-owner --exit-on-error'
-            .format(db_dump_path)
+        codec = get_file_codec(db_dump_path)
+        tar_flag = codec.tar_flag if codec else ''
+        if codec and tar_flag is None:
+            # the db container can only decompress gzip
+            db_dump_path = decompress_archive(
+                db_dump_path, codec, os.path.join(path, 'remote_db.tar'),
+            )
+            tar_flag = ''
+
+        # strip path from dump_path for use in the docker container
+        container_dump_path = db_dump_path.replace(path, '')
+        wait_for_db(db_container_id)
+        reset_local_db(db_container_id)
+        restore_db_from_archive(
+            db_container_id, container_dump_path, jobs=jobs,
+            tar_flag=tar_flag,
         )
-        subprocess.call((
-            'docker', 'exec', db_container_id,
-            '/bin/bash', '-c', piped_restore,
-        ))
-    except subprocess.CalledProcessError:
-        pass
-    import_time = int(time() - start_import)
-    click.echo(' [{}s]'.format(import_time))
+        if codec and codec.tar_flag is None:
+            os.remove(db_dump_path)
 
     click.secho('Done', fg='green', nl=False)
     total_time = int(time() - start_time)
     click.echo(' [{}s]'.format(total_time))
 
 
-def pull_media(client, path=None):
+def make_data_writable(project_home):
+    if 'linux' in sys.platform:
+        # On Linux, Docker typically runs as root, so files and folders
+        # created from within the container will be owned by root. As a
+        # workaround, make the folder permissions more permissive, to
+        # allow the invoking user to create files inside it.
+        docker_compose = utils.get_docker_compose_cmd(project_home)
+        check_call(
+            docker_compose(
+                'run', '--rm', 'web',
+                'chown', '-R', str(os.getuid()), 'data'
+            )
+        )
+
+
+def remove_empty_dirs(path, root):
+    path = os.path.dirname(path)
+    while path != root and os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+        path = os.path.dirname(path)
+
+
+def download_media_files(client, website_id, digests, directory):
+    """
+    Download the media files ``digests`` maps sha256 digests to paths of
+    into ``directory``, named by their digest. Every distinct content is
+    downloaded only once, several files are downloaded at the same time.
+    """
+    with client.concurrent(settings.MEDIA_DOWNLOAD_CONCURRENCY) as pool:
+        results = [
+            (digest, pool.download_media_file(
+                website_id, path, filename=digest, directory=directory,
+            ))
+            for digest, path in sorted(digests.items())
+        ]
+        with click.progressbar(length=len(results),
+                               label=' ---> Downloading...') as bar:
+            for digest, result in results:
+                if hash_file(result.get()) != digest:
+                    raise click.ClickException(messages.DOWNLOAD_INCOMPLETE)
+                bar.update(1)
+
+
+def pull_media_incremental(client, project_home, website_id,
+                           remote_manifest):
+    """
+    Download the files which are missing or different locally and delete
+    the files which do not exist on the server anymore.
+    """
+    media_dir = os.path.join(project_home, 'data', 'media')
+    if os.path.isdir(media_dir):
+        make_data_writable(project_home)
+    else:
+        os.makedirs(media_dir)
+    with open_media_index(project_home) as index:
+        manifest = build_media_manifest(index)
+        changed, deleted = remote_manifest.diff(manifest)
+        if changed or deleted:
+            apply_media_changes(
+                client, project_home, website_id, remote_manifest,
+                changed, deleted, index,
+            )
+        else:
+            click.secho('Local media is up to date', fg='green')
+        index.set_synced(remote_manifest)
+
+
+def apply_media_changes(client, project_home, website_id, remote_manifest,
+                        changed, deleted, index):
+    media_dir = os.path.join(project_home, 'data', 'media')
+    # refuse unsafe paths before downloading anything
+    targets = dict(
+        (path, get_local_path(media_dir, path)) for path in changed
+    )
+
+    click.echo(' ---> {} changed files ({}), {} deleted'.format(
+        len(changed),
+        pretty_size(sum(remote_manifest[path]['size'] for path in changed)),
+        len(deleted),
+    ))
+    staging_dir = os.path.join(
+        project_home, settings.PROJECT_CACHE_DIR, 'media-download',
+    )
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir)
+    digests = dict(
+        (remote_manifest[path]['sha256'], path) for path in changed
+    )
+    start_download = time()
+    try:
+        download_media_files(client, website_id, digests, staging_dir)
+        download_time = time() - start_download
+        click.echo('      [{}s, {}]'.format(
+            int(download_time),
+            pretty_rate(
+                sum(remote_manifest[digests[digest]]['size']
+                    for digest in digests),
+                download_time,
+            ),
+        ))
+
+        for path in changed:
+            digest = remote_manifest[path]['sha256']
+            target = targets[path]
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            # files with the same content share one download
+            shutil.copyfile(os.path.join(staging_dir, digest), target)
+            index.record(path, digest)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    for path in deleted:
+        target = get_local_path(media_dir, path)
+        os.remove(target)
+        remove_empty_dirs(target, media_dir)
+
+
+def extract_media_archive(fileobj, media_dir):
+    """
+    Extract the media archive read from ``fileobj`` into a staging
+    directory next to ``media_dir`` and swap it in once it is complete, a
+    failed extraction leaves the current media untouched. Returns the
+    ``TarStats`` of the extracted files.
+    """
+    staging_dir = media_dir + '.staging'
+    previous_dir = media_dir + '.previous'
+    for directory in (staging_dir, previous_dir):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+    try:
+        with open_tar_stream(fileobj) as media_archive:
+            stats = extract_members(media_archive, staging_dir)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    if not os.path.isdir(staging_dir):
+        # the archive is empty
+        os.makedirs(staging_dir)
+    if os.path.isdir(media_dir):
+        os.rename(media_dir, previous_dir)
+    os.rename(staging_dir, media_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    return stats
+
+
+def pull_media_stream(client, website_slug, download_url, media_dir):
+    """
+    Extract the media archive while it is being downloaded.
+    """
+    response = client.download_media_stream(website_slug, url=download_url)
+    if response is None:
+        # no backup yet, skipping
+        return False
+    click.secho(
+        ' ---> Downloading and extracting files to {}...'.format(media_dir),
+        nl=False,
+    )
+    start_download = time()
+    reader = ResponseReader(response)
+    # download the next blocks while the current ones are written to disk
+    blocks = IterReader(iter_in_thread(iter_blocks(reader.read)))
+    try:
+        stats = extract_media_archive(blocks, media_dir)
+    except tarfile.TarError as exc:
+        raise click.ClickException(
+            'The downloaded media archive is invalid: {}'.format(exc)
+        )
+    except DOWNLOAD_ERRORS as exc:
+        raise click.ClickException(
+            '{} {}'.format(messages.NETWORK_ERROR_MESSAGE, exc)
+        )
+    finally:
+        # the reader thread may be waiting for the stalled connection
+        abort_response(response)
+        blocks.close()
+    click.echo(' {} files ({}), {} downloaded [{}s, {}]'.format(
+        stats.files,
+        pretty_size(stats.size),
+        pretty_size(reader.bytes_read),
+        int(time() - start_download),
+        pretty_rate(reader.bytes_read, time() - start_download),
+    ))
+    return True
+
+
+def pull_media(client, path=None, incremental=False, stream=False):
     project_home = utils.get_project_home(path)
     path = os.path.join(project_home, 'data', 'media')
     website_id = utils.get_aldryn_project_settings(path)['id']
@@ -275,6 +673,20 @@ def pull_media(client, path=None):
         ),
     )
     start_time = time()
+    if incremental:
+        remote_manifest = client.get_media_manifest(website_id)
+        if remote_manifest is not None:
+            pull_media_incremental(
+                client, project_home, website_id, Manifest(remote_manifest),
+            )
+            click.secho('Done', fg='green', nl=False)
+            click.echo(' [{}s]'.format(int(time() - start_time)))
+            return
+        click.secho(
+            ' ---> The server does not provide a list of its media files, '
+            'downloading all files',
+            fg='yellow',
+        )
     click.secho(' ---> Preparing download...', nl=False)
     start_preparation = time()
     response = client.download_media_request(website_id) or {}
@@ -283,10 +695,10 @@ def pull_media(client, path=None):
         click.secho(' error!', color='red')
         exit()
 
-    progress = {'success': None}
-    while progress.get('success') is None:
-        sleep(2)
-        progress = client.download_media_progress(url=progress_url)
+    progress = poll(
+        lambda: client.download_media_progress(url=progress_url),
+        is_done=is_task_finished,
+    )
     if not progress.get('success'):
         click.secho(' error!', color='red')
         click.secho(progress.get('result') or '')
@@ -295,102 +707,175 @@ def pull_media(client, path=None):
     preparation_time = int(time() - start_preparation)
     click.echo(' [{}s]'.format(preparation_time))
 
+    if stream:
+        make_data_writable(project_home)
+        if pull_media_stream(client, website_slug, download_url, path):
+            forget_synced_media(project_home)
+            click.secho('Done', fg='green', nl=False)
+            click.echo(' [{}s]'.format(int(time() - start_time)))
+        return
+
     click.secho(' ---> Downloading...', nl=False)
     start_download = time()
-    backup_path = client.download_media(website_slug, url=download_url)
+    # download into the project so an interrupted download can be resumed
+    backup_path = client.download_media(
+        website_slug,
+        url=download_url,
+        filename='remote_media.tar.gz',
+        directory=project_home,
+    )
     if not backup_path:
         # no backup yet, skipping
         return
     download_time = int(time() - start_download)
-    click.echo(' [{}s]'.format(download_time))
+    click.echo(' {} [{}s, {}]'.format(
+        pretty_size(os.path.getsize(backup_path)),
+        download_time,
+        pretty_rate(os.path.getsize(backup_path), time() - start_download),
+    ))
 
-    if os.path.isdir(path):
-        start_remove = time()
-        click.secho(' ---> Removing local files...', nl=False)
-        shutil.rmtree(path)
-        remove_time = int(time() - start_remove)
-        click.echo(' [{}s]'.format(remove_time))
-
-    if 'linux' in sys.platform:
-        # On Linux, Docker typically runs as root, so files and folders
-        # created from within the container will be owned by root. As a
-        # workaround, make the folder permissions more permissive, to
-        # allow the invoking user to create files inside it.
-        docker_compose = utils.get_docker_compose_cmd(project_home)
-        check_call(
-            docker_compose(
-                'run', '--rm', 'web',
-                'chown', '-R', str(os.getuid()), 'data'
-            )
-        )
+    make_data_writable(project_home)
 
     click.secho(' ---> Extracting files to {}...'.format(path), nl=False)
     start_extract = time()
     with open(backup_path, 'rb') as fobj:
-        with tarfile.open(fileobj=fobj, mode='r:*') as media_archive:
-            media_archive.extractall(path=path)
+        stats = extract_media_archive(fobj, path)
     os.remove(backup_path)
+    forget_synced_media(project_home)
     extract_time = int(time() - start_extract)
-    click.echo(' [{}s]'.format(extract_time))
+    click.echo(' {} files ({}) [{}s]'.format(
+        stats.files, pretty_size(stats.size), extract_time,
+    ))
     click.secho('Done', fg='green', nl=False)
     total_time = int(time() - start_time)
     click.echo(' [{}s]'.format(total_time))
 
 
-def push_db(client):
-    project_home = utils.get_project_home()
-    website_id = utils.get_aldryn_project_settings(project_home)['id']
-    dump_filename = 'local_db.sql'
-    archive_filename = 'local_db.tar.gz'
-    archive_path = os.path.join(project_home, archive_filename)
-    docker_compose = utils.get_docker_compose_cmd(project_home)
-    website_slug = utils.get_aldryn_project_settings(project_home)['slug']
-    stage = 'test'
+def get_archive_codec(name):
+    codec = get_codec(name)
+    if codec.name != name:
+        click.secho(
+            ' ---> {} is not installed, using {}'.format(name, codec.name),
+            fg='yellow',
+        )
+    return codec
 
-    click.secho(
-        ' ===> Pushing local database to {} {} server'.format(
-            website_slug,
-            stage,
-        ),
-    )
-    start_time = time()
 
-    # start db
-    start_db = time()
-    click.secho(' ---> Starting local database server...')
-    click.secho('      ', nl=False)
-    check_call(docker_compose('up', '-d', 'db'))
-    db_time = int(time() - start_db)
-    click.secho('      [{}s]'.format(db_time))
+def upload_archive(client, kind, website_id, archive_path, chunked=False):
+    """
+    Upload a db or media archive, either in one request or as resumable
+    chunks, and show the upload progress.
+    """
+    upload = {
+        ('db', False): client.upload_db,
+        ('db', True): client.upload_db_chunked,
+        ('media', False): client.upload_media,
+        ('media', True): client.upload_media_chunked,
+    }[(kind, chunked)]
+    archive_size = os.path.getsize(archive_path)
+    start_upload = time()
+    with click.progressbar(length=archive_size,
+                           label=' ---> Uploading...') as bar:
+        response = upload(
+            website_id, archive_path, progress_callback=bar.update,
+        ) or {}
+    upload_time = int(time() - start_upload)
+    click.echo('      [{}s, {}]'.format(
+        upload_time, pretty_rate(archive_size, time() - start_upload),
+    ))
+    return response
+
+
+def resume_interrupted_upload(archive_path):
+    journal = ChunkJournal(archive_path, settings.UPLOAD_CHUNK_SIZE)
+    if not (journal.exists() and os.path.exists(archive_path)):
+        return False
+    if click.confirm(
+            'The upload of {} was interrupted. Do you want to resume it?'
+            .format(archive_path),
+            default=True):
+        return True
+    journal.clear()
+    return False
+
+
+DUMP_FILENAMES = {
+    'plain': 'local_db.sql',
+    'custom': 'local_db.dump',
+    'directory': 'local_db',
+}
+
+
+PG_DUMP_CMD = (
+    'pg_dump', '-U', 'postgres', '-d', 'db', '--no-owner', '--no-privileges',
+)
+
+
+def dump_local_db(project_home, dump_format='plain', jobs=None):
+    """
+    Dump the local database into the project directory and return the
+    path of the dump.
+    """
+    dump_filename = DUMP_FILENAMES[dump_format]
+    db_container_id = utils.get_db_container_id(project_home)
+    dump_args = ['--format={}'.format(dump_format)]
+    if dump_format == 'directory':
+        jobs = jobs or get_container_cpu_count(db_container_id)
+        dump_args.append('--jobs={}'.format(jobs))
 
     # take dump of database
     click.secho(' ---> Dumping local database...', nl=False)
     start_dump = time()
+    container_dump_path = os.path.join('/app/', dump_filename)
+    # pg_dump refuses to write a directory dump into an existing directory
+    utils.exec_check_call(db_container_id, ['rm', '-rf', container_dump_path])
     # TODO: show total table and row count
-    db_container_id = utils.get_db_container_id(project_home)
-    subprocess.call((
-        'docker', 'exec', db_container_id,
-        'pg_dump', '-U', 'postgres', '-d', 'db',
-        '--no-owner', '--no-privileges',
-        '-f', os.path.join('/app/', dump_filename)
-    ))
+    utils.exec_check_call(
+        db_container_id,
+        list(PG_DUMP_CMD) + ['-f', container_dump_path] + dump_args,
+    )
+    # the dump is owned by the user of the container, usually root, and
+    # directory dumps are only accessible to their owner
+    utils.exec_check_call(
+        db_container_id, ['chmod', '-R', 'a+rwX', container_dump_path],
+    )
     dump_time = int(time() - start_dump)
-    click.echo(' [{}s]'.format(dump_time))
+    click.echo(' {} format{} [{}s]'.format(
+        dump_format,
+        ', {} jobs'.format(jobs) if jobs else '',
+        dump_time,
+    ))
+    return os.path.join(project_home, dump_filename)
+
+
+def create_db_archive(project_home, archive_path, dump_format='plain',
+                      jobs=None, codec=None):
+    """
+    Dump the local database and pack it into ``archive_path``.
 
-    sql_dump_size = os.path.getsize(dump_filename)
+    Custom and directory format dumps are compressed by pg_dump itself
+    (in parallel for the directory format), so a gzip container is
+    written without compressing the data a second time.
+    """
+    codec = codec or get_codec('gzip')
+    dump_path = dump_local_db(project_home, dump_format, jobs)
+    dump_size = get_size(dump_path)
+    level = None
+    if dump_format != 'plain' and codec.name == 'gzip':
+        # the data of custom and directory dumps is compressed already
+        level = 0
     click.secho(
-        ' ---> Compressing SQL dump ({})...'.format(
-            pretty_size(sql_dump_size)
+        ' ---> {} SQL dump ({}, {})...'.format(
+            'Archiving' if level == 0 else 'Compressing',
+            pretty_size(dump_size),
+            codec.name,
         ),
         nl=False,
     )
     start_compress = time()
-    with tarfile.open(archive_path, mode='w:gz') as tar:
-        tar.add(
-            os.path.join(project_home, dump_filename),
-            arcname=dump_filename
-        )
-    compressed_size = os.path.getsize(archive_filename)
+    with open_tar(archive_path, codec=codec, level=level) as tar:
+        tar.add(dump_path, arcname=os.path.basename(dump_path))
+    compressed_size = os.path.getsize(archive_path)
     compress_time = int(time() - start_compress)
     click.echo(
         ' {} [{}s]'.format(
@@ -399,11 +884,176 @@ def push_db(client):
         )
     )
 
-    click.secho(' ---> Uploading...', nl=False)
+
+def show_pipeline_progress(progress, total=None, done=False):
+    """
+    Show the bytes dumped (or archived of ``total``) and sent by a
+    pipelined upload, at most twice a second.
+    """
+    now = time()
+    if not done and now - progress['shown'] < 0.5:
+        return
+    progress['shown'] = now
+    click.echo(
+        '\r ---> Compressing and uploading SQL dump... {}{} {}, {} '
+        'sent'.format(
+            pretty_size(progress['dumped']),
+            ' of {}'.format(pretty_size(total)) if total else '',
+            'archived' if total else 'dumped',
+            pretty_size(progress['sent']),
+        ),
+        nl=done,
+    )
+
+
+def stream_db_dump(client, website_id, project_home, codec, progress):
+    """
+    Upload the plain SQL output of pg_dump while it is being produced,
+    compressed in a worker thread and sent as a chunked request body. No
+    files are written and only a few blocks are held in memory. The bytes
+    dumped and sent are counted in ``progress``.
+
+    Returns ``None`` if the server refuses the bare dump, as servers only
+    accepting tar archives do.
+    """
+    db_container_id = utils.get_db_container_id(project_home)
+    process = utils.docker_exec(
+        db_container_id, PG_DUMP_CMD + ('--format=plain',),
+        stdout=subprocess.PIPE,
+    )
+
+    def dump_blocks():
+        for block in iter_blocks(process.stdout.read):
+            progress['dumped'] += len(block)
+            yield block
+        returncode = process.wait()
+        if returncode:
+            # never let the server import a truncated dump
+            raise click.ClickException(
+                messages.DB_DUMP_FAILED.format(returncode=returncode)
+            )
+
+    def update(num_bytes):
+        progress['sent'] += num_bytes
+        show_pipeline_progress(progress)
+
+    try:
+        response = client.upload_db_dump_stream(
+            website_id,
+            iter_in_thread(codec.iter_compress(dump_blocks())),
+            progress_callback=update,
+            filename='local_db.sql' + codec.extension.replace('.tar', '', 1),
+        )
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    show_pipeline_progress(progress, done=True)
+    return response
+
+
+def upload_db_dump_archive(client, website_id, project_home, codec,
+                           progress):
+    """
+    Archive, compress and upload a plain SQL dump in one pass.
+
+    A tar header states the size of its member, so the dump is written to
+    the project directory first. The archive is then produced from it
+    block by block, compressed in a worker thread and sent as a chunked
+    request body, without writing the archive to disk.
+    """
+    dump_path = dump_local_db(project_home)
+    dump_size = os.path.getsize(dump_path)
+
+    def archive_blocks():
+        for block in iter_tar_file(dump_path, os.path.basename(dump_path)):
+            progress['dumped'] = min(
+                progress['dumped'] + len(block), dump_size,
+            )
+            yield block
+
+    def update(num_bytes):
+        progress['sent'] += num_bytes
+        show_pipeline_progress(progress, dump_size)
+
+    response = client.upload_db_stream(
+        website_id,
+        iter_in_thread(codec.iter_compress(archive_blocks())),
+        progress_callback=update,
+        filename='local_db' + codec.extension,
+    )
+    show_pipeline_progress(progress, dump_size, done=True)
+    return response
+
+
+def upload_db_pipeline(client, website_id, project_home, codec=None):
+    """
+    Dump, compress and upload the local database in one pass, streaming
+    the output of pg_dump. Servers which refuse a bare SQL dump get the
+    usual archive, of a dump written to the project directory.
+    """
+    codec = codec or get_codec('gzip')
+    progress = {'dumped': 0, 'sent': 0, 'shown': 0}
     start_upload = time()
-    response = client.upload_db(website_id, archive_path) or {}
-    upload_time = int(time() - start_upload)
-    click.echo(' [{}s]'.format(upload_time))
+    response = stream_db_dump(
+        client, website_id, project_home, codec, progress,
+    )
+    if response is None:
+        click.secho(messages.DB_DUMP_STREAM_REFUSED, fg='yellow')
+        progress = {'dumped': 0, 'sent': 0, 'shown': 0}
+        start_upload = time()
+        response = upload_db_dump_archive(
+            client, website_id, project_home, codec, progress,
+        )
+    click.echo('      [{}s, {}]'.format(
+        int(time() - start_upload),
+        pretty_rate(progress['sent'], time() - start_upload),
+    ))
+    return response or {}
+
+
+def push_db(client, chunked=False, dump_format='plain', jobs=None,
+            pipeline=False, codec='gzip'):
+    project_home = utils.get_project_home()
+    website_id = utils.get_aldryn_project_settings(project_home)['id']
+    codec = get_archive_codec(codec)
+    archive_filename = 'local_db' + codec.extension
+    archive_path = os.path.join(project_home, archive_filename)
+    docker_compose = utils.get_docker_compose_cmd(project_home)
+    website_slug = utils.get_aldryn_project_settings(project_home)['slug']
+    stage = 'test'
+
+    click.secho(
+        ' ===> Pushing local database to {} {} server'.format(
+            website_slug,
+            stage,
+        ),
+    )
+    start_time = time()
+
+    resume = chunked and resume_interrupted_upload(archive_path)
+    if not resume:
+        # start db
+        start_db = time()
+        click.secho(' ---> Starting local database server...')
+        click.secho('      ', nl=False)
+        check_call(docker_compose('up', '-d', 'db'))
+        db_time = int(time() - start_db)
+        click.secho('      [{}s]'.format(db_time))
+
+    if pipeline:
+        response = upload_db_pipeline(
+            client, website_id, project_home, codec=codec,
+        )
+    else:
+        if not resume:
+            create_db_archive(
+                project_home, archive_path, dump_format=dump_format,
+                jobs=jobs, codec=codec,
+            )
+        response = upload_archive(
+            client, 'db', website_id, archive_path, chunked=chunked,
+        )
 
     progress_url = response.get('progress_url')
     if not progress_url:
@@ -412,10 +1062,10 @@ def push_db(client):
 
     click.secho(' ---> Processing...', nl=False)
     start_processing = time()
-    progress = {'success': None}
-    while progress.get('success') is None:
-        sleep(2)
-        progress = client.upload_db_progress(url=progress_url)
+    progress = poll(
+        lambda: client.upload_db_progress(url=progress_url),
+        is_done=is_task_finished,
+    )
     if not progress.get('success'):
         click.secho(' error!', color='red')
         click.secho(progress.get('result') or '')
@@ -424,17 +1074,127 @@ def push_db(client):
     click.echo(' [{}s]'.format(processing_time))
 
     # clean up
-    for temp_file in (dump_filename, archive_filename):
-        os.remove(os.path.join(project_home, temp_file))
+    if not pipeline:
+        os.remove(archive_path)
+    # the dump has been written by the container, which may run as root
+    utils.exec_call(utils.get_db_container_id(project_home), [
+        'rm', '-rf',
+    ] + [
+        os.path.join('/app/', dump_filename)
+        for dump_filename in DUMP_FILENAMES.values()
+    ])
     click.secho('Done', fg='green', nl=False)
     total_time = int(time() - start_time)
     click.echo(' [{}s]'.format(total_time))
 
 
-def push_media(client):
+def create_media_archive(project_home, archive_path, codec=None):
+    click.secho('Compressing local media folder...',  nl=False)
+    start_compression = time()
+    media_dir = os.path.join(project_home, 'data', 'media')
+    # partial uploads are currently not supported
+    # not including MANIFEST to do a full restore
+    entries = scan_tree(media_dir, exclude=(MANIFEST_FILENAME,))
+    file_count = sum(1 for entry in entries if entry.is_file())
+    with open_tar(archive_path, codec=codec) as tar:
+        add_entries(tar, media_dir, entries)
+    compress_time = int(time() - start_compression)
+    click.echo(
+        ' {} {} ({}) compressed to {} [{}s]'.format(
+            file_count,
+            'files' if file_count > 1 else 'file',
+            pretty_size(get_total_size(entries)),
+            pretty_size(os.path.getsize(archive_path)),
+            compress_time,
+        )
+    )
+
+
+def get_media_index_path(project_home):
+    return os.path.join(
+        project_home,
+        settings.PROJECT_CACHE_DIR,
+        settings.MEDIA_INDEX_FILENAME,
+    )
+
+
+def open_media_index(project_home):
+    return FileIndex(
+        os.path.join(project_home, 'data', 'media'),
+        get_media_index_path(project_home),
+    )
+
+
+def forget_synced_media(project_home):
+    """
+    Forget the state of the last sync after the media have been replaced
+    as a whole and it no longer describes the remote files.
+    """
+    if os.path.exists(get_media_index_path(project_home)):
+        with open_media_index(project_home) as index:
+            index.clear_synced()
+
+
+def set_synced_media(project_home, manifest):
+    with open_media_index(project_home) as index:
+        index.set_synced(manifest)
+
+
+def build_media_manifest(index):
+    """
+    Update the index of the local media folder and return its manifest.
+    Only files whose size, mtime or inode changed are hashed.
+    """
+    click.secho(' ---> Scanning local media folder...', nl=False)
+    start_scan = time()
+    hashed = []
+    manifest = index.update(callback=hashed.append)
+    click.echo(' {} files ({}), {} hashed [{}s]'.format(
+        len(manifest),
+        pretty_size(manifest.size),
+        len(hashed),
+        int(time() - start_scan),
+    ))
+    return manifest
+
+
+def create_partial_media_archive(project_home, archive_path, manifest,
+                                 changed, deleted, codec=None):
+    """
+    Pack the ``changed`` files together with a ``MANIFEST`` listing all
+    files and the ``deleted`` ones, which makes the server apply the
+    archive on top of the existing media instead of replacing them.
+    """
+    media_dir = os.path.join(project_home, 'data', 'media')
+    click.secho(
+        ' ---> Compressing {} changed files ({}), {} deleted...'.format(
+            len(changed),
+            pretty_size(sum(manifest[path]['size'] for path in changed)),
+            len(deleted),
+        ),
+        nl=False,
+    )
+    start_compression = time()
+    with open_tar(archive_path, codec=codec) as tar:
+        for path in changed:
+            tar.add(get_local_path(media_dir, path), arcname=path)
+            tar.members = []
+        data = manifest.to_json(deleted).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST_FILENAME)
+        info.size = len(data)
+        info.mtime = time()
+        tar.addfile(info, io.BytesIO(data))
+    click.echo(' {} [{}s]'.format(
+        pretty_size(os.path.getsize(archive_path)),
+        int(time() - start_compression),
+    ))
+
+
+def push_media(client, chunked=False, incremental=False, codec='gzip'):
     project_home = utils.get_project_home()
     website_id = utils.get_aldryn_project_settings(project_home)['id']
-    archive_path = os.path.join(project_home, 'local_media.tar.gz')
+    codec = get_archive_codec(codec)
+    archive_path = os.path.join(project_home, 'local_media' + codec.extension)
     website_slug = utils.get_aldryn_project_settings(project_home)['slug']
     stage = 'test'
     click.secho(
@@ -444,35 +1204,38 @@ def push_media(client):
         ),
     )
     start_time = time()
-    click.secho('Compressing local media folder...',  nl=False)
-    uncompressed_size = 0
-    start_compression = time()
-    with tarfile.open(archive_path, mode='w:gz') as tar:
-        media_dir = os.path.join(project_home, 'data', 'media')
-        for item in os.listdir(media_dir):
-            if item == 'MANIFEST':
-                # partial uploads are currently not supported
-                # not including MANIFEST to do a full restore
-                continue
-            file_path = os.path.join(media_dir, item)
-            tar.add(file_path, arcname=item)
-            uncompressed_size += get_size(file_path)
-        file_count = len(tar.getmembers())
-    compress_time = int(time() - start_compression)
-    click.echo(
-        ' {} {} ({}) compressed to {} [{}s]'.format(
-            file_count,
-            'files' if file_count > 1 else 'file',
-            pretty_size(uncompressed_size),
-            pretty_size(os.path.getsize(archive_path)),
-            compress_time,
-        )
+    resume = chunked and resume_interrupted_upload(archive_path)
+    manifest = None
+    if incremental:
+        with open_media_index(project_home) as index:
+            manifest = build_media_manifest(index)
+    if not resume and manifest is not None:
+        remote_manifest = client.get_media_manifest(website_id)
+        if remote_manifest is None:
+            # a partial archive could replace all media files on a server
+            # which does not know about them
+            click.secho(
+                ' ---> The server does not provide a list of its media '
+                'files, uploading all files',
+                fg='yellow',
+            )
+            create_media_archive(project_home, archive_path, codec=codec)
+        else:
+            changed, deleted = manifest.diff(Manifest(remote_manifest))
+            if not (changed or deleted):
+                set_synced_media(project_home, manifest)
+                click.secho('Remote media is up to date', fg='green')
+                return
+            create_partial_media_archive(
+                project_home, archive_path, manifest, changed, deleted,
+                codec=codec,
+            )
+    elif not resume:
+        create_media_archive(project_home, archive_path, codec=codec)
+
+    response = upload_archive(
+        client, 'media', website_id, archive_path, chunked=chunked,
     )
-    click.secho('Uploading...', nl=False)
-    start_upload = time()
-    response = client.upload_media(website_id, archive_path) or {}
-    upload_time = int(time() - start_upload)
-    click.echo(' [{}s]'.format(upload_time))
     progress_url = response.get('progress_url')
     if not progress_url:
         click.secho(' error!', color='red')
@@ -480,10 +1243,10 @@ def push_media(client):
 
     click.secho('Processing...', nl=False)
     start_processing = time()
-    progress = {'success': None}
-    while progress.get('success') is None:
-        sleep(2)
-        progress = client.upload_media_progress(url=progress_url)
+    progress = poll(
+        lambda: client.upload_media_progress(url=progress_url),
+        is_done=is_task_finished,
+    )
     if not progress.get('success'):
         click.secho(' error!', color='red')
         click.secho(progress.get('result') or '')
@@ -491,6 +1254,11 @@ def push_media(client):
     processing_time = int(time() - start_processing)
     click.echo(' [{}s]'.format(processing_time))
 
+    if manifest is not None:
+        set_synced_media(project_home, manifest)
+    else:
+        forget_synced_media(project_home)
+
     # clean up
     os.remove(archive_path)
     click.secho('Done', fg='green', nl=False)
@@ -498,6 +1266,32 @@ def push_media(client):
     click.echo(' [{}s]'.format(total_time))
 
 
+def show_media_status(path=None):
+    """
+    List the local media files changed since the last push or pull.
+    """
+    project_home = utils.get_project_home(path)
+    with open_media_index(project_home) as index:
+        manifest = build_media_manifest(index)
+        synced_manifest = index.get_synced_manifest()
+    if synced_manifest is None:
+        click.secho(
+            'The media files have not been pushed or pulled incrementally '
+            'yet',
+            fg='yellow',
+        )
+        return
+    changed, deleted = manifest.diff(synced_manifest)
+    if not (changed or deleted):
+        click.secho('No changes since the last push or pull', fg='green')
+        return
+    for path in changed:
+        status = 'modified' if path in synced_manifest else 'new'
+        click.echo('    {:<10}{}'.format(status + ':', path))
+    for path in deleted:
+        click.echo('    {:<10}{}'.format('deleted:', path))
+
+
 def update_local_project():
     project_home = utils.get_project_home()
     docker_compose = utils.get_docker_compose_cmd(project_home)
@@ -571,15 +1365,14 @@ def develop_package(package, no_rebuild=False):
 
 
 def open_project(open_browser=True):
-    docker_compose = utils.get_docker_compose_cmd(utils.get_project_home())
     try:
-        addr = check_output(docker_compose('port', 'web', '80'), catch=False)
+        addr = utils.get_service_port(utils.get_project_home(), 'web', 80)
     except subprocess.CalledProcessError:
         if click.prompt('Your project is not running. Do you want to start '
                         'it now?'):
             return start_project()
         return
-    host, port = addr.rstrip(os.linesep).split(':')
+    host, port = addr.split(':')
 
     if host == '0.0.0.0':
         docker_host_url = os.environ.get('DOCKER_HOST')
@@ -594,23 +1387,12 @@ def open_project(open_browser=True):
         fg='green'
     )
 
-    click.secho('Waiting for project to start..', fg='green', nl=False)
+    click.secho('Waiting for project to start...', fg='green', nl=False)
     # wait 30s for runserver to startup
-    seconds = 30
-    for attempt in range(seconds):
-        click.secho('.', fg='green', nl=False)
-        try:
-            requests.head(addr)
-        except requests.ConnectionError:
-            sleep(1)
-        else:
-            click.echo()
-            break
-    else:
-        raise click.ClickException(
-            "\nProject failed to start. Please run 'docker-compose logs' "
-            "to get more information."
-        )
+    wait_time = readiness.wait_until_ready(
+        readiness.http_probe(addr), 'web', deadline=30,
+    )
+    click.echo(' [{:.2f}s]'.format(wait_time))
 
     if open_browser:
         click.launch(addr)
@@ -0,0 +1,110 @@
+import subprocess
+from time import time
+
+import click
+import requests
+
+from ..polling import poll
+from ..utils import dev_null
+from .. import messages, settings
+from . import docker_api, utils
+
+
+def exec_probe(container_id, command):
+    """
+    Ready once ``command`` exits with status 0 in the container.
+    """
+    def probe():
+        with dev_null() as devnull:
+            try:
+                return not utils.exec_call(
+                    container_id, command,
+                    stdout=devnull, stderr=subprocess.STDOUT,
+                )
+            except docker_api.DOCKER_ERRORS + (OSError,):
+                return False
+    return probe
+
+
+def http_probe(url, timeout=1):
+    """
+    Ready once ``url`` answers HTTP requests.
+    """
+    def probe():
+        try:
+            requests.head(url, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+        return True
+    return probe
+
+
+def health_probe(container_id):
+    """
+    Ready once the health check of the container reports it healthy.
+    """
+    client = docker_api.get_client()
+
+    def probe():
+        try:
+            return client.get_health(container_id) == 'healthy'
+        except docker_api.DOCKER_ERRORS:
+            return False
+    return probe
+
+
+def has_health_check(container_id):
+    client = docker_api.get_client()
+    if client is None:
+        return False
+    try:
+        return client.get_health(container_id) not in (None, 'stopped')
+    except docker_api.DOCKER_ERRORS:
+        return False
+
+
+def get_probe(container_id, command=None):
+    """
+    Pick the probe for a container: ``command`` run in the container, which
+    checks exactly what the caller needs, or else the health check of the
+    container.
+    """
+    if command:
+        return exec_probe(container_id, command)
+    if has_health_check(container_id):
+        return health_probe(container_id)
+    raise ValueError('No way to probe container {}'.format(container_id))
+
+
+def wait_until_ready(probe, service, deadline=None):
+    """
+    Call ``probe`` until it returns ``True``, starting after
+    ``READINESS_INITIAL_INTERVAL`` seconds and doubling the interval up to
+    ``READINESS_MAX_INTERVAL``. Raises a ``click.ClickException`` after
+    ``deadline`` seconds. Returns the seconds it took.
+    """
+    deadline = deadline or settings.READINESS_DEADLINE
+    start = time()
+    poll(
+        probe,
+        is_done=bool,
+        initial_interval=settings.READINESS_INITIAL_INTERVAL,
+        max_interval=settings.READINESS_MAX_INTERVAL,
+        factor=2,
+        deadline=deadline,
+        timeout_message=messages.SERVICE_NOT_READY.format(
+            service=service, deadline=deadline,
+        ),
+    )
+    return time() - start
+
+
+def wait_for_container(container_id, service, command=None, label=None,
+                       deadline=None):
+    click.secho(
+        ' ---> Waiting for {}...'.format(label or service), nl=False,
+    )
+    probe = get_probe(container_id, command=command)
+    wait_time = wait_until_ready(probe, service, deadline=deadline)
+    click.echo(' [{:.2f}s]'.format(wait_time))
+    return wait_time
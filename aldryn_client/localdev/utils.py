@@ -1,11 +1,14 @@
 import json
+import re
+import subprocess
 import sys
 import os
 
 import click
 
-from ..utils import check_output, is_windows
+from ..utils import check_output, execute, is_windows
 from .. import settings
+from . import docker_api
 
 
 def get_aldryn_project_settings(path=None):
@@ -128,7 +131,151 @@ def ensure_windows_docker_compose_file_exists(path):
         yaml.safe_dump(config, fh)
 
 
-def get_db_container_id(path):
+def get_compose_project_names(path):
+    """
+    The project names docker-compose derives from the project directory,
+    older releases strip dashes and underscores as well.
+    """
+    name = (
+        os.environ.get('COMPOSE_PROJECT_NAME') or
+        os.path.basename(os.path.abspath(path))
+    ).lower()
+    return set([
+        re.sub(r'[^a-z0-9]', '', name),
+        re.sub(r'[^-_a-z0-9]', '', name),
+    ])
+
+
+def find_service_container(path, service):
+    """
+    Look up the container of the docker-compose ``service`` through the
+    Docker Engine API. Returns ``None`` if the API is not available or no
+    container has been found.
+    """
+    client = docker_api.get_client()
+    if client is None:
+        return None
+    project_names = get_compose_project_names(path)
+    try:
+        containers = client.list_containers(labels=[
+            'com.docker.compose.service={}'.format(service),
+        ])
+    except docker_api.DOCKER_ERRORS:
+        return None
+    containers = [
+        container for container in containers
+        if container['Labels'].get('com.docker.compose.project') in
+        project_names and
+        container['Labels'].get('com.docker.compose.oneoff') != 'True'
+    ]
+    if not containers:
+        return None
+    containers.sort(key=lambda container: int(
+        container['Labels'].get('com.docker.compose.container-number', 1)
+    ))
+    return containers[0]['Id']
+
+
+def get_service_container_id(path, service):
+    container_id = find_service_container(path, service)
+    if container_id:
+        return container_id
     docker_compose = get_docker_compose_cmd(path)
-    output = check_output(docker_compose('ps', '-q', 'db'))
+    output = check_output(docker_compose('ps', '-q', service))
     return output.rstrip(os.linesep)
+
+
+def get_db_container_id(path):
+    return get_service_container_id(path, 'db')
+
+
+def get_service_port(path, service, port):
+    """
+    Return the ``host:port`` the ``port`` of ``service`` is published at,
+    like ``docker-compose port``. Raises ``CalledProcessError`` if the
+    service is not running.
+    """
+    container_id = find_service_container(path, service)
+    if container_id:
+        try:
+            address = docker_api.get_client().get_port(container_id, port)
+        except docker_api.DOCKER_ERRORS:
+            address = None
+        if address:
+            return '{}:{}'.format(*address)
+    docker_compose = get_docker_compose_cmd(path)
+    return check_output(
+        docker_compose('port', service, str(port)), catch=False,
+    ).rstrip(os.linesep)
+
+
+def get_exec_command(container_id, command, interactive=False):
+    return (
+        ['docker', 'exec'] + (['-i'] if interactive else []) +
+        [container_id] + list(command)
+    )
+
+
+def docker_exec(container_id, command, **kwargs):
+    """
+    Start ``command`` in a container. Uses the Docker Engine API if
+    possible, ``docker exec`` otherwise. Takes the ``stdin``, ``stdout``
+    and ``stderr`` arguments of ``Popen`` and returns a ``Popen`` like
+    object.
+    """
+    client = docker_api.get_client()
+    if client is not None:
+        exec_kwargs = dict(kwargs)
+        exec_kwargs.pop('close_fds', None)
+        try:
+            return docker_api.ExecProcess(
+                client, container_id, command, **exec_kwargs
+            )
+        except docker_api.DOCKER_ERRORS:
+            # e.g. the container is not running (409) or the daemon is
+            # restarting, docker exec reports the problem like it would
+            # without the API
+            pass
+    return subprocess.Popen(
+        get_exec_command(
+            container_id, command,
+            interactive=kwargs.get('stdin') == subprocess.PIPE,
+        ),
+        **kwargs
+    )
+
+
+def exec_call(container_id, command, **kwargs):
+    return docker_exec(container_id, command, **kwargs).wait()
+
+
+def run_exec_check_call(container_id, command, **kwargs):
+    returncode = exec_call(container_id, command, **kwargs)
+    if returncode:
+        raise subprocess.CalledProcessError(
+            returncode, get_exec_command(container_id, command),
+        )
+    return returncode
+
+
+def run_exec_check_output(container_id, command, **kwargs):
+    process = docker_exec(
+        container_id, command, stdout=subprocess.PIPE, **kwargs
+    )
+    output = process.stdout.read()
+    returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(
+            returncode, get_exec_command(container_id, command), output,
+        )
+    return output
+
+
+def exec_check_call(container_id, command, **kwargs):
+    return execute(run_exec_check_call, container_id, command, **kwargs)
+
+
+def exec_check_output(container_id, command, **kwargs):
+    return execute(
+        run_exec_check_output, container_id, command, **kwargs
+    ).decode()
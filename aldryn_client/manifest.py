@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import sys
+
+import click
+import six
+
+from . import messages
+
+
+# written into media archives by the server, never part of the media itself
+MANIFEST_FILENAME = 'MANIFEST'
+
+
+def hash_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# encoding of file names on python 2, where they are byte strings
+FILESYSTEM_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+
+
+def decode_path(path):
+    """
+    Return a manifest path as text, manifests from the server and the file
+    index hold text only.
+    """
+    if isinstance(path, bytes):
+        return path.decode(FILESYSTEM_ENCODING)
+    return path
+
+
+def encode_path(path):
+    """
+    Return ``path`` in the type the file system functions expect, byte
+    strings on python 2.
+    """
+    if six.PY2 and isinstance(path, six.text_type):
+        return path.encode(FILESYSTEM_ENCODING)
+    return path
+
+
+def get_local_path(directory, relative_path):
+    """
+    Turn a relative manifest path into a path below ``directory``. Paths
+    which would point outside of ``directory`` raise a
+    ``click.ClickException``.
+    """
+    parts = relative_path.split('/')
+    if (not relative_path or relative_path.startswith('/') or
+            any(part in ('', '.', '..') for part in parts)):
+        raise click.ClickException(
+            messages.INVALID_MANIFEST_PATH.format(path=relative_path)
+        )
+    return os.path.join(
+        encode_path(directory), *[encode_path(part) for part in parts]
+    )
+
+
+class Manifest(dict):
+    """
+    Maps the relative paths of all files in a directory to their ``size``,
+    ``mtime`` and ``sha256`` digest.
+
+    Manifests received from the server have no ``mtime``, files are
+    compared by size and content only.
+    """
+    @property
+    def size(self):
+        return sum(entry['size'] for entry in self.values())
+
+    def diff(self, other):
+        """
+        Compare with the manifest ``other`` describes the target state of.
+
+        Returns the sorted paths which are missing or different in
+        ``other`` and the sorted paths which only exist in ``other``.
+        """
+        changed = [
+            path for path, entry in self.items()
+            if path not in other or
+            other[path]['size'] != entry['size'] or
+            other[path]['sha256'] != entry['sha256']
+        ]
+        deleted = [path for path in other if path not in self]
+        return sorted(changed), sorted(deleted)
+
+    def to_json(self, deleted=()):
+        """
+        Serialize to the ``MANIFEST`` of a partial media archive: the
+        complete list of files and the files to delete.
+        """
+        return json.dumps({
+            'files': dict(
+                (path, {'size': entry['size'], 'sha256': entry['sha256']})
+                for path, entry in self.items()
+            ),
+            'deleted': list(deleted),
+        }, indent=2, sort_keys=True)
@@ -19,3 +19,54 @@ INVALID_DB_SUBMITTED = (
     "The database dump you have uploaded contains an error. "
     "Please check the file 'db_upload.log' for errors and try again"
 )
+DOWNLOAD_INTERRUPTED = (
+    'The download was interrupted too many times ({error}). The partially '
+    'downloaded file has been kept at {path}, run the command again to '
+    'resume the download.'
+)
+DOWNLOAD_CHANGED = (
+    'The file changed on the server while it was being downloaded. '
+    'Please try again.'
+)
+DOWNLOAD_INCOMPLETE = (
+    'The downloaded file is incomplete or corrupted. Please try again.'
+)
+INVALID_MANIFEST_PATH = (
+    "The list of media files contains an invalid path: '{path}'"
+)
+CONNECTION_STATS = (
+    '{requests} HTTP requests over {connections} connections '
+    '({reused} reused)'
+)
+POLL_TIMEOUT = (
+    'Timed out while waiting for the server to finish. Please try again '
+    'later.'
+)
+SERVICE_NOT_READY = (
+    "Couldn't connect to the {service} container within {deadline}s. The "
+    "server may not have started, please check 'docker-compose logs "
+    "{service}'."
+)
+DB_DOWNLOAD_INTERRUPTED = (
+    'The download of the database was interrupted ({error}). The local '
+    'database is incomplete, please run the command again.'
+)
+DB_RESTORE_FAILED = (
+    'Importing the database failed ({command} exited with status '
+    '{returncode}).'
+)
+DB_ARCHIVE_EMPTY = 'The database archive is empty.'
+DB_STREAM_UNSUPPORTED = (
+    "The database archive holds '{name}', which is not a custom format "
+    "dump. Only custom format dumps can be imported with --stream, please "
+    "pull the database without it. The local database was not changed."
+)
+DB_DUMP_FAILED = (
+    'Dumping the local database failed (pg_dump exited with status '
+    '{returncode}). Nothing has been imported on the server.'
+)
+DB_DUMP_STREAM_REFUSED = (
+    ' ---> The server only accepts archives, uploading an archive of a '
+    'dump file instead'
+)
+DOCKER_EXEC_FAILED = 'The command in the container failed: {error}'
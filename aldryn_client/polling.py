@@ -0,0 +1,122 @@
+import random
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+import click
+
+from . import messages, settings
+
+
+def parse_retry_after(value):
+    """
+    Parse a ``Retry-After`` header (seconds or HTTP date) into seconds.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, mktime_tz(parsed) - time.time())
+
+
+class ProgressResult(dict):
+    """
+    The JSON data of a progress response together with the ``Retry-After``
+    hint the server sent along with it.
+    """
+    def __init__(self, data, retry_after=None):
+        super(ProgressResult, self).__init__(data)
+        self.retry_after = retry_after
+
+
+class PollJob(object):
+    def __init__(self, fetch, is_done, callback, interval):
+        self.fetch = fetch
+        self.is_done = is_done
+        self.callback = callback
+        self.interval = interval
+        self.next_poll = 0
+        self.result = None
+        self.done = False
+
+
+class Poller(object):
+    """
+    Polls one or more progress endpoints until all jobs are done.
+
+    Jobs are polled quickly at first and back off exponentially up to
+    ``max_interval`` for long running jobs. A ``Retry-After`` hint of the
+    server replaces the computed interval. All intervals are randomized by
+    ``jitter`` to avoid polling in lockstep. If the jobs are not done
+    before ``deadline`` seconds passed, a ``click.ClickException`` with
+    ``timeout_message`` is raised.
+    """
+    def __init__(self, initial_interval=0.25, max_interval=10, factor=1.5,
+                 jitter=0.1, deadline=settings.POLL_DEADLINE,
+                 timeout_message=messages.POLL_TIMEOUT):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.deadline = deadline
+        self.timeout_message = timeout_message
+        self.jobs = {}
+
+    def add(self, key, fetch, is_done, callback=None):
+        self.jobs[key] = PollJob(
+            fetch, is_done, callback, self.initial_interval,
+        )
+
+    def get_delay(self, job):
+        retry_after = getattr(job.result, 'retry_after', None)
+        if retry_after is not None:
+            # never poll earlier than the server asked for
+            return retry_after * random.uniform(1, 1 + self.jitter)
+        delay = job.interval
+        job.interval = min(job.interval * self.factor, self.max_interval)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self):
+        start = time.time()
+        for job in self.jobs.values():
+            job.next_poll = start + self.get_delay(job)
+
+        pending = [job for job in self.jobs.values() if not job.done]
+        while pending:
+            now = time.time()
+            if self.deadline and now - start > self.deadline:
+                raise click.ClickException(self.timeout_message)
+            next_poll = min(job.next_poll for job in pending)
+            if next_poll > now:
+                time.sleep(next_poll - now)
+                continue
+            for job in pending:
+                if job.next_poll > now:
+                    continue
+                job.result = job.fetch()
+                if job.callback:
+                    job.callback(job.result)
+                if job.is_done(job.result):
+                    job.done = True
+                else:
+                    job.next_poll = time.time() + self.get_delay(job)
+            pending = [job for job in pending if not job.done]
+        return dict((key, job.result) for key, job in self.jobs.items())
+
+
+def poll(fetch, is_done, callback=None, **kwargs):
+    """
+    Call ``fetch`` with adaptive intervals until ``is_done`` returns
+    ``True`` for its result and return that result.
+    """
+    poller = Poller(**kwargs)
+    poller.add(None, fetch, is_done, callback)
+    return poller.run()[None]
+
+
+def is_task_finished(progress):
+    """``is_done`` check for the progress of server side tasks"""
+    return progress.get('success') is not None
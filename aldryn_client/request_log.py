@@ -0,0 +1,63 @@
+import json
+import threading
+from collections import OrderedDict
+
+from .utils import pretty_size, table
+
+
+class RequestLog(object):
+    """
+    Collects timing and transfer information of API requests.
+
+    ``APIRequest`` adds one record per request once the response has been
+    processed, including any time spent streaming the response body to
+    disk. Responses streamed by the caller are added once they are closed.
+    """
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, method, url, status, ttfb, total, bytes_sent,
+            bytes_received, cached=False):
+        with self.lock:
+            self.records.append(OrderedDict((
+                ('method', method),
+                ('url', url),
+                ('status', status),
+                ('ttfb', round(ttfb, 4)),
+                ('total', round(total, 4)),
+                ('bytes_sent', bytes_sent),
+                ('bytes_received', bytes_received),
+                ('cached', cached),
+            )))
+
+    def to_json_lines(self):
+        return '\n'.join(json.dumps(record) for record in self.records)
+
+    def to_table(self):
+        groups = OrderedDict()
+        for record in self.records:
+            key = (record['method'], record['url'])
+            groups.setdefault(key, []).append(record)
+
+        rows = []
+        for (method, url), records in groups.items():
+            count = len(records)
+            rows.append((
+                method,
+                url,
+                count,
+                sum(1 for record in records if record['cached']),
+                '{:.3f}'.format(
+                    sum(record['ttfb'] for record in records) / count
+                ),
+                '{:.3f}'.format(sum(record['total'] for record in records)),
+                pretty_size(sum(record['bytes_sent'] for record in records)),
+                pretty_size(
+                    sum(record['bytes_received'] for record in records)
+                ),
+            ))
+        return table(rows, (
+            'Method', 'URL', 'Requests', 'Cached', 'Avg TTFB (s)',
+            'Total (s)', 'Sent', 'Received',
+        ))
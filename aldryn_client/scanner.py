@@ -0,0 +1,194 @@
+import os
+import stat
+import tarfile
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from . import settings
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # backport for python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    # windows
+    grp = pwd = None
+
+
+class ListdirEntry(object):
+    """
+    The part of ``os.DirEntry`` the scanner uses, for pythons without
+    ``scandir``.
+    """
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+
+def iter_directory(directory):
+    if scandir is not None:
+        return scandir(directory)
+    return (ListdirEntry(directory, name) for name in os.listdir(directory))
+
+
+class TreeEntry(namedtuple('TreeEntry',
+                           'relative_path size mtime mode uid gid inode')):
+    """
+    A file, directory or link found by ``scan_tree`` with the parts of its
+    ``lstat`` result needed to archive and index it. ``relative_path``
+    always uses forward slashes.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_stat(cls, relative_path, stat_result):
+        return cls(
+            relative_path=relative_path,
+            size=stat_result.st_size,
+            mtime=stat_result.st_mtime,
+            mode=stat_result.st_mode,
+            uid=stat_result.st_uid,
+            gid=stat_result.st_gid,
+            inode=stat_result.st_ino,
+        )
+
+    def get_path(self, directory):
+        return os.path.join(directory, *self.relative_path.split('/'))
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.mode)
+
+
+def scan_directory(path, relative_path):
+    """
+    List a single directory. Returns its entries and the paths of the
+    subdirectories to scan next.
+    """
+    entries = []
+    subdirectories = []
+    for dir_entry in iter_directory(path):
+        entry = TreeEntry.from_stat(
+            relative_path + '/' + dir_entry.name if relative_path
+            else dir_entry.name,
+            # the only stat call per entry, free on windows where the
+            # directory listing contains the stat results
+            dir_entry.stat(follow_symlinks=False),
+        )
+        entries.append(entry)
+        if entry.is_dir():
+            subdirectories.append((dir_entry.path, entry.relative_path))
+    return entries, subdirectories
+
+
+def scan_tree(directory, exclude=(), threads=None):
+    """
+    List everything below ``directory``, sorted by relative path, with
+    each entry stat'ed exactly once. Top level entries named in
+    ``exclude`` are skipped, symlinks are not followed.
+
+    Directories of the same depth are scanned on a thread pool, which
+    hides the latency of network filesystems and bind mounts.
+    """
+    if not os.path.isdir(directory):
+        return []
+    entries, level = scan_directory(directory, '')
+    entries = [
+        entry for entry in entries if entry.relative_path not in exclude
+    ]
+    level = [
+        (path, relative_path) for path, relative_path in level
+        if relative_path not in exclude
+    ]
+    pool = ThreadPool(threads or settings.SCAN_THREADS)
+    try:
+        while level:
+            results = pool.map(
+                lambda subdirectory: scan_directory(*subdirectory), level,
+            )
+            level = []
+            for directory_entries, subdirectories in results:
+                entries.extend(directory_entries)
+                level.extend(subdirectories)
+    finally:
+        pool.close()
+        pool.join()
+    entries.sort(key=lambda entry: entry.relative_path)
+    return entries
+
+
+def get_total_size(entries):
+    return sum(entry.size for entry in entries if entry.is_file())
+
+
+class TarInfoFactory(object):
+    """
+    Create ``TarInfo`` objects from ``TreeEntry`` stat results, like
+    ``TarFile.gettarinfo`` does without stat'ing the file again. User and
+    group names are looked up once per id.
+    """
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+
+    def get_user_name(self, uid):
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid)[0] if pwd else ''
+            except KeyError:
+                self.users[uid] = ''
+        return self.users[uid]
+
+    def get_group_name(self, gid):
+        if gid not in self.groups:
+            try:
+                self.groups[gid] = grp.getgrgid(gid)[0] if grp else ''
+            except KeyError:
+                self.groups[gid] = ''
+        return self.groups[gid]
+
+    def create(self, entry, path):
+        """
+        Returns ``None`` for sockets and other file types tar cannot
+        store.
+        """
+        info = tarfile.TarInfo(entry.relative_path)
+        mode = entry.mode
+        if stat.S_ISREG(mode):
+            info.type = tarfile.REGTYPE
+            info.size = entry.size
+        elif stat.S_ISDIR(mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISFIFO(mode):
+            info.type = tarfile.FIFOTYPE
+        else:
+            return None
+        info.mode = stat.S_IMODE(mode)
+        info.mtime = entry.mtime
+        info.uid = entry.uid
+        info.gid = entry.gid
+        info.uname = self.get_user_name(info.uid)
+        info.gname = self.get_group_name(info.gid)
+        return info
@@ -2,3 +2,40 @@ ACCESS_TOKEN_URL_PATH = '/account/desktop-app/access-token/'
 BOILERPLATE_CONFIG_FILENAME = 'boilerplate.json'
 ADDON_CONFIG_FILENAME = 'addon.json'
 ALDRYN_DOT_FILE = '.aldryn'
+# parallel downloads of large files, can be overridden in ~/.aldryn
+DOWNLOAD_SEGMENTS = 4
+DOWNLOAD_MIN_SEGMENT_SIZE = 32 * 1024 * 1024
+# seconds to wait before retrying an interrupted transfer, doubled for
+# every further attempt
+TRANSFER_RETRY_BACKOFF = 1
+TRANSFER_RETRY_MAX_BACKOFF = 30
+# resumable uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# HTTP connection pool size and (connect, read) timeouts in seconds
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = (15, 300)
+# on-disk cache of read-only API responses
+RESPONSE_CACHE_MAX_SIZE = 10 * 1024 * 1024
+# on-disk cache of downloaded dumps and media archives, can be overridden in
+# ~/.aldryn
+DOWNLOAD_CACHE_MAX_SIZE = 5 * 1024 * 1024 * 1024
+# give up waiting for server side tasks after this many seconds
+POLL_DEADLINE = 4 * 60 * 60
+# per project state, relative to the project home
+PROJECT_CACHE_DIR = '.aldryn-cache'
+MEDIA_INDEX_FILENAME = 'media-index.sqlite3'
+# parallel downloads of single media files
+MEDIA_DOWNLOAD_CONCURRENCY = 8
+# threads compressing archives, defaults to the number of CPUs
+COMPRESSION_THREADS = None
+# threads listing directories when scanning file trees
+SCAN_THREADS = 8
+# Docker Engine API, used instead of the docker command line client where
+# the daemon can be reached through its unix socket
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_API_VERSION = '1.24'
+DOCKER_API_TIMEOUT = 60
+# readiness probes of local services, seconds
+READINESS_INITIAL_INTERVAL = 0.05
+READINESS_MAX_INTERVAL = 1
+READINESS_DEADLINE = 60
@@ -0,0 +1,803 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from six.moves import queue
+
+import click
+import requests
+import six
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+from . import messages, settings
+
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+# errors raised while streaming a response body after the headers have been
+# received. These are worth retrying when the download can be resumed.
+DOWNLOAD_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+def get_retry_delay(attempt):
+    """
+    Seconds to wait before retry number ``attempt`` of a transfer.
+    """
+    return min(
+        settings.TRANSFER_RETRY_BACKOFF * 2 ** (attempt - 1),
+        settings.TRANSFER_RETRY_MAX_BACKOFF,
+    )
+
+
+def parse_content_range(value):
+    """
+    Parse a ``Content-Range`` header value into a ``(start, end, total)``
+    tuple. ``total`` is ``None`` if the server did not send it.
+    """
+    match = CONTENT_RANGE_RE.match((value or '').strip())
+    if not match:
+        return None
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == '*' else int(total)
+
+
+class DownloadState(object):
+    """
+    Keeps track of a partially downloaded file.
+
+    The data is written to ``<path>.part`` and a JSON sidecar
+    ``<path>.part.json`` records the validator (ETag or Last-Modified) of
+    the remote file, the number of bytes already on disk and the expected
+    total size. A later attempt uses this information to request only the
+    missing bytes.
+
+    Segmented downloads record ``segments`` instead of ``offset``, a list of
+    ``[start, end, offset]`` byte ranges and how far each of them got.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.partial_path = path + '.part'
+        self.state_path = path + '.part.json'
+        self.etag = None
+        self.last_modified = None
+        self.size = None
+        self.offset = 0
+        self.segments = None
+
+    def load(self):
+        try:
+            with open(self.state_path, 'r') as fh:
+                data = json.load(fh)
+            partial_size = os.path.getsize(self.partial_path)
+        except (IOError, OSError, ValueError):
+            self.clear()
+            return self
+
+        self.etag = data.get('etag')
+        self.last_modified = data.get('last_modified')
+        self.size = data.get('size')
+        self.offset = data.get('offset') or 0
+        self.segments = data.get('segments')
+
+        if (self.offset > partial_size or not self.validator or
+                (self.segments and not self.segments_match(partial_size))):
+            # sidecar does not match the data on disk, start over
+            self.clear()
+        return self
+
+    def segments_match(self, partial_size):
+        # the partial file of segmented downloads is preallocated
+        return partial_size == self.size and all(
+            start <= offset <= end + 1
+            for start, end, offset in self.segments
+        )
+
+    def save(self):
+        with open(self.state_path, 'w') as fh:
+            json.dump({
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'size': self.size,
+                'offset': self.offset,
+                'segments': self.segments,
+            }, fh)
+
+    def clear(self):
+        for path in (self.partial_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.etag = None
+        self.last_modified = None
+        self.size = None
+        self.offset = 0
+        self.segments = None
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.partial_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return self.path
+
+    @property
+    def validator(self):
+        # prefer strong ETags, weak ones are not allowed in If-Range
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    @property
+    def can_resume(self):
+        return bool(self.offset and self.validator)
+
+    @property
+    def is_complete(self):
+        if self.segments:
+            return all(
+                offset > end for start, end, offset in self.segments
+            )
+        return self.size is not None and self.offset == self.size
+
+    def get_range_headers(self):
+        if not self.can_resume:
+            return {}
+        return {
+            'Range': 'bytes={}-'.format(self.offset),
+            'If-Range': self.validator,
+        }
+
+    def start(self, response):
+        """
+        Prepare the partial file for the body of ``response`` and return the
+        mode the partial file has to be opened with.
+
+        A ``206 Partial Content`` response continuing at the current offset is
+        appended, anything else (e.g. the server ignored the range or the
+        remote file changed) restarts the download from scratch.
+        """
+        content_range = parse_content_range(
+            response.headers.get('Content-Range')
+        )
+        if (response.status_code == requests.codes.partial_content and
+                content_range and content_range[0] == self.offset):
+            with open(self.partial_path, 'ab') as fh:
+                # drop anything written after the last checkpoint
+                fh.truncate(self.offset)
+            if content_range[2] is not None:
+                self.size = content_range[2]
+            return 'ab'
+
+        self.clear()
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit():
+            self.size = int(content_length)
+        return 'wb'
+
+
+class StreamReader(object):
+    """
+    Read a streamed response body in large, adaptively sized chunks.
+
+    Reading straight from the connection skips the decoding layers of
+    ``iter_content`` and large chunks keep the per-chunk overhead low. The
+    chunk size starts at ``min_chunk_size`` and doubles whenever a read
+    completes within ``fast_read_time`` seconds, up to ``max_chunk_size``;
+    slow reads halve it again.
+    """
+    min_chunk_size = 64 * 1024
+    max_chunk_size = 4 * 1024 * 1024
+    fast_read_time = 0.05
+
+    def __init__(self, response):
+        self.response = response
+        self.chunk_size = self.min_chunk_size
+        self.bytes_read = 0
+        self.started = None
+        self.finished = None
+
+    def __iter__(self):
+        self.started = time.time()
+        try:
+            if ('Content-Encoding' in self.response.headers or
+                    self.response.raw is None):
+                # requests has to decode the body for us
+                chunks = self.iter_content()
+            else:
+                chunks = self.iter_raw()
+            for chunk in chunks:
+                self.bytes_read += len(chunk)
+                yield chunk
+        finally:
+            self.finished = time.time()
+
+    def iter_raw(self):
+        raw = self.response.raw
+        while True:
+            start = time.time()
+            try:
+                chunk = raw.read(self.chunk_size)
+            except urllib3_exceptions.HTTPError as e:
+                # requests only wraps these when using iter_content
+                raise requests.exceptions.ChunkedEncodingError(e)
+            if not chunk:
+                return
+            self.adapt(len(chunk), time.time() - start)
+            yield chunk
+
+    def iter_content(self):
+        for chunk in self.response.iter_content(self.max_chunk_size):
+            if chunk:  # filter out keep-alive new chunks
+                yield chunk
+
+    def adapt(self, length, duration):
+        if length < self.chunk_size:
+            return
+        if duration < self.fast_read_time:
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+        elif duration > self.fast_read_time * 4:
+            self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """Average throughput in bytes per second"""
+        if not self.elapsed:
+            return 0
+        return self.bytes_read / self.elapsed
+
+
+class ResponseReader(object):
+    """
+    A file object reading a streamed response body, e.g. for ``tarfile``
+    stream mode. Transport compression is undone and network errors are
+    raised as ``requests`` exceptions.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.response.raw.decode_content = True
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        try:
+            data = self.response.raw.read(
+                None if size is None or size < 0 else size
+            )
+        except urllib3_exceptions.HTTPError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        self.bytes_read += len(data)
+        return data
+
+
+def abort_response(response):
+    """
+    Close a streamed ``response`` and interrupt reads of its body which
+    are blocked in other threads, which closing the socket alone does not.
+    """
+    connection = getattr(response.raw, '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    response.close()
+
+
+class IterReader(object):
+    """
+    A file object reading from an iterable of byte strings.
+    """
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.pending = b''
+
+    def read(self, size=-1):
+        chunks = [self.pending]
+        length = len(self.pending)
+        while size is None or size < 0 or length < size:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            chunks.append(block)
+            length += len(block)
+        data = b''.join(chunks)
+        if size is None or size < 0:
+            self.pending = b''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        close = getattr(self.blocks, 'close', None)
+        if close:
+            close()
+
+
+def iter_in_thread(iterable, max_items=16):
+    """
+    Iterate over ``iterable`` in a worker thread and yield its items.
+
+    Producing the items (e.g. downloading, compressing) overlaps with
+    whatever the caller does with them, but at most ``max_items`` items are
+    buffered: a slow consumer blocks the producer. Errors of the producer
+    are re-raised in the consuming thread.
+    """
+    items = queue.Queue(maxsize=max_items)
+    stopped = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stopped.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    break
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            items.put(None)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        stopped.set()
+        # unblock the producer so it can terminate
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if errors:
+        raise errors[0]
+
+
+def iter_blocks(read, block_size=1024 * 1024):
+    return iter(lambda: read(block_size), b'')
+
+
+def pump(read, write, block_size=1024 * 1024, max_blocks=16):
+    """
+    Copy data from ``read`` to ``write`` with a reader thread in between.
+
+    Reading (e.g. downloading and decompressing) and writing (e.g. into the
+    stdin of a process) overlap, but at most ``max_blocks`` blocks of
+    ``block_size`` bytes are buffered, so a slow writer in turn stops the
+    reader from consuming the network connection. Returns the number of
+    bytes copied.
+    """
+    copied = 0
+    for block in iter_in_thread(iter_blocks(read, block_size), max_blocks):
+        write(block)
+        copied += len(block)
+    return copied
+
+
+def split_ranges(size, segments, min_segment_size):
+    """
+    Split ``size`` bytes into at most ``segments`` inclusive byte ranges of
+    at least ``min_segment_size`` bytes each.
+    """
+    count = max(1, min(segments, size // max(min_segment_size, 1)))
+    step = -(-size // count)  # ceil division
+    return [
+        (start, min(start + step, size) - 1)
+        for start in range(0, size, step)
+    ]
+
+
+def get_validator(response):
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def supports_segments(response, segments, min_segment_size):
+    """
+    Check whether the body of ``response`` can be fetched as several byte
+    ranges in parallel.
+    """
+    content_length = response.headers.get('Content-Length') or ''
+    return (
+        segments > 1 and
+        response.status_code == requests.codes.ok and
+        response.headers.get('Accept-Ranges', '').lower() == 'bytes' and
+        'Content-Encoding' not in response.headers and
+        content_length.isdigit() and
+        int(content_length) >= 2 * min_segment_size and
+        bool(get_validator(response))
+    )
+
+
+class SegmentedDownload(object):
+    """
+    Download a file over several connections at once.
+
+    The file is split into byte ranges which are fetched concurrently from
+    a thread pool and written at their final position into a preallocated
+    file. The already open response of the initial request is reused for
+    the first segment.
+
+    With a ``DownloadState`` the progress of every segment is saved every
+    ``checkpoint_size`` bytes, a later download of the same file continues
+    the unfinished segments. Failed segments are retried with exponential
+    backoff, once one of them gives up the others are cancelled.
+    """
+    def __init__(self, session, url, headers, path, response,
+                 segments, min_segment_size, retries=3, state=None,
+                 checkpoint_size=8 * 1024 * 1024):
+        self.session = session
+        self.url = url
+        self.headers = headers
+        self.path = path
+        self.response = response
+        self.size = int(response.headers['Content-Length'])
+        self.validator = get_validator(response)
+        self.retries = retries
+        self.state = state
+        self.checkpoint_size = checkpoint_size
+        self.resumed = bool(
+            state and state.segments and state.size == self.size and
+            state.validator == self.validator
+        )
+        if self.resumed:
+            self.ranges = [(start, end) for start, end, _ in state.segments]
+            self.offsets = [offset for _, _, offset in state.segments]
+        else:
+            self.ranges = split_ranges(self.size, segments, min_segment_size)
+            self.offsets = [start for start, _ in self.ranges]
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.unsaved = 0
+
+    def run(self):
+        partial_path = self.path + '.part'
+        if not self.resumed:
+            if self.state:
+                self.state.clear()
+                self.state.etag = self.response.headers.get('ETag')
+                self.state.last_modified = self.response.headers.get(
+                    'Last-Modified'
+                )
+                self.state.size = self.size
+                self.save_state()
+            with open(partial_path, 'wb') as fh:
+                # preallocate, segments are written at their final offset
+                fh.truncate(self.size)
+
+        fd = os.open(partial_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        pool = ThreadPool(len(self.ranges))
+        try:
+            written = pool.map(
+                lambda args: self.fetch_segment(fd, *args),
+                enumerate(self.ranges),
+            )
+        finally:
+            pool.close()
+            pool.join()
+            os.close(fd)
+            self.response.close()
+            self.save_state()
+
+        try:
+            self.verify(partial_path, written)
+        except click.ClickException:
+            if self.state:
+                # the partial file cannot be trusted anymore
+                self.state.clear()
+            raise
+        if self.state:
+            return self.state.finish()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(partial_path, self.path)
+        return self.path
+
+    def save_state(self):
+        if not self.state:
+            return
+        with self.state_lock:
+            self.state.segments = [
+                [start, end, offset]
+                for (start, end), offset in zip(self.ranges, self.offsets)
+            ]
+            self.state.save()
+            self.unsaved = 0
+
+    def update_progress(self, index, offset, size):
+        self.offsets[index] = offset
+        with self.state_lock:
+            self.unsaved += size
+            checkpoint = self.unsaved >= self.checkpoint_size
+        if checkpoint:
+            self.save_state()
+
+    def write_at(self, fd, data, offset):
+        if hasattr(os, 'pwrite'):
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+        else:
+            with self.lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+
+    def open_range(self, start, end):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes={}-{}'.format(start, end)
+        headers['If-Range'] = self.validator
+        response = self.session.request(
+            'GET', self.url, headers=headers, stream=True,
+        )
+        content_range = parse_content_range(
+            response.headers.get('Content-Range')
+        )
+        if (response.status_code != requests.codes.partial_content or
+                not content_range or content_range[0] != start):
+            response.close()
+            raise click.ClickException(messages.DOWNLOAD_CHANGED)
+        return response
+
+    def fetch_segment(self, fd, index, segment):
+        try:
+            return self.fetch_range(fd, index, segment)
+        except Exception:
+            # the download failed, stop fetching the other segments
+            self.cancelled.set()
+            raise
+
+    def fetch_range(self, fd, index, segment):
+        start, end = segment
+        offset = self.offsets[index]
+        attempt = 0
+        # the initial response streams the whole file from the start
+        response = self.response if offset == 0 else None
+        while offset <= end and not self.cancelled.is_set():
+            try:
+                if response is None:
+                    response = self.open_range(offset, end)
+                for chunk in StreamReader(response):
+                    if self.cancelled.is_set():
+                        break
+                    chunk = chunk[:end + 1 - offset]
+                    self.write_at(fd, chunk, offset)
+                    offset += len(chunk)
+                    self.update_progress(index, offset, len(chunk))
+                    if offset > end:
+                        break
+                else:
+                    if offset <= end:
+                        raise requests.exceptions.ChunkedEncodingError(
+                            'Segment ended prematurely'
+                        )
+            except DOWNLOAD_ERRORS as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise click.ClickException(self.get_error_message(e))
+                # returns early when another segment failed
+                self.cancelled.wait(get_retry_delay(attempt))
+            finally:
+                if response is not None and response is not self.response:
+                    response.close()
+                response = None
+        return offset - start
+
+    def get_error_message(self, error):
+        if self.state:
+            return messages.DOWNLOAD_INTERRUPTED.format(
+                path=self.state.partial_path, error=error,
+            )
+        return messages.NETWORK_ERROR_MESSAGE + str(error)
+
+    def verify(self, partial_path, written):
+        expected = [end - start + 1 for start, end in self.ranges]
+        if (written != expected or
+                os.path.getsize(partial_path) != self.size):
+            raise click.ClickException(messages.DOWNLOAD_INCOMPLETE)
+
+        content_md5 = self.response.headers.get('Content-MD5')
+        if content_md5:
+            md5 = hashlib.md5()
+            with open(partial_path, 'rb') as fh:
+                for block in iter(lambda: fh.read(1024 * 1024), b''):
+                    md5.update(block)
+            if base64.b64encode(md5.digest()).decode() != content_md5:
+                raise click.ClickException(messages.DOWNLOAD_INCOMPLETE)
+
+
+def get_file_size(fileobj):
+    position = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell() - position
+    fileobj.seek(position)
+    return size
+
+
+class MultipartEncoder(object):
+    """
+    A ``multipart/form-data`` request body which is read on demand.
+
+    requests builds multipart bodies in memory. This encoder instead
+    behaves like a file: the form fields and file headers are rendered up
+    front, the file contents are read in blocks of ``block_size`` bytes as
+    the body is sent, so memory usage does not depend on the file size.
+    Files can also be given as ``(filename, iterable)`` tuples to send
+    data as it is produced, the length of the body is unknown then.
+    ``callback`` is called with the number of file bytes sent after every
+    block.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, fields=None, files=None, callback=None):
+        self.boundary = uuid.uuid4().hex
+        self.callback = callback
+        self.parts = []
+        for name, value in (fields or {}).items():
+            if value is None:
+                continue
+            self.parts.append(
+                self.get_part_header(name) + self.to_bytes(value)
+            )
+        for name, fileobj in (files or {}).items():
+            if isinstance(fileobj, tuple):
+                filename, fileobj = fileobj
+            else:
+                filename = os.path.basename(getattr(fileobj, 'name', name))
+            self.parts.append(self.get_part_header(name, filename))
+            self.parts.append(fileobj)
+        self.parts.append('\r\n--{}--\r\n'.format(self.boundary).encode())
+        if all(isinstance(part, bytes) or hasattr(part, 'read')
+               for part in self.parts):
+            self.length = sum(
+                len(part) if isinstance(part, bytes) else get_file_size(part)
+                for part in self.parts
+            )
+        else:
+            # parts produced by iterators have an unknown length
+            self.length = None
+        self.iterator = self.iter_blocks()
+        self.pending = b''
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def to_bytes(self, value):
+        if isinstance(value, bytes):
+            return value
+        return six.text_type(value).encode('utf-8')
+
+    def get_part_header(self, name, filename=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        lines = []
+        if self.parts:
+            # terminate the previous part
+            lines.append('')
+        if filename is not None:
+            disposition += '; filename="{}"'.format(filename)
+        lines.extend([
+            '--{}'.format(self.boundary),
+            'Content-Disposition: {}'.format(disposition),
+        ])
+        if filename is not None:
+            lines.append('Content-Type: application/octet-stream')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+    def iter_blocks(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            if hasattr(part, 'read'):
+                blocks = iter_blocks(part.read, self.block_size)
+            else:
+                blocks = part
+            for block in blocks:
+                block = self.to_bytes(block)
+                yield block
+                if self.callback:
+                    self.callback(len(block))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iterator
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.pending = self.pending + b''.join(self.iterator), b''
+            return data
+        while len(self.pending) < size:
+            try:
+                self.pending += next(self.iterator)
+            except StopIteration:
+                break
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+class ChunkJournal(object):
+    """
+    Records which chunks of a file have already been uploaded.
+
+    The journal is stored as ``<path>.chunks.json`` next to the file. Chunks
+    are addressed by the SHA-256 digest of their content, so a changed file
+    simply produces different chunk digests.
+    """
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.journal_path = path + '.chunks.json'
+        self.chunk_size = chunk_size
+        self.completed = set()
+
+    def exists(self):
+        return os.path.exists(self.journal_path)
+
+    def load(self):
+        try:
+            with open(self.journal_path, 'r') as fh:
+                data = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return self
+        if data.get('chunk_size') == self.chunk_size:
+            self.completed = set(data.get('completed') or [])
+        return self
+
+    def save(self):
+        with open(self.journal_path, 'w') as fh:
+            json.dump({
+                'chunk_size': self.chunk_size,
+                'completed': sorted(self.completed),
+            }, fh)
+
+    def add(self, digest):
+        self.completed.add(digest)
+        self.save()
+
+    def clear(self):
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.completed = set()
+
+    def iter_chunks(self):
+        """
+        Yield ``(index, digest, data)`` for all chunks of the file.
+        """
+        with open(self.path, 'rb') as fh:
+            for index, data in enumerate(
+                    iter(lambda: fh.read(self.chunk_size), b'')):
+                yield index, hashlib.sha256(data).hexdigest(), data
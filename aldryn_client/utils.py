@@ -74,6 +74,26 @@ def redirect_stderr(new_stream):
         sys.stderr = original_stream
 
 
+def get_user_cache_dir(name=None):
+    """
+    Platform specific directory for cached data of aldryn-client, optionally
+    the subdirectory ``name`` of it. The directory is created if needed.
+    """
+    if is_windows():
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = (
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.expanduser('~/.cache')
+        )
+    path = os.path.join(base, 'aldryn-client', name or '')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
 def create_temp_dir():
     return tempfile.mkdtemp(prefix='tmp_aldryn_client_')
 
@@ -155,10 +175,10 @@ def is_windows():
     return sys.platform == 'win32'
 
 
-unit_list = zip(
+unit_list = list(zip(
         ['bytes', 'kB', 'MB', 'GB', 'TB', 'PB'],
         [0, 0, 1, 2, 2, 2],
-)
+))
 
 
 def pretty_size(num):
@@ -176,6 +196,13 @@ def pretty_size(num):
         return '1 byte'
 
 
+def pretty_rate(num_bytes, seconds):
+    """Human friendly transfer rate"""
+    if seconds <= 0:
+        return '- /s'
+    return '{}/s'.format(pretty_size(int(num_bytes / seconds)))
+
+
 def get_size(start_path):
     """
     Get size of the file or directory specified by start_path in bytes.
@@ -184,17 +211,12 @@ def get_size(start_path):
     directory - calculate total size of all the files within it
     (including subdirectories).
     """
-    # http://stackoverflow.com/a/1392549/176490
+    from .scanner import get_total_size, scan_tree
 
     if os.path.isfile(start_path):
         return os.path.getsize(start_path)
 
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for filename in filenames:
-            fp = os.path.join(dirpath, filename)
-            total_size += os.path.getsize(fp)
-    return total_size
+    return get_total_size(scan_tree(start_path))
 
 
 def get_latest_version_from_pypi():
@@ -0,0 +1,103 @@
+"""
+Compare packing a media tree into a gzip archive with the former
+``tarfile.open(mode='w:gz')`` and with ``open_tar``, which compresses on
+all CPU cores.
+
+    python tests/benchmark_compression.py [megabytes] [directory]
+
+A synthetic media tree of ``megabytes`` (2048 by default) is created in a
+temporary directory, or below ``directory``, and removed afterwards. Like
+real media it is a mix of already compressed files (random data, e.g.
+images) and compressible text files.
+"""
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aldryn_client.compression import (  # noqa: E402
+    add_entries, get_compression_threads, open_tar,
+)
+from aldryn_client.scanner import scan_tree  # noqa: E402
+
+# time.clock measures the CPU time of the process on python 2
+process_time = getattr(time, 'process_time', None) or time.clock
+
+FILE_SIZES = (4 * 1024, 64 * 1024, 512 * 1024, 4 * 1024 * 1024)
+TEXT = b''.join(
+    '{} lorem ipsum dolor sit amet, consectetur adipiscing elit\n'.format(
+        line,
+    ).encode('ascii')
+    for line in range(100000)
+)
+
+
+def create_tree(directory, size):
+    """
+    Write files of ``FILE_SIZES`` into ``directory`` until they add up to
+    ``size`` bytes, half of them of random data.
+    """
+    written = 0
+    count = 0
+    while written < size:
+        file_size = min(FILE_SIZES[count % len(FILE_SIZES)], size - written)
+        subdirectory = os.path.join(directory, '{:03d}'.format(count // 100))
+        if not os.path.isdir(subdirectory):
+            os.makedirs(subdirectory)
+        if count // len(FILE_SIZES) % 2:
+            data = os.urandom(file_size)
+        else:
+            data = (TEXT * (file_size // len(TEXT) + 1))[:file_size]
+        path = os.path.join(subdirectory, '{:06d}.dat'.format(count))
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        written += file_size
+        count += 1
+    return count
+
+
+def tarfile_gz(directory, archive_path):
+    with tarfile.open(archive_path, mode='w:gz') as tar:
+        tar.add(directory, arcname='.')
+
+
+def parallel_gz(directory, archive_path):
+    with open_tar(archive_path) as tar:
+        add_entries(tar, directory, scan_tree(directory))
+
+
+def main(megabytes=2048, directory=None):
+    size = megabytes * 1024 * 1024
+    workdir = tempfile.mkdtemp(dir=directory)
+    try:
+        media_dir = os.path.join(workdir, 'media')
+        count = create_tree(media_dir, size)
+        print('{} files, {} MB, {} compression threads'.format(
+            count, megabytes, get_compression_threads(),
+        ))
+        for pack in (tarfile_gz, parallel_gz):
+            archive_path = os.path.join(workdir, pack.__name__ + '.tar.gz')
+            cpu, wall = process_time(), time.time()
+            pack(media_dir, archive_path)
+            wall = time.time() - wall
+            print('{:<11} {:.1f}s, {:.0f} MB/s, {:.1f}s CPU, {} MB'.format(
+                pack.__name__,
+                wall,
+                megabytes / wall,
+                process_time() - cpu,
+                os.path.getsize(archive_path) // (1024 * 1024),
+            ))
+            os.remove(archive_path)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[
+        int(arg) if index == 0 else arg
+        for index, arg in enumerate(sys.argv[1:])
+    ])
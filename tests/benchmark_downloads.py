@@ -0,0 +1,89 @@
+"""
+Compare the CPU time spent on writing a download to disk with the former
+``iter_content(1024)`` loop and with ``StreamReader``.
+
+    python tests/benchmark_downloads.py [megabytes]
+
+The body is served by a separate process so that only the client side is
+measured.
+"""
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aldryn_client.transfer import StreamReader  # noqa: E402
+
+# time.clock measures the CPU time of the process on python 2
+process_time = getattr(time, 'process_time', None) or time.clock
+
+
+SERVER = '''
+import sys
+from six.moves import BaseHTTPServer
+
+SIZE = int(sys.argv[1])
+BLOCK = b'x' * 1024 * 1024
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(SIZE))
+        self.end_headers()
+        for _ in range(SIZE // len(BLOCK)):
+            self.wfile.write(BLOCK)
+
+
+server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+sys.stdout.write('{}\\n'.format(server.server_port))
+sys.stdout.flush()
+server.serve_forever()
+'''
+
+
+def iter_content(response, fh):
+    for chunk in response.iter_content(chunk_size=1024):
+        if chunk:
+            fh.write(chunk)
+            fh.flush()
+
+
+def stream_reader(response, fh):
+    for chunk in StreamReader(response):
+        fh.write(chunk)
+
+
+def main(megabytes=1024):
+    size = megabytes * 1024 * 1024
+    server = subprocess.Popen(
+        [sys.executable, '-c', SERVER, str(size)], stdout=subprocess.PIPE,
+    )
+    try:
+        url = 'http://127.0.0.1:{}/'.format(
+            int(server.stdout.readline().strip())
+        )
+        for download in (iter_content, stream_reader):
+            response = requests.get(url, stream=True)
+            cpu, wall = process_time(), time.time()
+            with open(os.devnull, 'wb') as fh:
+                download(response, fh)
+            cpu = process_time() - cpu
+            print('{:<14} {:.2f}s CPU/GB, {:.0f} MB/s'.format(
+                download.__name__,
+                cpu * 1024 / megabytes,
+                megabytes / (time.time() - wall),
+            ))
+    finally:
+        server.kill()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
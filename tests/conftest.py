@@ -0,0 +1,124 @@
+import email
+import json
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+from aldryn_client import settings
+from aldryn_client.cloud import CloudClient
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up early are part of the tests
+        pass
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Base class of the request handlers of stand-in servers, records the
+    requests it receives in ``server.requests``.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def record(self):
+        self.server.requests.append((self.command, self.path, self.headers))
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(
+                int(self.headers.get('Content-Length') or 0)
+            )
+        body = b''
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+            if not size:
+                return body
+
+    def read_multipart(self):
+        """
+        Return the files of a multipart request body as a dictionary of
+        ``(filename, data)`` tuples by field name.
+        """
+        parse = getattr(
+            email, 'message_from_bytes', email.message_from_string,
+        )
+        message = parse(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() +
+            b'\r\n\r\n' + self.read_body()
+        )
+        return dict(
+            (part.get_param('name', header='Content-Disposition'), (
+                part.get_filename(), part.get_payload(decode=True),
+            ))
+            for part in message.get_payload()
+        )
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode('utf-8'), status, [
+            ('Content-Type', 'application/json'),
+        ])
+
+    def send_body(self, body, status=200, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def drop_connection(self):
+        self.wfile.flush()
+        self.connection.shutdown(2)
+        self.close_connection = True
+
+
+@pytest.fixture
+def serve():
+    """
+    Start a stand-in HTTP server for a ``StandInHandler`` subclass and
+    return it, ``server.url`` is its base URL.
+    """
+    servers = []
+
+    def start(handler_class):
+        server = StandInServer(('127.0.0.1', 0), handler_class)
+        server.requests = []
+        server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def client(tmpdir, monkeypatch):
+    """
+    Return a function creating a ``CloudClient`` for a stand-in server,
+    with a temporary home directory.
+    """
+    monkeypatch.setenv('HOME', str(tmpdir.mkdir('home')))
+
+    def create(server):
+        return CloudClient(server.url, use_cache=False)
+    return create
+
+
+@pytest.fixture(autouse=True)
+def no_retry_backoff(monkeypatch):
+    monkeypatch.setattr(settings, 'TRANSFER_RETRY_BACKOFF', 0.01)
+    monkeypatch.setattr(settings, 'TRANSFER_RETRY_MAX_BACKOFF', 0.01)
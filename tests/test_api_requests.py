@@ -0,0 +1,239 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+
+import click
+import pytest
+
+from aldryn_client import api_requests, settings
+from aldryn_client.cache import DownloadCache
+from aldryn_client.transfer import get_retry_delay, split_ranges
+
+from conftest import StandInHandler
+
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class RangeHandler(StandInHandler):
+    """
+    Serves ``DATA`` with byte range support. ``actions`` scripts what
+    happens to the next requests: ``'truncate'`` sends half of the body,
+    ``'refuse'`` closes the connection without a response. All range
+    requests or those starting at ``refuse_start`` are refused, bodies are
+    cut off after ``limit`` bytes and sent in blocks ``delay`` seconds
+    apart. With ``gzip``, bodies are gzip encoded for clients accepting
+    it, like web servers compressing responses on the fly do.
+    """
+    actions = []
+    refuse_ranges = False
+    refuse_start = None
+    limit = None
+    delay = 0
+    gzip = False
+
+    def do_GET(self):
+        self.record()
+        action = self.actions.pop(0) if self.actions else None
+        start, end, status = 0, len(DATA) - 1, 200
+        if self.headers.get('Range'):
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            start, end, status = int(first), int(last or end), 206
+            if self.refuse_ranges or start == self.refuse_start:
+                action = 'refuse'
+        if action == 'refuse':
+            self.drop_connection()
+            return
+        body = DATA[start:end + 1]
+        encode = (
+            self.gzip and
+            'gzip' in self.headers.get('Accept-Encoding', '')
+        )
+        if encode:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as fh:
+                fh.write(body)
+            body = buf.getvalue()
+        self.send_response(status)
+        if encode:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(DATA),
+            ))
+        self.end_headers()
+        limit = len(body) // 2 if action == 'truncate' else self.limit
+        sent = body if limit is None else body[:limit]
+        for position in range(0, len(sent), 64 * 1024):
+            self.wfile.write(sent[position:position + 64 * 1024])
+            time.sleep(self.delay)
+        if limit is not None:
+            self.drop_connection()
+
+
+@pytest.fixture
+def range_server(serve):
+    def start(*actions, **options):
+        options['actions'] = list(actions)
+        handler = type('Handler', (RangeHandler,), options)
+        server = serve(handler)
+        return server, api_requests.SingleHostSession(server.url)
+    return start
+
+
+def read(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def test_retry_delay_backs_off_exponentially(monkeypatch):
+    monkeypatch.setattr(settings, 'TRANSFER_RETRY_BACKOFF', 1)
+    monkeypatch.setattr(settings, 'TRANSFER_RETRY_MAX_BACKOFF', 5)
+    assert [get_retry_delay(attempt) for attempt in range(1, 6)] == [
+        1, 2, 4, 5, 5,
+    ]
+
+
+def test_resume_after_truncated_body(range_server, tmpdir):
+    server, session = range_server('truncate')
+    path = api_requests.DownloadDBRequest(
+        session, url='/db', directory=str(tmpdir),
+    )()
+    assert read(path) == DATA
+    ranges = [headers.get('Range') for _, _, headers in server.requests]
+    assert ranges[0] is None
+    assert ranges[1].startswith('bytes=')
+
+
+def test_resume_retries_failed_reconnects(range_server, tmpdir):
+    server, session = range_server('truncate', 'refuse', 'refuse')
+    path = api_requests.DownloadDBRequest(
+        session, url='/db', directory=str(tmpdir),
+    )()
+    assert read(path) == DATA
+    assert len(server.requests) == 4
+
+
+def test_resume_gives_up_after_retries(range_server, tmpdir):
+    server, session = range_server('truncate', *['refuse'] * 10)
+    request = api_requests.DownloadDBRequest(
+        session, url='/db', directory=str(tmpdir),
+    )
+    with pytest.raises(click.ClickException):
+        request()
+    assert len(server.requests) == 1 + request.download_retries
+    # the partial file is kept for a later attempt
+    assert os.path.exists(request.download_state.partial_path)
+
+
+def test_download_without_content_encoding(range_server, tmpdir):
+    server, session = range_server(gzip=True)
+    path = api_requests.DownloadDBRequest(
+        session, url='/db', directory=str(tmpdir),
+    )()
+    assert read(path) == DATA
+    [(_, _, headers)] = server.requests
+    assert headers['Accept-Encoding'] == 'identity'
+
+
+def test_network_error():
+    session = api_requests.SingleHostSession('http://127.0.0.1:1')
+    with pytest.raises(click.ClickException) as exc_info:
+        api_requests.UploadDBProgressRequest(session, url='/progress/')()
+    assert exc_info.value.message.startswith(
+        api_requests.messages.NETWORK_ERROR_MESSAGE
+    )
+
+
+class BackupHandler(StandInHandler):
+    """
+    Serves ``server.body`` with a strong ETag naming its content.
+    """
+    def do_GET(self):
+        self.record()
+        self.send_body(self.server.body, headers=[
+            ('ETag', '"{}"'.format(
+                hashlib.sha256(self.server.body).hexdigest()
+            )),
+        ])
+
+
+def test_download_keeps_cached_files(serve, tmpdir):
+    server = serve(BackupHandler)
+    session = api_requests.SingleHostSession(server.url)
+    session.download_cache = DownloadCache(str(tmpdir.mkdir('cache')), 2 ** 30)
+
+    def download(body):
+        server.body = body
+        return read(api_requests.DownloadBackupRequest(
+            session, url_kwargs={'website_slug': 'slug'},
+            directory=str(tmpdir),
+        )())
+
+    assert download(b'first') == b'first'
+    # replaces the file linked into the cache
+    assert download(b'second') == b'second'
+    assert download(b'first') == b'first'
+    assert len(server.requests) == 3
+    assert sorted(
+        path.read_binary() for path in tmpdir.join('cache').listdir()
+    ) == [b'first', b'second']
+
+
+def download_segmented(session, tmpdir):
+    return api_requests.DownloadDBRequest(
+        session, url='/db', directory=str(tmpdir),
+        segments=3, min_segment_size=1024 * 1024,
+    )
+
+
+def test_segmented_download_without_content_encoding(range_server, tmpdir):
+    server, session = range_server(gzip=True)
+    path = download_segmented(session, tmpdir)()
+    assert read(path) == DATA
+    assert len(server.requests) == 3
+    for _, _, headers in server.requests:
+        assert headers['Accept-Encoding'] == 'identity'
+
+
+def test_segmented_download_retries_segments(range_server, tmpdir):
+    server, session = range_server(None, 'truncate', 'refuse')
+    path = download_segmented(session, tmpdir)()
+    assert read(path) == DATA
+    assert len(server.requests) == 5
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_segmented_download_resumes_segments(range_server, tmpdir):
+    server, session = range_server(limit=256 * 1024, refuse_ranges=True)
+    request = download_segmented(session, tmpdir)
+    with pytest.raises(click.ClickException):
+        request()
+    with open(request.download_state.state_path) as fh:
+        segments = json.load(fh)['segments']
+    assert len(segments) == 3
+    assert segments[0][2] == 256 * 1024
+
+    server, session = range_server()
+    path = download_segmented(session, tmpdir)()
+    assert read(path) == DATA
+    ranges = [headers.get('Range') for _, _, headers in server.requests]
+    assert sorted(ranges[1:]) == sorted(
+        'bytes={}-{}'.format(offset, end) for _, end, offset in segments
+    )
+
+
+def test_segmented_download_cancels_segments(range_server, tmpdir):
+    last_segment = split_ranges(len(DATA), 3, 1024 * 1024)[-1]
+    server, session = range_server(refuse_start=last_segment[0], delay=0.1)
+    start = time.time()
+    with pytest.raises(click.ClickException):
+        download_segmented(session, tmpdir)()
+    # the other segments would take more than 1.6s to complete
+    assert time.time() - start < 1
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import re
+
+import click
+import pytest
+from six.moves.urllib_parse import parse_qs
+
+from aldryn_client import settings
+
+from conftest import StandInHandler
+
+
+CHUNK_RE = re.compile(
+    r'^/api/v1/website/(\d+)/upload/(db|media)/chunks/([0-9a-f]{64})/$'
+)
+COMMIT_RE = re.compile(r'^/api/v1/website/(\d+)/upload/(db|media)/commit/$')
+
+
+class ChunkHandler(StandInHandler):
+    """
+    Implements the chunk and commit endpoints of chunked uploads. Chunks
+    are kept in ``server.chunks``, committed archives in
+    ``server.archives``. The chunk uploads listed in ``fail`` (counting
+    from 0) answer with a server error.
+    """
+    fail = ()
+
+    def do_PUT(self):
+        self.record()
+        match = CHUNK_RE.match(self.path)
+        data = self.read_body()
+        if not match:
+            return self.send_json({}, 404)
+        digest = match.group(3)
+        puts = len([r for r in self.server.requests if r[0] == 'PUT'])
+        if puts - 1 in self.fail:
+            return self.send_json({}, 500)
+        if (hashlib.sha256(data).hexdigest() != digest or
+                self.headers.get('X-Checksum-SHA256') != digest):
+            return self.send_json({'message': 'checksum mismatch'}, 400)
+        self.server.chunks[digest] = data
+        self.send_body(b'OK')
+
+    def do_POST(self):
+        self.record()
+        match = COMMIT_RE.match(self.path)
+        form = parse_qs(self.read_body().decode('utf-8'))
+        if not match:
+            return self.send_json({}, 404)
+        missing = [
+            digest for digest in form['chunks']
+            if digest not in self.server.chunks
+        ]
+        if missing:
+            return self.send_json({'missing': missing}, 400)
+        archive = b''.join(
+            self.server.chunks[digest] for digest in form['chunks']
+        )
+        if len(archive) != int(form['size'][0]):
+            return self.send_json({'message': 'size mismatch'}, 400)
+        self.server.archives[match.group(2)] = (form['filename'][0], archive)
+        self.send_json({'upload_progress_url': '/progress/'})
+
+
+@pytest.fixture
+def chunk_server(serve, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_CHUNK_SIZE', 1024)
+
+    def start(**options):
+        server = serve(type('Handler', (ChunkHandler,), options))
+        server.chunks = {}
+        server.archives = {}
+        return server
+    return start
+
+
+@pytest.fixture
+def archive(tmpdir):
+    path = str(tmpdir.join('local_db.tar.gz'))
+    # the repeated block produces the same chunk twice
+    block = os.urandom(1024)
+    with open(path, 'wb') as fh:
+        fh.write(os.urandom(2048) + block + block + os.urandom(100))
+    return path
+
+
+def read(path):
+    with open(path, 'rb') as fh:
+        return fh.read()
+
+
+def get_chunk_puts(server):
+    return [path for method, path, _ in server.requests if method == 'PUT']
+
+
+def test_upload_chunks(chunk_server, client, archive):
+    server = chunk_server()
+    uploaded = []
+    response = client(server).upload_db_chunked(
+        1, archive, progress_callback=uploaded.append,
+    )
+    assert response == {'upload_progress_url': '/progress/'}
+    assert server.archives['db'] == ('local_db.tar.gz', read(archive))
+    assert sum(uploaded) == os.path.getsize(archive)
+    # the repeated chunk is only uploaded once
+    assert len(get_chunk_puts(server)) == 4
+    assert not os.path.exists(archive + '.chunks.json')
+
+
+def test_upload_chunks_resumes(chunk_server, client, archive):
+    server = chunk_server(fail=(2,))
+    with pytest.raises(click.ClickException):
+        client(server).upload_media_chunked(1, archive)
+    assert len(server.chunks) == 2
+    assert os.path.exists(archive + '.chunks.json')
+
+    uploaded = get_chunk_puts(server)
+    client(server).upload_media_chunked(1, archive)
+    assert server.archives['media'][1] == read(archive)
+    retried = get_chunk_puts(server)[len(uploaded):]
+    # the chunks which arrived before the error are not sent again
+    assert not set(retried) & set(uploaded[:2])
+    assert len(retried) == 2
+    assert not os.path.exists(archive + '.chunks.json')
+
+
+def test_upload_chunks_restarts_for_changed_chunk_size(
+        chunk_server, client, archive, monkeypatch):
+    server = chunk_server(fail=(1,))
+    with pytest.raises(click.ClickException):
+        client(server).upload_db_chunked(1, archive)
+
+    monkeypatch.setattr(settings, 'UPLOAD_CHUNK_SIZE', 2048)
+    client(server).upload_db_chunked(1, archive)
+    assert server.archives['db'][1] == read(archive)
+    assert len(get_chunk_puts(server)) == 2 + 3
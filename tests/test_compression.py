@@ -0,0 +1,158 @@
+import gzip
+import io
+import os
+import subprocess
+import sys
+import tarfile
+
+import pytest
+
+from aldryn_client import compression
+from aldryn_client.compression import ParallelGzipWriter, iter_tar_file
+
+
+@pytest.mark.parametrize('size', [0, 1, 512, 10000, 3 * 1024 * 1024 + 7])
+def test_iter_tar_file(tmpdir, size):
+    path = tmpdir.join('local_db.sql')
+    data = os.urandom(size)
+    path.write_binary(data)
+    blocks = list(iter_tar_file(str(path), 'local_db.sql', block_size=4096))
+    assert max(len(block) for block in blocks) <= 4096 + 2 * 10240
+    archive = b''.join(blocks)
+    assert len(archive) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        [member] = tar.getmembers()
+        assert member.name == 'local_db.sql'
+        assert tar.extractfile(member).read() == data
+
+
+@pytest.mark.parametrize('size', [0, 1, 4096, 10 * 4096 + 7])
+@pytest.mark.parametrize('compresslevel', [0, 6])
+def test_parallel_gzip_writer(size, compresslevel):
+    data = os.urandom(size // 2) + b'x' * (size - size // 2)
+    buf = io.BytesIO()
+    with ParallelGzipWriter(buf, compresslevel=compresslevel,
+                            block_size=4096, threads=3) as writer:
+        # writes which do not line up with the blocks
+        for position in range(0, size, 1000):
+            writer.write(data[position:position + 1000])
+    buf.seek(0)
+    assert gzip.GzipFile(fileobj=buf).read() == data
+
+
+def test_parallel_gzip_writer_tar():
+    data = os.urandom(10000)
+    buf = io.BytesIO()
+    with ParallelGzipWriter(buf, compresslevel=0, block_size=4096) as writer:
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            info = tarfile.TarInfo('local_db.sql')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    with tarfile.open(fileobj=buf, mode='r:gz') as tar:
+        assert tar.extractfile('local_db.sql').read() == data
+
+
+def get_member(name, type=tarfile.REGTYPE, linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    return info
+
+
+@pytest.mark.parametrize('extraction_filter', [
+    pytest.param('data', marks=pytest.mark.skipif(
+        not hasattr(tarfile, 'data_filter'),
+        reason='tarfile has no extraction filters',
+    )),
+    None,
+])
+@pytest.mark.parametrize('member', [
+    get_member('../outside'),
+    get_member('/outside'),
+    get_member('a/../../outside'),
+    get_member('link', tarfile.SYMTYPE, '../outside'),
+    get_member('link', tarfile.SYMTYPE, '/etc/passwd'),
+    get_member('link', tarfile.LNKTYPE, '../outside'),
+], ids=['parent', 'absolute', 'nested', 'symlink', 'symlink_absolute',
+        'hardlink'])
+def test_extract_members_unsafe(tmpdir, monkeypatch, extraction_filter,
+                                member):
+    monkeypatch.setattr(compression, 'EXTRACTION_FILTER', extraction_filter)
+    tmpdir.join('outside').write_binary(b'keep')
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        tar.addfile(get_member('a.txt'), io.BytesIO())
+        tar.addfile(member, io.BytesIO())
+        tar.addfile(get_member('outside'), io.BytesIO())
+    buf.seek(0)
+    target = tmpdir.mkdir('media')
+    with tarfile.open(fileobj=buf) as tar:
+        if extraction_filter and member.name == '/outside':
+            # the data filter strips the leading slash instead
+            compression.extract_members(tar, str(target))
+        else:
+            with pytest.raises(tarfile.TarError):
+                compression.extract_members(tar, str(target))
+            assert [path.basename for path in target.listdir()] == ['a.txt']
+    assert tmpdir.join('outside').read_binary() == b'keep'
+
+
+@pytest.mark.parametrize('extraction_filter', [
+    pytest.param('data', marks=pytest.mark.skipif(
+        not hasattr(tarfile, 'data_filter'),
+        reason='tarfile has no extraction filters',
+    )),
+    None,
+])
+def test_extract_members_links(tmpdir, monkeypatch, extraction_filter):
+    monkeypatch.setattr(compression, 'EXTRACTION_FILTER', extraction_filter)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        info = get_member('b/c.txt')
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b'c'))
+        tar.addfile(get_member('b/link', tarfile.SYMTYPE, 'c.txt'))
+        tar.addfile(get_member('d', tarfile.SYMTYPE, 'b/../b/c.txt'))
+        tar.addfile(get_member('e', tarfile.LNKTYPE, 'b/c.txt'))
+    buf.seek(0)
+    target = tmpdir.mkdir('media')
+    with tarfile.open(fileobj=buf) as tar:
+        compression.extract_members(tar, str(target))
+    for name in ('b/link', 'd', 'e'):
+        assert target.join(name).read_binary() == b'c'
+
+
+# Reads a stream of a million members with iter_members and prints how much
+# the peak memory of the process grew, in kilobytes.
+READ_MILLION_MEMBERS = '''
+import itertools
+import resource
+import tarfile
+
+from aldryn_client.compression import iter_members, open_tar_stream
+from aldryn_client.transfer import IterReader
+
+header = tarfile.TarInfo('media/0000000.jpg').tobuf()
+blocks = itertools.chain(
+    itertools.repeat(header * 1000, 1000), [b'\\0' * 1024],
+)
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+with open_tar_stream(IterReader(blocks)) as tar:
+    count = sum(1 for _ in iter_members(tar))
+assert count == 1000000, count
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+'''
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith('linux'),
+    reason='ru_maxrss is in kilobytes on linux only',
+)
+def test_iter_members_memory():
+    # a TarFile keeping every member needs over a gigabyte for this
+    output = subprocess.check_output(
+        [sys.executable, '-c', READ_MILLION_MEMBERS],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    assert int(output) < 50 * 1024
@@ -0,0 +1,190 @@
+import json
+import struct
+import subprocess
+import threading
+
+import pytest
+from six.moves import socketserver
+
+from aldryn_client.localdev import docker_api, utils
+
+from conftest import StandInHandler
+
+
+class DaemonHandler(StandInHandler):
+    """
+    Implements the parts of the Docker Engine API used for exec sessions.
+    Sessions write ``server.frames`` and echo their stdin, then exit with
+    ``server.exit_code``. ``server.errors`` maps the names of endpoints
+    (``create``, ``start`` and ``inspect``) to the status they fail with.
+    Containers publish ``server.ports``.
+    """
+    def fail(self, endpoint):
+        status = self.server.errors.get(endpoint)
+        if status:
+            self.send_json({'message': '{} failed'.format(endpoint)}, status)
+        return status
+
+    def do_GET(self):
+        self.record()
+        path = self.path.split('?')[0].split('/')[2:]
+        if path == ['_ping']:
+            return self.send_body(b'OK', headers=[
+                ('Content-Type', 'text/plain'),
+            ])
+        if path[0] == 'exec' and not self.fail('inspect'):
+            self.send_json(self.server.execs[path[1]])
+        elif path[0] == 'containers':
+            self.send_json({
+                'State': {'Running': True},
+                'NetworkSettings': {'Ports': self.server.ports},
+            })
+
+    def do_POST(self):
+        self.record()
+        path = self.path.split('/')[2:]
+        body = json.loads(self.read_body().decode('utf-8'))
+        if path[0] == 'containers' and not self.fail('create'):
+            exec_id = str(len(self.server.execs))
+            self.server.execs[exec_id] = {'Running': False, 'ExitCode': None}
+            self.server.stdin[exec_id] = body['AttachStdin']
+            self.send_json({'Id': exec_id}, 201)
+        elif path[0] == 'exec' and not self.fail('start'):
+            self.start_exec(path[1])
+
+    def start_exec(self, exec_id):
+        self.server.execs[exec_id]['Running'] = True
+        # the first frames arrive together with the response head
+        self.wfile.write(
+            b'HTTP/1.1 101 UPGRADED\r\n'
+            b'Content-Type: application/vnd.docker.raw-stream\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Upgrade: tcp\r\n'
+            b'\r\n' + b''.join(
+                get_frame(stream, data) for stream, data in self.server.frames
+            )
+        )
+        if self.server.stdin[exec_id]:
+            data = self.rfile.read()
+            # split into frames smaller than the blocks read by the client
+            for start in range(0, len(data), 1000):
+                self.wfile.write(
+                    get_frame(docker_api.STDOUT, data[start:start + 1000])
+                )
+        self.server.execs[exec_id] = {
+            'Running': False, 'ExitCode': self.server.exit_code,
+        }
+        self.close_connection = True
+
+
+class FakeDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+def get_frame(stream, data):
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+@pytest.fixture
+def daemon(tmpdir, monkeypatch):
+    server = FakeDaemon(str(tmpdir.join('docker.sock')), DaemonHandler)
+    server.requests = []
+    server.execs = {}
+    server.stdin = {}
+    server.frames = []
+    server.exit_code = 0
+    server.errors = {}
+    server.ports = {}
+    monkeypatch.setenv(
+        'DOCKER_HOST', 'unix://{}'.format(server.server_address),
+    )
+    monkeypatch.setattr(docker_api, 'CLIENTS', {})
+    # print the docker exec command the API falls back to
+    get_exec_command = utils.get_exec_command
+    monkeypatch.setattr(
+        utils, 'get_exec_command',
+        lambda *args, **kwargs: ['echo'] + get_exec_command(*args, **kwargs),
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_exec_output(daemon, tmpdir):
+    daemon.frames = [
+        (docker_api.STDOUT, b'out'),
+        (docker_api.STDERR, b'err'),
+        (docker_api.STDOUT, b'x' * 200000),
+    ]
+    daemon.exit_code = 3
+    with tmpdir.join('stderr').open('wb') as stderr:
+        process = utils.docker_exec(
+            'db', ['ls'], stdout=subprocess.PIPE, stderr=stderr,
+        )
+        assert process.stdout.read() == b'out' + b'x' * 200000
+        assert process.wait() == 3
+    assert tmpdir.join('stderr').read_binary() == b'err'
+
+
+def test_exec_output_merged(daemon, tmpdir):
+    daemon.frames = [
+        (docker_api.STDOUT, b'out'),
+        (docker_api.STDERR, b'err'),
+        (docker_api.STDOUT, b'out'),
+    ]
+    assert utils.exec_check_output(
+        'db', ['ls'], stderr=subprocess.STDOUT,
+    ) == 'outerrout'
+    with tmpdir.join('output').open('wb') as output:
+        assert utils.exec_call(
+            'db', ['ls'], stdout=output, stderr=subprocess.STDOUT,
+        ) == 0
+    assert tmpdir.join('output').read_binary() == b'outerrout'
+
+
+def test_exec_input(daemon):
+    data = bytes(bytearray(range(256))) * 1000
+    process = utils.docker_exec(
+        'db', ['cat'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    process.stdin.write(data)
+    process.stdin.close()
+    assert process.stdout.read() == data
+    assert process.wait() == 0
+
+
+@pytest.mark.parametrize('endpoint', ['create', 'start'])
+@pytest.mark.parametrize('status', [404, 409, 500])
+def test_exec_falls_back_to_cli(daemon, endpoint, status):
+    daemon.errors[endpoint] = status
+    assert utils.exec_check_output('db', ['ls']) == 'docker exec db ls\n'
+
+
+def test_exec_daemon_error(daemon, tmpdir):
+    daemon.errors['inspect'] = 500
+    with tmpdir.join('stderr').open('wb') as stderr:
+        with pytest.raises(subprocess.CalledProcessError) as exc_info:
+            utils.run_exec_check_call('db', ['ls'], stderr=stderr)
+    assert exc_info.value.returncode == 1
+    assert b'inspect failed' in tmpdir.join('stderr').read_binary()
+
+
+@pytest.mark.parametrize('host_ips,host', [
+    (['0.0.0.0'], '0.0.0.0'),
+    (['127.0.0.1'], '127.0.0.1'),
+    (['::', '0.0.0.0'], '0.0.0.0'),
+    (['::'], '0.0.0.0'),
+    ([''], '0.0.0.0'),
+])
+def test_get_port(daemon, host_ips, host):
+    daemon.ports = {'80/tcp': [
+        {'HostIp': host_ip, 'HostPort': '8000'} for host_ip in host_ips
+    ]}
+    assert docker_api.get_client().get_port('web', 80) == (host, 8000)
+    assert docker_api.get_client().get_port('web', 81) is None
@@ -0,0 +1,335 @@
+import gzip
+import io
+import os
+import subprocess
+import tarfile
+
+import click
+import pytest
+
+from aldryn_client import utils as aldryn_utils
+from aldryn_client.localdev import main, readiness, utils
+
+from conftest import StandInHandler
+
+
+def make_archive(name, data):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        if name is not None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+DUMP = b'PGDMP' + os.urandom(1024 * 1024)
+ARCHIVE = make_archive('db.dump', DUMP)
+
+
+class ArchiveHandler(StandInHandler):
+    """
+    Serves ``archive``, cut off after ``limit`` bytes.
+    """
+    archive = ARCHIVE
+    limit = None
+
+    def do_GET(self):
+        self.record()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.archive)))
+        self.end_headers()
+        self.wfile.write(self.archive[:self.limit])
+        if self.limit is not None:
+            self.drop_connection()
+
+
+@pytest.fixture
+def local_exec(monkeypatch, tmpdir):
+    """
+    Run the commands meant for a container as the local shell command
+    ``command``, which gets the original command as ``$@``. Paths in
+    ``/app/`` refer to ``tmpdir``.
+    """
+    def patch(command='"$@"'):
+        def docker_exec(container_id, args, **kwargs):
+            args = [
+                arg.replace('/app/', str(tmpdir) + '/')
+                for arg in [command, 'sh'] + list(args)
+            ]
+            return subprocess.Popen(['/bin/sh', '-c'] + args, **kwargs)
+        monkeypatch.setattr(utils, 'docker_exec', docker_exec)
+    return patch
+
+
+@pytest.fixture
+def archive_response(serve, client):
+    def get(**options):
+        server = serve(type('Handler', (ArchiveHandler,), options))
+        return client(server).download_db_stream(
+            'slug', url=server.url + '/db.tar.gz',
+        )
+    return get
+
+
+def test_restore_db_from_stream(local_exec, archive_response, tmpdir):
+    restored = tmpdir.join('restored')
+    local_exec('cat > {}'.format(restored))
+    main.restore_db_from_stream('db', archive_response())
+    assert restored.read_binary() == DUMP
+
+
+def test_restore_db_from_stream_interrupted(local_exec, archive_response):
+    local_exec('cat > /dev/null')
+    with pytest.raises(click.ClickException) as exc_info:
+        main.restore_db_from_stream(
+            'db', archive_response(limit=len(ARCHIVE) // 2),
+        )
+    assert 'interrupted' in exc_info.value.message
+
+
+def test_restore_db_from_stream_failed(local_exec, archive_response):
+    local_exec('head -c 10 > /dev/null; exit 3')
+    with pytest.raises(click.ClickException) as exc_info:
+        main.restore_db_from_stream('db', archive_response())
+    assert 'status 3' in exc_info.value.message
+
+
+# stand in for pg_restore, which refuses plain SQL dumps, and psql, both
+# failing if /app/fail exists, copy the dump to /app/restored
+FAKE_RESTORE = '''
+restore() {
+    [ -e /app/fail ] && exit 2
+    for arg; do dump=$arg; done
+    echo "$@" > /app/args
+    cp "$dump" /app/restored
+}
+pg_restore() {
+    for arg; do dump=$arg; done
+    [ "$(head -c 5 "$dump")" = PGDMP ] || exit 1
+    restore pg_restore "$@"
+}
+psql() {
+    restore psql "$@"
+}
+"$@"
+'''
+
+
+@pytest.mark.parametrize('name,data', [
+    ('db.sql', b'-- plain dump\n'),
+    # directory dumps start with their table of contents
+    ('db/toc.dat', b'PGDMP toc'),
+], ids=['plain', 'directory'])
+def test_restore_db_from_stream_unsupported(local_exec, archive_response,
+                                            monkeypatch, name, data):
+    local_exec('cat > /dev/null')
+    monkeypatch.setattr(main, 'reset_local_db', pytest.fail)
+    with pytest.raises(click.ClickException) as exc_info:
+        main.restore_db_from_stream(
+            'db', archive_response(archive=make_archive(name, data)),
+            reset=True,
+        )
+    assert exc_info.value.message == (
+        main.messages.DB_STREAM_UNSUPPORTED.format(name=name)
+    )
+
+
+def test_restore_db_from_stream_reset(local_exec, archive_response,
+                                      monkeypatch, tmpdir):
+    restored = tmpdir.join('restored')
+    local_exec('cat > {}'.format(restored))
+    reset = []
+    monkeypatch.setattr(main, 'reset_local_db', reset.append)
+    main.restore_db_from_stream('db', archive_response(), reset=True)
+    assert reset == ['db']
+    assert restored.read_binary() == DUMP
+
+
+@pytest.fixture
+def restore_archive(local_exec, monkeypatch, tmpdir):
+    """
+    Restore an archive in ``tmpdir``, return the command the dump was
+    restored with.
+    """
+    local_exec(FAKE_RESTORE)
+    restore_dir = tmpdir.join('restore')
+    monkeypatch.setattr(main, 'RESTORE_DIR', str(restore_dir))
+
+    def restore(archive):
+        tmpdir.join('db.tar.gz').write_binary(archive)
+        try:
+            main.restore_db_from_archive('db', '/db.tar.gz', jobs=2)
+        finally:
+            assert not restore_dir.exists()
+        return tmpdir.join('args').read().split()
+    return restore
+
+
+def test_restore_db_from_archive_custom(restore_archive, tmpdir):
+    args = restore_archive(ARCHIVE)
+    assert tmpdir.join('restored').read_binary() == DUMP
+    assert args[0] == 'pg_restore'
+    assert '--jobs=2' in args
+
+
+def test_restore_db_from_archive_plain(restore_archive, tmpdir):
+    dump = b'-- plain dump\n' * 1000
+    args = restore_archive(make_archive('db.sql', dump))
+    # restored from the extracted file without parallel jobs
+    assert tmpdir.join('restored').read_binary() == dump
+    assert args[:3] == ['psql', '-v', 'ON_ERROR_STOP=1']
+    assert args[-1].endswith('/db.sql')
+
+
+@pytest.mark.parametrize('name,data', [
+    ('db.dump', DUMP), ('db.sql', b'-- plain dump\n'),
+], ids=['custom', 'plain'])
+def test_restore_db_from_archive_failed(restore_archive, tmpdir, name, data):
+    tmpdir.join('fail').write('')
+    with pytest.raises(click.ClickException) as exc_info:
+        restore_archive(make_archive(name, data))
+    assert 'status 2' in exc_info.value.message
+
+
+def test_restore_db_from_archive_empty(restore_archive, tmpdir):
+    with pytest.raises(click.ClickException) as exc_info:
+        restore_archive(make_archive(None, None))
+    assert exc_info.value.message == main.messages.DB_ARCHIVE_EMPTY
+
+
+# stands in for pg_dump, writing to stdout without -f, refusing to write
+# into an existing directory and failing if /app/fail exists
+FAKE_PG_DUMP = '''
+pg_dump() {
+    [ -e /app/fail ] && exit 1
+    for arg; do
+        case $arg in
+            --format=*) format=${arg#--format=} ;;
+        esac
+        [ "$previous" = -f ] && target=$arg
+        previous=$arg
+    done
+    if [ -z "$target" ]; then
+        echo "$format dump"
+    elif [ "$format" = directory ]; then
+        mkdir "$target" || exit 1
+        echo toc > "$target/toc.dat"
+        chmod -R go-rwx "$target"
+    else
+        echo "$format dump" > "$target"
+    fi
+}
+"$@"
+'''
+
+
+@pytest.fixture
+def dump_db(local_exec, monkeypatch, tmpdir):
+    local_exec(FAKE_PG_DUMP)
+    monkeypatch.setattr(utils, 'get_db_container_id', lambda path: 'db')
+
+    def dump(dump_format):
+        archive_path = str(tmpdir.join('local_db.tar.gz'))
+        main.create_db_archive(
+            str(tmpdir), archive_path, dump_format=dump_format, jobs=2,
+        )
+        with tarfile.open(archive_path) as tar:
+            return dict(
+                (member.name, tar.extractfile(member).read())
+                for member in tar.getmembers() if member.isfile()
+            )
+    return dump
+
+
+def test_create_db_archive_plain(dump_db):
+    assert dump_db('plain') == {'local_db.sql': b'plain dump\n'}
+
+
+def test_create_db_archive_replaces_directory_dump(dump_db, tmpdir):
+    # left over by an earlier push
+    tmpdir.mkdir('local_db').join('toc.dat').write('stale')
+    assert dump_db('directory') == {'local_db/toc.dat': b'toc\n'}
+    assert tmpdir.join('local_db').stat().mode & 0o777 == 0o777
+
+
+def test_create_db_archive_failed_dump(dump_db, tmpdir, monkeypatch):
+    # the separator uses click.get_terminal_size, which click 8 removed
+    monkeypatch.setattr(aldryn_utils, 'hr', lambda **kwargs: None)
+    tmpdir.join('fail').write('')
+    with pytest.raises(SystemExit):
+        dump_db('directory')
+
+
+class UploadHandler(StandInHandler):
+    """
+    Implements the database upload endpoint, keeping the uploaded files in
+    ``server.uploads``. Bare SQL dumps are refused unless
+    ``server.accepts_dumps`` is set.
+    """
+    def do_POST(self):
+        self.record()
+        files = self.read_multipart()
+        filename, _ = files['db_dump']
+        if '.tar' not in filename and not self.server.accepts_dumps:
+            return self.send_json({'message': 'not an archive'}, 400)
+        self.server.uploads.update(files)
+        self.send_json({'progress_url': '/progress/'})
+
+
+@pytest.fixture
+def upload_server(serve):
+    def start(accepts_dumps):
+        server = serve(UploadHandler)
+        server.uploads = {}
+        server.accepts_dumps = accepts_dumps
+        return server
+    return start
+
+
+def test_upload_db_pipeline(dump_db, upload_server, client, tmpdir):
+    server = upload_server(accepts_dumps=True)
+    response = main.upload_db_pipeline(client(server), 1, str(tmpdir))
+    assert response == {'progress_url': '/progress/'}
+    [(method, path, headers)] = server.requests
+    assert path == '/api/v1/website/1/upload/db/'
+    assert headers['Transfer-Encoding'] == 'chunked'
+
+    filename, data = server.uploads['db_dump']
+    assert filename == 'local_db.sql.gz'
+    assert gzip.GzipFile(fileobj=io.BytesIO(data)).read() == b'plain dump\n'
+    # streamed from pg_dump without writing a dump file
+    assert not tmpdir.join('local_db.sql').exists()
+
+
+def test_upload_db_pipeline_archive(dump_db, upload_server, client, tmpdir):
+    server = upload_server(accepts_dumps=False)
+    response = main.upload_db_pipeline(client(server), 1, str(tmpdir))
+    assert response == {'progress_url': '/progress/'}
+    assert len(server.requests) == 2
+
+    filename, data = server.uploads['db_dump']
+    assert filename == 'local_db.tar.gz'
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        [member] = tar.getmembers()
+        assert member.name == 'local_db.sql'
+        assert tar.extractfile(member).read() == b'plain dump\n'
+
+
+def test_upload_db_pipeline_failed_dump(dump_db, upload_server, client,
+                                        tmpdir):
+    server = upload_server(accepts_dumps=True)
+    tmpdir.join('fail').write('')
+    with pytest.raises(click.ClickException) as exc_info:
+        main.upload_db_pipeline(client(server), 1, str(tmpdir))
+    assert 'status 1' in exc_info.value.message
+    assert server.uploads == {}
+
+
+@pytest.mark.parametrize('command,ready', [('true', True), ('false', False)])
+def test_get_probe_prefers_command(local_exec, monkeypatch, command, ready):
+    local_exec()
+    # the health check of the container does not matter then
+    monkeypatch.setattr(readiness, 'has_health_check', lambda _: True)
+    probe = readiness.get_probe('db', command=[command])
+    assert probe() is ready
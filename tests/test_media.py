@@ -0,0 +1,219 @@
+import hashlib
+import io
+import json
+import tarfile
+import threading
+import time
+
+import click
+import pytest
+import six
+from six.moves.urllib_parse import unquote
+
+from aldryn_client.file_index import FileIndex
+from aldryn_client.localdev import main
+
+from conftest import StandInHandler
+
+
+class MediaHandler(StandInHandler):
+    """
+    Implements the media manifest, file, upload and progress endpoints of
+    the project 1. ``server.files`` maps the paths of the remote media
+    files to their content, ``None`` lets the manifest endpoint answer 404
+    like servers without it. Uploaded archives are kept in
+    ``server.uploads``.
+    """
+    files_prefix = '/api/v1/website/1/media/files/'
+
+    def do_GET(self):
+        self.record()
+        if self.path.startswith(self.files_prefix):
+            path = unquote(self.path[len(self.files_prefix):])
+            if path not in (self.server.files or {}):
+                return self.send_json({}, 404)
+            return self.send_body(self.server.files[path])
+        if self.path == '/progress/':
+            return self.send_json({'success': True})
+        if self.path == '/api/v1/website/1/media/manifest/':
+            if self.server.files is None:
+                return self.send_json({}, 404)
+            return self.send_json({'files': dict(
+                (path, {
+                    'size': len(data),
+                    'sha256': hashlib.sha256(data).hexdigest(),
+                })
+                for path, data in self.server.files.items()
+            )})
+        self.send_json({}, 404)
+
+    def do_POST(self):
+        self.record()
+        if self.path != '/api/v1/website/1/upload/media/':
+            return self.send_json({}, 404)
+        filename, data = self.read_multipart()['media_files']
+        self.server.uploads.append(data)
+        self.send_json({'progress_url': self.server.url + '/progress/'})
+
+
+@pytest.fixture
+def media_server(serve):
+    def start(files=None):
+        server = serve(MediaHandler)
+        server.files = files
+        server.uploads = []
+        return server
+    return start
+
+
+@pytest.fixture
+def project(tmpdir, monkeypatch):
+    """
+    A local project with the media files ``a.txt`` and ``b/c.txt``.
+    """
+    project_home = tmpdir.mkdir('project')
+    project_home.join('.aldryn').write(json.dumps({'id': 1, 'slug': 'demo'}))
+    media = project_home.mkdir('data').mkdir('media')
+    media.join('a.txt').write_binary(b'a')
+    media.mkdir('b').join('c.txt').write_binary(b'c')
+    monkeypatch.chdir(str(project_home))
+    return project_home
+
+
+def read_archive(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return dict(
+            (member.name, tar.extractfile(member).read())
+            for member in tar.getmembers() if member.isfile()
+        )
+
+
+def test_push_media_incremental(media_server, client, project):
+    server = media_server(files={'a.txt': b'a', 'b/c.txt': b'old', 'd': b''})
+    main.push_media(client(server), incremental=True)
+    [upload] = server.uploads
+    files = read_archive(upload)
+    assert sorted(files) == ['MANIFEST', 'b/c.txt']
+    assert json.loads(files['MANIFEST'].decode('utf-8'))['deleted'] == ['d']
+
+
+def test_push_media_incremental_without_manifest(media_server, client,
+                                                 project):
+    # a partial archive could delete the remote files missing from it
+    server = media_server(files=None)
+    main.push_media(client(server), incremental=True)
+    [upload] = server.uploads
+    assert read_archive(upload) == {'a.txt': b'a', 'b/c.txt': b'c'}
+
+    # also when the media has been pushed before
+    project.join('data', 'media', 'a.txt').write_binary(b'changed')
+    main.push_media(client(server), incremental=True)
+    assert read_archive(server.uploads[1]) == {
+        'a.txt': b'changed', 'b/c.txt': b'c',
+    }
+
+
+@pytest.fixture
+def pull_media(project, client, monkeypatch):
+    # no docker-compose in the tests
+    monkeypatch.setattr(main, 'make_data_writable', lambda project_home: None)
+
+    def pull(server):
+        main.pull_media(client(server), incremental=True)
+        media = project.join('data', 'media')
+        return dict(
+            (str(path.relto(media)), path.read_binary())
+            for path in media.visit() if path.isfile()
+        )
+    return pull
+
+
+def get_file_requests(server):
+    return sorted(
+        unquote(path[len(MediaHandler.files_prefix):])
+        for _, path, _ in server.requests
+        if path.startswith(MediaHandler.files_prefix)
+    )
+
+
+def test_pull_media_incremental(media_server, pull_media):
+    server = media_server(files={
+        'a.txt': b'a', 'b/c.txt': b'new', 'd e/f.txt': b'new',
+    })
+    assert pull_media(server) == {
+        'a.txt': b'a', 'b/c.txt': b'new', 'd e/f.txt': b'new',
+    }
+    # same content, downloaded once
+    assert get_file_requests(server) in (['b/c.txt'], ['d e/f.txt'])
+
+    del server.files['a.txt']
+    assert pull_media(server) == {'b/c.txt': b'new', 'd e/f.txt': b'new'}
+
+
+@pytest.mark.parametrize('path', ['../outside', '/etc/passwd', 'a//b'])
+def test_pull_media_incremental_unsafe_path(media_server, pull_media, path):
+    server = media_server(files={path: b'x'})
+    with pytest.raises(click.ClickException) as exc_info:
+        pull_media(server)
+    assert path in exc_info.value.message
+    assert get_file_requests(server) == []
+
+
+def test_pull_media_incremental_non_ascii(media_server, pull_media):
+    server = media_server(files={u'caf\xe9/\xfc.txt': b'x'})
+    assert pull_media(server) == {u'caf\xe9/\xfc.txt': b'x'}
+    del server.files[u'caf\xe9/\xfc.txt']
+    assert pull_media(server) == {}
+
+
+def test_file_index_non_ascii(tmpdir):
+    # the scanned file names are byte strings on python 2
+    directory = tmpdir.mkdir('media')
+    directory.join(u'\xfc.txt').write_binary(b'x')
+    with FileIndex(str(directory), str(tmpdir.join('index'))) as index:
+        manifest = index.update()
+        assert list(manifest) == [u'\xfc.txt']
+        assert isinstance(list(manifest)[0], six.text_type)
+        index.record(u'\xfc.txt', manifest[u'\xfc.txt']['sha256'])
+        assert index.update() == manifest
+
+
+class StalledArchiveHandler(StandInHandler):
+    """
+    Sends the start of a media archive with the unsafe member
+    ``../outside``, then stalls until ``server.release`` is set.
+    """
+    def do_GET(self):
+        self.record()
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            tar.addfile(tarfile.TarInfo('../outside'), io.BytesIO())
+        # more than the blocks read from the response, padded with zeros
+        data = buf.getvalue().ljust(2 * 1024 * 1024, b'\0')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data) * 2))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+        self.server.release.wait(30)
+        self.close_connection = True
+
+
+def test_pull_media_stream_unsafe_member(serve, client, tmpdir):
+    server = serve(StalledArchiveHandler)
+    server.release = threading.Event()
+    media = tmpdir.mkdir('media')
+    media.join('a.txt').write_binary(b'a')
+    start = time.time()
+    try:
+        with pytest.raises(click.ClickException) as exc_info:
+            main.pull_media_stream(
+                client(server), 'demo', server.url + '/media/', str(media),
+            )
+    finally:
+        server.release.set()
+    assert 'invalid' in exc_info.value.message
+    # without waiting for the stalled download
+    assert time.time() - start < 10
+    assert not tmpdir.join('outside').exists()
+    assert [path.basename for path in media.listdir()] == ['a.txt']
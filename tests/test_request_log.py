@@ -0,0 +1,53 @@
+import os
+import time
+
+from conftest import StandInHandler
+
+
+BODY = os.urandom(512 * 1024)
+
+
+class SignedURLHandler(StandInHandler):
+    """
+    Serves ``BODY`` for any URL but the progress endpoint, sending the
+    second half after a delay.
+    """
+    def do_GET(self):
+        self.record()
+        if self.path.startswith('/progress/'):
+            return self.send_json({'success': None})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY[:len(BODY) // 2])
+        self.wfile.flush()
+        time.sleep(0.2)
+        self.wfile.write(BODY[len(BODY) // 2:])
+
+
+def test_stream_logged_when_closed(serve, client):
+    server = serve(SignedURLHandler)
+    cloud_client = client(server)
+    request_log = cloud_client.enable_request_log()
+    response = cloud_client.download_db_stream(
+        'slug', url=server.url + '/dumps/db.tar.gz?Signature=secret',
+    )
+    assert not request_log.records
+    assert response.raw.read() == BODY
+    response.close()
+    response.close()
+
+    [record] = request_log.records
+    assert record['bytes_received'] == len(BODY)
+    assert record['total'] >= 0.2
+    assert record['url'] == '/api/v1/workspace/{website_slug}/download/db/'
+
+
+def test_log_url_of_server_urls(serve, client):
+    server = serve(SignedURLHandler)
+    cloud_client = client(server)
+    request_log = cloud_client.enable_request_log()
+    cloud_client.download_db_progress(
+        server.url + '/progress/?Signature=secret',
+    )
+    assert request_log.records[0]['url'] == '/progress/'